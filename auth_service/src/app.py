@@ -1,72 +1,31 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_restx import Api, Resource, fields
-from authentication import authenticate, verify_token, AuthorizationError
-from logging.config import dictConfig
-
-dictConfig({
-    'version': 1,
-    'formatters': {
-        'default': {
-            'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-        }
-    },
-    'handlers': {
-        'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'filename': 'authentication_logging.log',
-            'maxBytes': 1000000,
-            'backupCount': 3,
-            'formatter': 'default',
-        }
-    },
-    'root': {
-        'level': 'DEBUG',
-        'handlers': ['file']
-    }
-})
+from authentication import authenticate, verify_token, revoke_token, AuthorizationError, active_tokens, users
+import json
+from common import requestlog
+from common import metrics
 
-app = Flask(__name__)
+# From Flask documentation: "If possible, configure logging before creating the application object."
+requestlog.configure_logging('authentication_logging.log')
 
-@app.before_request
-def log_request_info():
-    app.logger.debug("REQUEST --- Source: %s, Destination: %s, Headers: %s, Metadata: %s, Body: %s",
-        request.remote_addr,
-        request.url,
-        dict(request.headers),
-        dict(request.args) if request.args else None,
-        request.get_data(as_text=True)
-    )
-
-@app.after_request
-def log_response_info(response):
-    if response.direct_passthrough:
-        response.direct_passthrough = False
-
-    content_type = response.headers.get("Content-Type", "")
-    loggable_types = ["text/", "application/json", "application/xml"] # filter for these types of responses, to avoid large blobs of text
-
-    if not any(content_type.startswith(t) for t in loggable_types):
-        body = f"<{content_type} not logged>"
-    else:
-        try:
-            body = response.get_data(as_text=True)
-            # There are some large bodies of text during logging, we can make them shorter by uncommenting the following 2 lines:
-            # if len(body) > 1000:
-            #     body = body[:1000] + "... [shortened]"
-        except Exception:
-            body = "<body is unreadable>"
-    app.logger.debug("RESPONSE --- Source: %s, Destination: %s, Headers: %s, Metadata: %s, Body: %s",
-                     request.url,
-                     request.remote_addr,
-                     dict(response.headers),
-                     None, body)
-    return response
+app = Flask(__name__)
+requestlog.install(app)
+metrics.install(app)
+metrics.Gauge('auth_active_tokens', 'Issued tokens in the token store (active_tokens), shared by all worker processes', function=lambda: len(active_tokens))
 
 api = Api(app, 
           title='Authentication Service', 
           description='Authentication service for DS project',
           version='0.4.22')
 
+# The user and token tables are created at deploy time by "flask --app app init-db" (python app.py does it before
+# serving), not whenever a worker process imports the app
+@app.cli.command('init-db')
+def init_db():
+    """Create the missing tables of the user and token stores"""
+    users.create_schema()
+    active_tokens.create_schema()
+
 # Namespace definition for organization
 auth_ns = api.namespace('auth', description='Authentication services')
 
@@ -94,6 +53,11 @@ verify_r = api.model('VerifyResponse',
                         'valid' : fields.Boolean(description = 'Token Validity ')
                     })
 
+revoked_r = api.model('RevokedTokens',
+                    {
+                        'revoked': fields.List(fields.String, description = 'Ids (jti) of the logged out signed tokens that have not expired yet')
+                    })
+
 error_m = api.model('Error', 
                     {
                         'error': fields.String(description = 'Error Message')
@@ -103,13 +67,16 @@ error_m = api.model('Error',
 class Login(Resource):
     @api.expect(login_m)
     @api.response(200, 'Success', token_m)
+    @api.response(400, 'Bad Request', error_m)
     @api.response(401, 'Authentication Failed', error_m)
     def post(self):
         """Login with username and password -> token"""
         try:
             data = request.json
-            if not data or 'username' not in data or 'password' not in data:
+            if not isinstance(data, dict) or 'username' not in data or 'password' not in data:
                 return {'error': 'Missing username or password information'}, 400
+            if not isinstance(data['username'], str) or not isinstance(data['password'], str):
+                return {'error': 'Username and password must be strings'}, 400
             
             try:
                 result = authenticate(data['username'], data['password'])
@@ -137,6 +104,41 @@ class Verify(Resource):
         except Exception as e:
             return {'error': str(e)}, 500
 
+@auth_ns.route('/logout')
+class Logout(Resource):
+    @api.expect(verify_m)
+    @api.response(200, 'Token revoked')
+    @api.response(400, 'Bad Request', error_m)
+    @api.response(401, 'Invalid token', error_m)
+    def post(self):
+        """Revoke a token (logout)"""
+        try:
+            data = request.json
+            if not data or 'username' not in data or 'token' not in data:
+                return {'error': 'Missing username or token'}, 400
+
+            if not revoke_token(data['username'], data['token']):
+                return {'error': 'Invalid or expired token'}, 401
+            return {'revoked': True}, 200
+        except Exception as e:
+            return {'error': str(e)}, 500
+
+@auth_ns.route('/revoked')
+class Revoked(Resource):
+    @api.response(200, 'Success', revoked_r)
+    def get(self):
+        """Ids of the logged out signed tokens, for services that verify signed tokens themselves"""
+        return {'revoked': active_tokens.revoked_ids()}, 200
+
+
+# The Swagger spec is built once, when the app is loaded (with gunicorn's preload_app before the workers are forked),
+# and every GET /swagger.json is answered with the same bytes
+with app.test_request_context():
+    swagger_json = json.dumps(api.__schema__).encode('utf-8')
+app.view_functions['specs'] = lambda: Response(swagger_json, mimetype='application/json')
+
 
 if __name__ == '__main__':
+    users.create_schema()
+    active_tokens.create_schema()
     app.run(debug=True, port= 8000)
\ No newline at end of file
@@ -1,47 +1,78 @@
 import base64
 import os
 import time
-from usermodels import users, UserRole
+from usermodels import UserRole
+from userstore import UserStore
+from common.signedtokens import sign_token, read_token
+from tokenstore import TokenStore
 
-# in-memory token storage
-active_tokens = {}
 TOKEN_EXP = 3600
 
+# Users with hashed passwords (SQLite file); password checks run in a process pool of LOGIN_WORKERS processes
+users = UserStore(os.environ.get('USER_DB_PATH', 'users.db'),
+                  cache_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+                  cache_ttl=float(os.environ.get('USER_CACHE_TTL', 5)),
+                  workers=int(os.environ.get('LOGIN_WORKERS', 0)) or None)
+
+# Token storage shared by all auth worker processes on this host (SQLite file)
+active_tokens = TokenStore(os.environ.get('TOKEN_DB_PATH', 'tokens.db'),
+                           capacity=int(os.environ.get('TOKEN_STORE_CAPACITY', 100000)),
+                           sweep_interval=float(os.environ.get('TOKEN_SWEEP_INTERVAL', 60)))
+
+# TOKEN_MODE=random: random tokens, looked up in active_tokens
+# TOKEN_MODE=signed: HMAC-signed tokens carrying username, role and expiry, verifiable by any process holding TOKEN_SECRET
+TOKEN_MODE = os.environ.get('TOKEN_MODE', 'random')
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '').encode('utf-8')
+if TOKEN_MODE == 'signed' and not TOKEN_SECRET:
+    raise RuntimeError("TOKEN_MODE=signed needs the shared signing key in TOKEN_SECRET")
+
 class AuthorizationError(Exception):
     """For raising authorisation error in the authenticate function"""
     pass
 
 def generate_token(username, userrole):
     """Generate token with role and random string"""
+    if TOKEN_MODE == 'signed':
+        return sign_token(TOKEN_SECRET, username, userrole.value, TOKEN_EXP)
+
     random_bytes = os.urandom(16)
     random_string = base64.b64encode(random_bytes).decode('utf-8')
     token = f"{userrole.value}:{random_string}"
 
-    # Token and expiration stored together
-    active_tokens[username] = (token, time.time() + TOKEN_EXP)
+    # Token and expiration stored together; a user may hold several tokens at once
+    active_tokens.add(token, username, userrole.value, time.time() + TOKEN_EXP)
     return token
 
 def verify_token(username, token):
     """Verify if token is still valid for user"""
-    if username not in active_tokens:
-        return False
+    if TOKEN_MODE == 'signed':
+        claims = read_token(TOKEN_SECRET, token)
+        return claims is not None and claims['sub'] == username and not active_tokens.is_revoked(claims['jti'])
+
+    # Expired tokens are not returned, the store's sweeper deletes them
+    stored = active_tokens.get(token)
+    return stored is not None and stored[0] == username
 
-    stored_token, expiry_time = active_tokens[username]
-    if time.time() > expiry_time:
-        # Token is already expired
-        del active_tokens[username]
+def revoke_token(username, token):
+    """Log out: the token is no longer accepted. Returns False if it was not a valid token of this user"""
+    if not verify_token(username, token):
         return False
-    return stored_token == token
+    if TOKEN_MODE == 'signed':
+        claims = read_token(TOKEN_SECRET, token)
+        active_tokens.revoke(claims['jti'], claims['exp']) # kept until the token would have expired anyway
+    else:
+        active_tokens.delete(token)
+    return True
 
 def authenticate(username, pwd):
     """
     The authentication function accepting username and password
     """
-    if username in users and users[username].password == pwd:
+    user = users.check_password(username, pwd)
+    if user is not None:
         # successful validation
-        user = users[username]
         token = generate_token(username, user.role)
         return {"token": token, "role": user.role.value}
 
     # Authorization failed
-    raise AuthorizationError("Authorization failed")
\ No newline at end of file
+    raise AuthorizationError("Authorization failed")
@@ -0,0 +1,5 @@
+import os
+
+# The modules used by both services are kept once, in the common folder at the top of the repository.
+# This package of each service's src folder loads them from there, e.g. "from common.signedtokens import read_token".
+__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, os.pardir, 'common'))
@@ -0,0 +1,25 @@
+import os
+from common.serving import worker_count
+
+# Production serving of the authentication service: "python -m gunicorn app:app" in this folder (gunicorn reads
+# this file from there), after "flask --app app init-db" has created the user and token tables.
+# The master process imports the app once (preload_app) and forks WEB_WORKERS worker processes with WEB_THREADS
+# request threads each. Settings come from environment variables:
+# WEB_BIND       address to listen on (default 127.0.0.1:8000)
+# WEB_WORKERS    worker processes (default: one per core; -w/--workers of the command line override it)
+# WEB_THREADS    request threads per worker (default 8)
+# WEB_BACKLOG    connections waiting to be accepted (default 2048)
+# WEB_TIMEOUT    seconds a busy worker may not answer the master before it is restarted (default 60)
+
+bind = os.environ.get('WEB_BIND', '127.0.0.1:8000')
+workers = worker_count(int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))) # -w on the command line counts too
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+preload_app = True
+backlog = int(os.environ.get('WEB_BACKLOG', 2048))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+# Every worker checks passwords in a process pool of its own (LOGIN_WORKERS processes); unless set, the workers share the cores
+if 'LOGIN_WORKERS' not in os.environ:
+    raw_env = [f'LOGIN_WORKERS={max(1, (os.cpu_count() or 1) // workers)}']
@@ -0,0 +1,120 @@
+import os
+import sqlite3
+import threading
+import time
+from common import metrics
+
+class TokenStore:
+    """
+    Issued tokens in a SQLite file, shared by every auth worker process on the host.
+    Lookups go through the token's primary key, expired tokens are found through an index on the
+    expiry time (removed by a background sweeper, and ignored on lookup in the meantime), and the
+    number of stored tokens is bounded: when capacity is reached, the tokens closest to expiry go first.
+    A user can hold several tokens (sessions) at once.
+    """
+
+    def __init__(self, path, capacity=100000, sweep_interval=60):
+        self.path = path
+        self.capacity = capacity
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+
+    def create_schema(self):
+        """Create the missing tables, indexes and triggers; run once at deploy time (flask --app app init-db)"""
+        self._db().executescript("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                role TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_tokens_expires_at ON tokens (expires_at);
+            CREATE INDEX IF NOT EXISTS ix_tokens_username ON tokens (username);
+
+            -- revoked signed tokens (which are not stored in tokens), by token id
+            CREATE TABLE IF NOT EXISTS revoked (
+                jti TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_revoked_expires_at ON revoked (expires_at);
+
+            -- row count of tokens kept by triggers, so the capacity check does not count the table
+            CREATE TABLE IF NOT EXISTS token_count (n INTEGER NOT NULL);
+            INSERT INTO token_count (n) SELECT COUNT(*) FROM tokens WHERE NOT EXISTS (SELECT 1 FROM token_count);
+            CREATE TRIGGER IF NOT EXISTS tokens_count_insert AFTER INSERT ON tokens BEGIN UPDATE token_count SET n = n + 1; END;
+            CREATE TRIGGER IF NOT EXISTS tokens_count_delete AFTER DELETE ON tokens BEGIN UPDATE token_count SET n = n - 1; END;
+        """)
+
+    def _db(self):
+        # One connection per thread and process; sqlite3 connections must not cross either
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, factory=metrics.TimedConnection) # autocommit, transactions are explicit
+            db.execute("PRAGMA journal_mode=WAL") # readers do not block the writer and vice versa
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _ensure_sweeper(self):
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid != os.getpid():
+                threading.Thread(target=self._sweep_forever, name='token-sweeper', daemon=True).start()
+                self._sweeper_pid = os.getpid()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                pass # the next round retries
+
+    def sweep(self):
+        """Delete expired tokens and revocations; returns the number of deleted tokens"""
+        now = time.time()
+        db = self._db()
+        deleted = db.execute("DELETE FROM tokens WHERE expires_at <= ?", (now,)).rowcount
+        db.execute("DELETE FROM revoked WHERE expires_at <= ?", (now,))
+        return deleted
+
+    def add(self, token, username, role, expires_at):
+        self._ensure_sweeper()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO tokens (token, username, role, expires_at) VALUES (?, ?, ?, ?)", (token, username, role, expires_at))
+            excess = db.execute("SELECT n FROM token_count").fetchone()[0] - self.capacity
+            if excess > 0:
+                db.execute("DELETE FROM tokens WHERE token IN (SELECT token FROM tokens ORDER BY expires_at LIMIT ?)", (excess,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def get(self, token):
+        """(username, role) of a stored, unexpired token, or None"""
+        row = self._db().execute("SELECT username, role, expires_at FROM tokens WHERE token = ?", (token,)).fetchone()
+        if row is None or row[2] <= time.time():
+            return None
+        return row[0], row[1]
+
+    def delete(self, token):
+        return self._db().execute("DELETE FROM tokens WHERE token = ?", (token,)).rowcount > 0
+
+    def revoke(self, jti, expires_at):
+        self._ensure_sweeper()
+        self._db().execute("INSERT OR REPLACE INTO revoked (jti, expires_at) VALUES (?, ?)", (jti, expires_at))
+
+    def is_revoked(self, jti):
+        return self._db().execute("SELECT 1 FROM revoked WHERE jti = ?", (jti,)).fetchone() is not None
+
+    def revoked_ids(self):
+        """Ids of the revoked signed tokens that have not expired yet"""
+        return [row[0] for row in self._db().execute("SELECT jti FROM revoked WHERE expires_at > ?", (time.time(),))]
+
+    def __len__(self):
+        return self._db().execute("SELECT n FROM token_count").fetchone()[0]
@@ -6,13 +6,7 @@ class UserRole(Enum):
     SECRETARY = "secretary"
 
 class User:
-    def __init__(self, username, password, role):
+    def __init__(self, username, password_hash, role):
         self.username = username
-        self.password = password
-        self.role = role
-
-users = {
-    "mynames_admin": User("mynames_admin", "password123", UserRole.ADMINISTRATOR),
-    "agent_007": User("agent_007", "Bond007", UserRole.AGENT),
-    "stacy": User("stacy", "starbucks123", UserRole.SECRETARY)
-}
\ No newline at end of file
+        self.password_hash = password_hash
+        self.role = role
\ No newline at end of file
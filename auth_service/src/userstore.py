@@ -0,0 +1,163 @@
+import base64
+import csv
+import hashlib
+import hmac
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from common import metrics
+from usermodels import User, UserRole
+
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', 100000))
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    """Salted PBKDF2-SHA256 hash, stored as 'pbkdf2_sha256$<iterations>$<salt>$<hash>'"""
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode('ascii')}${base64.b64encode(digest).decode('ascii')}"
+
+def verify_password(password, password_hash):
+    """Check a password against a stored hash; module-level so it can run in a worker process"""
+    algorithm, iterations, salt, digest = password_hash.split('$')
+    if algorithm != 'pbkdf2_sha256':
+        return False
+    computed = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(computed, base64.b64decode(digest))
+
+def _hash_row(row):
+    username, password, role = row
+    return username, hash_password(password), role
+
+# Verified against when the username does not exist, so unknown users take as long as wrong passwords
+DUMMY_HASH = hash_password('')
+
+# Users of the first start, so the service can be tried out right away
+DEFAULT_USERS = [
+    ("mynames_admin", "password123", UserRole.ADMINISTRATOR),
+    ("agent_007", "Bond007", UserRole.AGENT),
+    ("stacy", "starbucks123", UserRole.SECRETARY)
+]
+
+class UserStore:
+    """
+    Users in a SQLite table with salted password hashes, with an LRU cache of user records in front of it.
+    Cached records are trusted for cache_ttl seconds, so a user changed by another process (another worker, or an
+    import) is read again soon; unknown users are not cached, so a new user can log in right away.
+    Password checks run in a process pool, so concurrent logins use all cores instead of queueing on the GIL.
+    """
+
+    def __init__(self, path, cache_size=10000, workers=None, cache_ttl=5.0):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.workers = workers or os.cpu_count()
+        self._cache = OrderedDict() # username -> (User, expires_at)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+        self._pool_pid = None
+
+    def create_schema(self):
+        """Create the users table, with the default users when it is empty; run once at deploy time (flask --app app init-db)"""
+        db = self._db()
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password_hash TEXT NOT NULL,
+                role TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        if db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+            self.add_many([(username, hash_password(password), role.value) for username, password, role in DEFAULT_USERS])
+
+    def _db(self):
+        # One connection per thread and process; sqlite3 connections must not cross either
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, factory=metrics.TimedConnection)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _executor(self):
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                # spawn, not fork: forking a process that runs request threads can copy held locks
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def get(self, username):
+        """User record, or None if there is no such user"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(username)
+            if entry is not None and entry[1] > now:
+                self._cache.move_to_end(username)
+                return entry[0]
+        row = self._db().execute("SELECT username, password_hash, role FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        user = User(row[0], row[1], UserRole(row[2]))
+        if self.cache_ttl > 0:
+            with self._lock:
+                self._cache[username] = (user, now + self.cache_ttl)
+                self._cache.move_to_end(username)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return user
+
+    def check_password(self, username, password):
+        """The user if the password is right, otherwise None"""
+        user = self.get(username)
+        password_hash = user.password_hash if user else DUMMY_HASH
+        valid = self._executor().submit(verify_password, password, password_hash).result()
+        return user if user and valid else None
+
+    def add_many(self, rows):
+        """Insert or replace (username, password_hash, role) rows in one transaction"""
+        db = self._db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO users (username, password_hash, role) VALUES (?, ?, ?)", rows)
+        with self._lock:
+            for username, _, _ in rows:
+                self._cache.pop(username, None)
+
+    def import_csv(self, path, batch_size=10000):
+        """
+        Load users from a CSV file with the columns username, role and either password or password_hash.
+        Plain passwords are hashed in the process pool. Returns the number of imported users.
+        """
+        count = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            batch = []
+            for record in reader:
+                UserRole(record['role']) # fail early on unknown roles
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    count += self._import_batch(batch)
+                    batch = []
+            count += self._import_batch(batch)
+        return count
+
+    def _import_batch(self, records):
+        hashed = [(r['username'], r['password_hash'], r['role']) for r in records if r.get('password_hash')]
+        plain = [(r['username'], r['password'], r['role']) for r in records if not r.get('password_hash')]
+        hashed.extend(self._executor().map(_hash_row, plain, chunksize=256))
+        self.add_many(hashed)
+        return len(hashed)
+
+
+if __name__ == '__main__':
+    # python userstore.py import users.csv
+    if len(sys.argv) != 3 or sys.argv[1] != 'import':
+        sys.exit("usage: python userstore.py import <users.csv>")
+    store = UserStore(os.environ.get('USER_DB_PATH', 'users.db'))
+    store.create_schema()
+    print(f"Imported {store.import_csv(sys.argv[2])} users")
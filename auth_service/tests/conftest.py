@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The service reads its settings from the environment when its modules are imported, so they are set first:
+# fresh SQLite files in a temporary folder, random tokens and fewer hash iterations, so logins are quick.
+# Run from auth_service: python -m pytest tests
+FOLDER = tempfile.mkdtemp(prefix='auth_service_tests_')
+os.environ.update({
+    'USER_DB_PATH': os.path.join(FOLDER, 'users.db'),
+    'TOKEN_DB_PATH': os.path.join(FOLDER, 'tokens.db'),
+    'PASSWORD_ITERATIONS': '1000',
+    'LOGIN_WORKERS': '1',
+    'TOKEN_MODE': 'random',
+})
+os.environ.pop('TOKEN_SECRET', None)
+os.chdir(FOLDER) # the request log file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+import app as service # noqa: E402
+
+service.users.create_schema()
+service.active_tokens.create_schema()
+
+@pytest.fixture
+def client():
+    return service.app.test_client()
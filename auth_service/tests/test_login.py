@@ -0,0 +1,31 @@
+import authentication
+from userstore import hash_password
+
+def test_login_needs_string_credentials(client):
+    for body in ({'username': 'agent_007', 'password': 5}, {'username': 'agent_007', 'password': None},
+                 {'username': ['agent_007'], 'password': 'Bond007'}, {'username': {}, 'password': 'Bond007'}):
+        response = client.post('/auth/login', json=body)
+        assert response.status_code == 400, body
+        assert response.json['error'] == 'Username and password must be strings'
+    for body in ({'username': 'agent_007'}, ['agent_007', 'Bond007'], 'username password'):
+        assert client.post('/auth/login', json=body).status_code == 400, body
+
+def test_new_user_can_log_in_right_away(client):
+    users = authentication.users
+    assert client.post('/auth/login', json={'username': 'newcomer', 'password': 'secret'}).status_code == 401
+    users.add_many([('newcomer', hash_password('secret'), 'agent')])
+    assert client.post('/auth/login', json={'username': 'newcomer', 'password': 'secret'}).status_code == 200
+
+def test_cached_users_expire(monkeypatch):
+    users = authentication.users
+    now = [1000.0]
+    monkeypatch.setattr('userstore.time.monotonic', lambda: now[0])
+    users.add_many([('changing', hash_password('old'), 'agent')])
+    assert users.get('changing').role.value == 'agent'
+    # changed by another process, which does not invalidate this process's cache
+    db = users._db()
+    with db:
+        db.execute("UPDATE users SET role = 'administrator' WHERE username = 'changing'")
+    assert users.get('changing').role.value == 'agent'
+    now[0] += users.cache_ttl
+    assert users.get('changing').role.value == 'administrator'
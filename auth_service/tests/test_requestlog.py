@@ -0,0 +1,24 @@
+import logging
+from common import requestlog
+
+def logged(caplog, path):
+    events = [record.event for record in caplog.records if getattr(record, 'event', {}).get('path') == path]
+    assert events
+    return events[-1]
+
+def test_passwords_and_tokens_are_not_logged(client, caplog):
+    caplog.set_level(logging.DEBUG)
+    response = client.post('/auth/login', json={'username': 'agent_007', 'password': 'Bond007'})
+    token = response.json['token']
+    event = logged(caplog, '/auth/login')
+    assert 'Bond007' not in event['request_body'] and '"password": "<redacted>"' in event['request_body']
+    assert '"username": "agent_007"' in event['request_body']
+    assert token not in event['response_body'] and '"token": "<redacted>"' in event['response_body']
+    client.post('/auth/authenticate', json={'username': 'agent_007', 'token': token}, headers={'Authorization': token})
+    event = logged(caplog, '/auth/authenticate')
+    assert token not in str(event)
+
+def test_unparsable_bodies_with_secrets_are_not_logged():
+    assert requestlog._body(b'{"password": "Bond0', 'application/json') == "<body with redacted fields not logged>"
+    assert requestlog._body(b'[{"a": {"token": "x"}}]', 'application/json') == '[{"a": {"token": "<redacted>"}}]'
+    assert requestlog._body(b'{"customer": "c"}', 'application/json') == '{"customer": "c"}'
@@ -0,0 +1,56 @@
+import pytest
+import authentication
+
+@pytest.fixture
+def signed(monkeypatch):
+    monkeypatch.setattr(authentication, 'TOKEN_MODE', 'signed')
+    monkeypatch.setattr(authentication, 'TOKEN_SECRET', b'test secret')
+
+@pytest.fixture(params=['random', 'signed'])
+def token_mode(request):
+    """Runs a test with random tokens and with signed ones"""
+    if request.param == 'signed':
+        request.getfixturevalue('signed')
+    return request.param
+
+def login(client, username='agent_007', password='Bond007'):
+    response = client.post('/auth/login', json={'username': username, 'password': password})
+    assert response.status_code == 200
+    return response.json['token']
+
+def valid(client, token, username='agent_007'):
+    response = client.post('/auth/authenticate', json={'username': username, 'token': token})
+    assert response.status_code == 200
+    return response.json['validity']
+
+def test_login_gives_a_valid_token(client, token_mode):
+    token = login(client)
+    assert token.startswith('agent:')
+    assert valid(client, token)
+    assert not valid(client, token, username='stacy')
+
+def test_wrong_password_is_rejected(client):
+    response = client.post('/auth/login', json={'username': 'agent_007', 'password': 'wrong'})
+    assert response.status_code == 401
+
+def test_tampered_token_is_invalid(client, token_mode):
+    token = login(client)
+    last = 'A' if token[-1] != 'A' else 'B'
+    for tampered in (token[:-1] + last, 'administrator' + token[len('agent'):], token + 'é', 'agent:é.é', ''):
+        assert not valid(client, tampered), tampered
+
+def test_logout_revokes_the_token(client, token_mode):
+    token, other = login(client), login(client)
+    response = client.post('/auth/logout', json={'username': 'agent_007', 'token': token})
+    assert response.status_code == 200
+    assert not valid(client, token)
+    assert valid(client, other)
+    # a second logout finds no valid token
+    assert client.post('/auth/logout', json={'username': 'agent_007', 'token': token}).status_code == 401
+
+def test_revoked_lists_logged_out_signed_tokens(client, signed):
+    token = login(client)
+    jti = authentication.read_token(authentication.TOKEN_SECRET, token)['jti']
+    assert jti not in client.get('/auth/revoked').json['revoked']
+    client.post('/auth/logout', json={'username': 'agent_007', 'token': token})
+    assert jti in client.get('/auth/revoked').json['revoked']
@@ -0,0 +1,403 @@
+import argparse
+import csv
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+import requests
+
+# End-to-end benchmark of both services: starts auth_service and transactions_service on free local ports, in a
+# temporary folder (so they get fresh SQLite files), seeds users and transactions, then drives a mix of requests
+# from concurrent clients and reports throughput and latency percentiles per endpoint as JSON.
+#
+# python benchmarks/bench.py run [options] > report.json      (see --help; the summary table goes to stderr)
+# python benchmarks/bench.py run --baseline baseline.json      also compares with an earlier report
+# python benchmarks/bench.py compare report.json baseline.json
+#
+# Both compare modes exit with status 1 when an endpoint got slower or lost throughput by more than --tolerance.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTH_SRC = os.path.join(ROOT, 'auth_service', 'src')
+TRANSACTIONS_SRC = os.path.join(ROOT, 'transactions_service', 'src')
+
+OPERATIONS = ('login', 'verify', 'create', 'list', 'get', 'update', 'result')
+DEFAULT_MIX = 'login=1,verify=10,create=10,list=5,get=20,update=5,result=10'
+STATUSES = ('submitted', 'accepted', 'rejected')
+PERCENTILES = (50, 95, 99)
+SEED_BATCH_SIZE = 5000
+STARTUP_TIMEOUT = 60
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def parse_pairs(value, convert):
+    """'a=1,b=2' -> {'a': convert('1'), 'b': convert('2')}"""
+    pairs = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        key, _, setting = item.partition('=')
+        pairs[key.strip()] = convert(setting.strip())
+    return pairs
+
+
+class Service:
+    """One service as a child process in its own process group (so its worker processes are stopped with it)"""
+
+    def __init__(self, name, command, src, workdir, env):
+        self.name = name
+        self.log_path = os.path.join(workdir, f'{name}.out')
+        env = dict(os.environ, PYTHONPATH=src, **env)
+        with open(self.log_path, 'wb') as log:
+            self.process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def wait_ready(self, url):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if requests.get(url, timeout=1).status_code < 500:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        with open(self.log_path, errors='replace') as log:
+            output = log.read()[-2000:]
+        raise RuntimeError(f"{self.name} did not start:\n{output}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+
+
+def flask_command(port):
+    return [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', '127.0.0.1', '--port', str(port), '--no-reload', '--no-debugger']
+
+def gunicorn_command(port, src):
+    # the settings of gunicorn.conf.py (preloaded app, WEB_WORKERS and WEB_THREADS), on the port of the benchmark
+    return [sys.executable, '-m', 'gunicorn', '-c', os.path.join(src, 'gunicorn.conf.py'), '--bind', f'127.0.0.1:{port}', 'app:app']
+
+def server_command(server, port, src):
+    return gunicorn_command(port, src) if server == 'gunicorn' else flask_command(port)
+
+def init_db(src, workdir, env):
+    """Create the tables of a service, as at deploy time"""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'],
+                   cwd=workdir, env=dict(os.environ, PYTHONPATH=src, **env), check=True, stdout=subprocess.DEVNULL)
+
+def asyncio_command(port):
+    return [sys.executable, '-m', 'aiohttp.web', '-H', '127.0.0.1', '-P', str(port), 'asyncapp:make_app']
+
+def seed_users(workdir, count, env):
+    """count users (half agents, half administrators) imported with userstore.py; returns [(username, password)]"""
+    users = [(f'bench_user_{i}', f'bench_password_{i}', ('agent', 'administrator')[i % 2]) for i in range(count)]
+    path = os.path.join(workdir, 'users.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['username', 'password', 'role'])
+        writer.writerows(users)
+    subprocess.run([sys.executable, os.path.join(AUTH_SRC, 'userstore.py'), 'import', path],
+                   cwd=workdir, env=dict(os.environ, PYTHONPATH=AUTH_SRC, **env), check=True, stdout=subprocess.DEVNULL)
+    return [(username, password) for username, password, _ in users]
+
+
+class Workload:
+    """The requests of the mix and the state they share: tokens of the logged in users and known transaction ids"""
+
+    def __init__(self, auth_url, transactions_url, users, customers, vendors):
+        self.auth_url = auth_url
+        self.transactions_url = transactions_url
+        self.users = users
+        self.customers = customers
+        self.vendors = vendors
+        self.tokens = []
+        self.ids = [] # appended by the clients; list.append is atomic
+        self.operations = {name: getattr(self, name) for name in OPERATIONS}
+
+    def log_in_all(self, http):
+        for username, password in self.users:
+            response = http.post(f'{self.auth_url}/auth/login', json={'username': username, 'password': password})
+            response.raise_for_status()
+            self.tokens.append((username, response.json()['token']))
+
+    def headers(self, rng):
+        username, token = rng.choice(self.tokens)
+        return {'Authorization': token, 'Username': username}
+
+    def transaction(self, rng):
+        return {'customer': rng.choice(self.customers), 'vendor_id': rng.choice(self.vendors), 'amount': round(rng.uniform(1, 5000), 2)}
+
+    def seed_transactions(self, http, count, rng):
+        while count > 0:
+            batch = [self.transaction(rng) for _ in range(min(count, SEED_BATCH_SIZE))]
+            response = http.post(f'{self.transactions_url}/transactions/batch', json=batch, headers=self.headers(rng))
+            response.raise_for_status()
+            self.ids.extend(item['id'] for item in response.json()['items'])
+            count -= len(batch)
+
+    def login(self, http, rng):
+        username, password = rng.choice(self.users)
+        return http.post(f'{self.auth_url}/auth/login', json={'username': username, 'password': password})
+
+    def verify(self, http, rng):
+        username, token = rng.choice(self.tokens)
+        return http.post(f'{self.auth_url}/auth/authenticate', json={'username': username, 'token': token})
+
+    def create(self, http, rng):
+        response = http.post(f'{self.transactions_url}/transactions/', json=self.transaction(rng), headers=self.headers(rng))
+        if response.status_code == 201:
+            self.ids.append(response.json()['id'])
+        return response
+
+    def list(self, http, rng):
+        params = {'limit': 100}
+        if rng.random() < 0.5:
+            params['customer'] = rng.choice(self.customers)
+        return http.get(f'{self.transactions_url}/transactions/', params=params, headers=self.headers(rng))
+
+    def get(self, http, rng):
+        return http.get(f'{self.transactions_url}/transactions/{rng.choice(self.ids)}', headers=self.headers(rng))
+
+    def update(self, http, rng):
+        return http.put(f'{self.transactions_url}/transactions/{rng.choice(self.ids)}', json={'status': rng.choice(STATUSES)}, headers=self.headers(rng))
+
+    def result(self, http, rng):
+        return http.get(f'{self.transactions_url}/results/transaction/{rng.choice(self.ids)}', headers=self.headers(rng))
+
+
+def drive(workload, mix, concurrency, warmup, duration, seed):
+    """
+    concurrency clients, each with its own keep-alive session, send requests back to back, picked from mix by weight.
+    Returns ({operation: [latency in seconds]}, {operation: errors}, measured seconds); warmup requests are not counted.
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    start = time.perf_counter() + warmup
+    stop = start + duration
+
+    def client(number):
+        rng = random.Random(seed * 1000 + number)
+        own_latencies = {name: [] for name in names}
+        own_errors = {name: 0 for name in names}
+        with requests.Session() as http:
+            while True:
+                name = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                if started >= stop:
+                    break
+                try:
+                    ok = workload.operations[name](http, rng).status_code < 400
+                except requests.RequestException:
+                    ok = False
+                if started >= start:
+                    own_latencies[name].append(time.perf_counter() - started)
+                    own_errors[name] += not ok
+        with lock:
+            for name in names:
+                latencies[name].extend(own_latencies[name])
+                errors[name] += own_errors[name]
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, duration
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(latencies, errors, seconds):
+    endpoints = {}
+    for name, values in latencies.items():
+        values = sorted(values)
+        endpoint = {'requests': len(values), 'errors': errors[name], 'throughput_rps': round(len(values) / seconds, 2)}
+        if values:
+            endpoint.update({f'p{p}_ms': round(percentile(values, p) * 1000, 3) for p in PERCENTILES})
+            endpoint['mean_ms'] = round(sum(values) / len(values) * 1000, 3)
+            endpoint['max_ms'] = round(values[-1] * 1000, 3)
+        endpoints[name] = endpoint
+    every = sorted(value for values in latencies.values() for value in values)
+    total = {'requests': len(every), 'errors': sum(errors.values()), 'throughput_rps': round(len(every) / seconds, 2)}
+    if every:
+        total.update({f'p{p}_ms': round(percentile(every, p) * 1000, 3) for p in PERCENTILES})
+    return endpoints, total
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline, tolerance):
+    """
+    Per endpoint: the ratio of every percentile and of the throughput to the baseline, and whether it regressed,
+    i.e. a percentile is more than tolerance slower or the throughput more than tolerance lower
+    """
+    if report.get('config') != baseline.get('config'):
+        print("Note: the baseline was measured with other settings", file=sys.stderr)
+    comparison = {}
+    for name, endpoint in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if not before or not before.get('requests') or not endpoint.get('requests'):
+            continue
+        ratios = {key: round(endpoint[key] / before[key], 3) if before[key] else None
+                  for key in [f'p{p}_ms' for p in PERCENTILES] + ['throughput_rps']}
+        regressed = [key for key, ratio in ratios.items() if ratio is not None and
+                     (ratio < 1 - tolerance if key == 'throughput_rps' else ratio > 1 + tolerance)]
+        comparison[name] = {'ratios': ratios, 'regressed': regressed}
+    return comparison
+
+def print_summary(report, out=sys.stderr):
+    comparison = report.get('comparison', {})
+    print(f"{'endpoint':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+    for name, endpoint in list(report['endpoints'].items()) + [('total', report['total'])]:
+        row = f"{name:<10}{endpoint['requests']:>10}{endpoint['errors']:>8}{endpoint['throughput_rps']:>10}"
+        row += ''.join(f"{endpoint.get(f'p{p}_ms', '-'):>10}" for p in PERCENTILES)
+        if comparison.get(name, {}).get('regressed'):
+            row += '  REGRESSED: ' + ', '.join(f"{key} x{comparison[name]['ratios'][key]}" for key in comparison[name]['regressed'])
+        print(row, file=out)
+
+def regressions(report):
+    return [name for name, result in report.get('comparison', {}).items() if result['regressed']]
+
+def run(args):
+    mix = parse_pairs(args.mix, float)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        sys.exit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+    env = dict(item.split('=', 1) for item in args.env)
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    services = []
+    try:
+        auth_port, transactions_port = free_port(), free_port()
+        auth_url, transactions_url = f'http://127.0.0.1:{auth_port}', f'http://127.0.0.1:{transactions_port}'
+        transactions_env = dict({'AUTH_SERVICE_URL': auth_url}, **env)
+        init_db(AUTH_SRC, workdir, env)
+        init_db(TRANSACTIONS_SRC, workdir, transactions_env)
+        users = seed_users(workdir, args.users, env)
+        services.append(Service('auth_service', server_command(args.server, auth_port, AUTH_SRC), AUTH_SRC, workdir, env))
+        # the seeding goes through the batch endpoint of app.py, even when asyncapp.py is measured
+        services.append(Service('transactions_service', server_command(args.server, transactions_port, TRANSACTIONS_SRC), TRANSACTIONS_SRC, workdir, transactions_env))
+        services[0].wait_ready(f'{auth_url}/swagger.json')
+        services[1].wait_ready(f'{transactions_url}/transactions/')
+
+        workload = Workload(auth_url, transactions_url, users,
+                            customers=[f'customer_{i}' for i in range(args.customers)],
+                            vendors=[f'vendor_{i}' for i in range(args.vendors)])
+        with requests.Session() as http:
+            workload.log_in_all(http)
+            seeding_started = time.perf_counter()
+            workload.seed_transactions(http, args.transactions, rng)
+            seeding_seconds = time.perf_counter() - seeding_started
+        if args.server == 'asyncio':
+            services.pop().stop()
+            services.append(Service('transactions_service_asyncio', asyncio_command(transactions_port), TRANSACTIONS_SRC, workdir, transactions_env))
+            services[1].wait_ready(f'{transactions_url}/transactions/')
+        if not workload.ids:
+            workload.create(requests, rng) # get, update and result need at least one id
+
+        latencies, errors, seconds = drive(workload, mix, args.concurrency, args.warmup, args.duration, args.seed)
+        endpoints, total = summarize(latencies, errors, seconds)
+        report = {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {
+                'server': args.server, 'users': args.users, 'transactions': args.transactions, 'customers': args.customers,
+                'vendors': args.vendors, 'concurrency': args.concurrency, 'warmup_seconds': args.warmup,
+                'duration_seconds': args.duration, 'seed': args.seed, 'mix': mix, 'env': env
+            },
+            'seeding_seconds': round(seeding_seconds, 3),
+            'endpoints': endpoints,
+            'total': total
+        }
+    finally:
+        for service in reversed(services):
+            service.stop()
+        if args.keep:
+            print(f"Service folder kept: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(report, json.load(f), args.tolerance)
+    write_report(report, args.output)
+    print_summary(report)
+    return 1 if regressions(report) else 0
+
+def write_report(report, path):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+def compare_files(args):
+    with open(args.report) as f:
+        report = json.load(f)
+    with open(args.baseline) as f:
+        report['comparison'] = compare(report, json.load(f), args.tolerance)
+    json.dump(report['comparison'], sys.stdout, indent=2)
+    print()
+    print_summary(report)
+    return 1 if regressions(report) else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and latency benchmark of the authentication and transaction services')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='start both services, seed them and measure a request mix')
+    run_parser.add_argument('--users', type=int, default=50, help='users seeded in the auth service (default 50)')
+    run_parser.add_argument('--transactions', type=int, default=10000, help='transactions seeded before the run (default 10000)')
+    run_parser.add_argument('--customers', type=int, default=500, help='distinct customers of the transactions (default 500)')
+    run_parser.add_argument('--vendors', type=int, default=50, help='distinct vendors of the transactions (default 50)')
+    run_parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients (default 16)')
+    run_parser.add_argument('--warmup', type=float, default=5, help='seconds of requests before measuring (default 5)')
+    run_parser.add_argument('--duration', type=float, default=30, help='measured seconds (default 30)')
+    run_parser.add_argument('--mix', default=DEFAULT_MIX, help=f'relative weights of the operations (default {DEFAULT_MIX})')
+    run_parser.add_argument('--server', choices=('flask', 'asyncio', 'gunicorn'), default='flask',
+                            help='app.py on the Flask dev server, asyncapp.py for the transaction service, or both services on gunicorn (WEB_WORKERS, WEB_THREADS)')
+    run_parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='setting for both services, e.g. SHARD_COUNT=4 (repeatable)')
+    run_parser.add_argument('--seed', type=int, default=1, help='random seed of the data and the request mix (default 1)')
+    run_parser.add_argument('--output', help='file for the JSON report (default: stdout)')
+    run_parser.add_argument('--baseline', help='earlier JSON report to compare with')
+    run_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline (default 0.1 = 10%%)')
+    run_parser.add_argument('--keep', action='store_true', help='keep the folder with the databases and logs of the services')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved reports')
+    compare_parser.add_argument('report')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == 'run' else compare_files(args))
+
+
+if __name__ == '__main__':
+    main()
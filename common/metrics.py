@@ -0,0 +1,261 @@
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+
+# Metrics of both services in the Prometheus text format, served at GET /metrics: request counts and latency
+# histograms per route and status code, requests in flight, and the time spent in SQL statements, per statement
+# and per route.
+# Every process keeps its own numbers in memory. Settings come from environment variables:
+# SLOW_QUERY_MS   statements that take longer are logged with their duration and route (default 0: no slow-query log)
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+MAX_STATEMENT_SERIES = 500 # distinct statements with their own series, the rest is counted as 'other'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+def _format_number(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {} # label values -> value
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        """(name suffix, label values, extra labels, value) of every series"""
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield '', labels, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labels, labels, extra)} {_format_number(value)}')
+        return lines
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Counter):
+    """A gauge changed with inc/dec, or read at every scrape from function(): a number, or {(label values): number}"""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        try:
+            value = self.function()
+        except Exception:
+            return # a component that cannot answer must not break the whole scrape
+        for labels, number in (value.items() if isinstance(value, dict) else [((), value)]):
+            yield '', labels, (), number
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value) # the first bucket whose upper bound is >= value
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0] # per bucket and +Inf, then the sum
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._values.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                yield '_bucket', labels, (('le', _format_number(bound)),), cumulative
+            yield '_count', labels, (), cumulative
+            yield '_sum', labels, (), series[-1]
+
+def render():
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
+
+
+requests_total = Counter('http_requests_total', 'Requests by route, method and status code', ('route', 'method', 'status'))
+request_duration = Histogram('http_request_duration_seconds',
+                             'Time until the handler returned its response (streamed bodies are sent later), by route, method and status code',
+                             ('route', 'method', 'status'))
+requests_in_flight = Gauge('http_requests_in_flight', 'Requests being handled, by route', ('route',))
+statement_duration = Histogram('sql_statement_duration_seconds', 'Execution time of SQL statements, by statement', ('statement',), STATEMENT_BUCKETS)
+route_statement_seconds = Counter('sql_route_seconds_total', 'Time spent in SQL statements, by the route that ran them (background: no request)', ('route',))
+route_statements = Counter('sql_route_statements_total', 'SQL statements, by the route that ran them', ('route',))
+slow_statements = Counter('sql_slow_statements_total', 'SQL statements slower than SLOW_QUERY_MS, by route', ('route',))
+
+# Route of the request being handled by this thread or task, to attribute SQL time to it
+current_route = ContextVar('current_route', default='background')
+
+_slow_log = logging.getLogger('slow_query')
+_whitespace = re.compile(r'\s+')
+_parameter_list = re.compile(r'\?(?:\s*,\s*\?)+')
+_row_list = re.compile(r'\(\?(?:\.\.\.)?\)(?:\s*,\s*\(\?(?:\.\.\.)?\))+')
+_statement_labels = {} # statement -> label
+_statement_series = set()
+
+def statement_label(statement):
+    """
+    The statement with its whitespace collapsed and its lists of parameters or rows shortened,
+    so IN lists and multi-row inserts of any length share one series
+    """
+    label = _statement_labels.get(statement)
+    if label is None:
+        label = _row_list.sub('(?...)...', _parameter_list.sub('?...', _whitespace.sub(' ', statement).strip()))
+        if label not in _statement_series:
+            if len(_statement_series) >= MAX_STATEMENT_SERIES:
+                label = 'other'
+            else:
+                _statement_series.add(label)
+        if len(_statement_labels) < 10 * MAX_STATEMENT_SERIES:
+            _statement_labels[statement] = label
+    return label
+
+def record_statement(statement, seconds):
+    route = current_route.get()
+    statement_duration.observe(seconds, statement_label(statement))
+    route_statement_seconds.inc(route, amount=seconds)
+    route_statements.inc(route)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        slow_statements.inc(route)
+        _slow_log.warning("Slow SQL statement, %.1f ms", seconds * 1000,
+                          extra={'event': {'statement': statement[:2000], 'duration_ms': round(seconds * 1000, 3), 'route': route}})
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that times its statements: sqlite3.connect(path, factory=metrics.TimedConnection)"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_statement(sql, time.perf_counter() - started)
+
+def instrument_engine(engine):
+    """Time every statement of a SQLAlchemy engine (of an async engine: its sync_engine)"""
+    from sqlalchemy import event
+
+    # start times as a stack per connection: a failed statement gets no after event, handle_error drops its start time
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        record_statement(statement, time.perf_counter() - conn.info['statement_started'].pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def failed_statement(exception_context):
+        started = exception_context.connection.info.get('statement_started') if exception_context.connection is not None else None
+        if started:
+            started.pop()
+
+def install(app):
+    """Count and time the requests of a Flask app, and serve GET /metrics"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request():
+        g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = current_route.set(g.metrics_route)
+        requests_in_flight.inc(g.metrics_route)
+
+    @app.after_request
+    def count_request(response):
+        if 'metrics_started' in g:
+            status = str(response.status_code)
+            requests_total.inc(g.metrics_route, request.method, status)
+            request_duration.observe(time.perf_counter() - g.metrics_started, g.metrics_route, request.method, status)
+        return response
+
+    @app.teardown_request
+    def end_request(exception):
+        # also runs when after_request did not, so the gauge cannot drift
+        if 'metrics_token' in g:
+            requests_in_flight.dec(g.metrics_route)
+            current_route.reset(g.pop('metrics_token'))
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+def aiohttp_middleware():
+    """The same request metrics as a middleware of an aiohttp application (the asyncio mode, asyncapp.py)"""
+    from aiohttp import web
+
+    @web.middleware
+    async def count_request(request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        started = time.perf_counter()
+        token = current_route.set(route)
+        requests_in_flight.inc(route)
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            requests_in_flight.dec(route)
+            current_route.reset(token)
+            requests_total.inc(route, request.method, str(status))
+            request_duration.observe(time.perf_counter() - started, route, request.method, str(status))
+
+    return count_request
+
+async def aiohttp_handler(request):
+    """GET /metrics of the aiohttp application"""
+    from aiohttp import web
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
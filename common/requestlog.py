@@ -0,0 +1,188 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from flask import g, request
+
+# Request/response logging of both services: structured JSON lines, written by a background thread through a
+# QueueHandler, so request threads only put a record on a queue. Settings come from environment variables:
+# REQUEST_LOG_BODY_LIMIT     bytes of request/response bodies kept (default 1000, 0 logs no bodies)
+# REQUEST_LOG_SAMPLING       per-route sampling rates, e.g. "/transactions/=0.01,/results/=0.1" (default: log everything)
+# REQUEST_LOG_METADATA_ONLY  routes logged without headers and bodies, e.g. "/transactions/,/results/"
+
+BODY_LIMIT = int(os.environ.get('REQUEST_LOG_BODY_LIMIT', 1000))
+LOGGABLE_TYPES = ("text/", "application/json", "application/xml") # filter for these types of bodies, to avoid large blobs of text
+REDACTED_HEADERS = {'authorization', 'cookie', 'set-cookie'} # lower case, header names are case-insensitive
+REDACTED_FIELDS = {'password', 'token'} # fields of JSON bodies, at any depth, e.g. of /auth/login and its answer
+_REDACTED_KEYS = tuple(f'"{field}"'.encode('ascii') for field in REDACTED_FIELDS)
+
+def _parse_routes(value, convert):
+    routes = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route, _, setting = item.partition('=')
+        routes[route.strip()] = convert(setting.strip())
+    return routes
+
+SAMPLING = _parse_routes(os.environ.get('REQUEST_LOG_SAMPLING', ''), float)
+METADATA_ONLY = set(_parse_routes(os.environ.get('REQUEST_LOG_METADATA_ONLY', ''), str))
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; the 'event' dict of a record is merged into it"""
+
+    def format(self, record):
+        line = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage()
+        }
+        line.update(getattr(record, 'event', {}))
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+_queue_handler = None
+_file_handler = None
+
+def configure_logging(filename, max_bytes=1000000, backup_count=3, level=logging.DEBUG):
+    """Root logger -> QueueHandler -> (listener thread) -> RotatingFileHandler with JSON lines"""
+    global _queue_handler, _file_handler
+    _file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    _file_handler.setFormatter(JsonFormatter())
+    _queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler) # to disable console logging
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _ensure_listener()
+
+def _ensure_listener():
+    # The listener thread does not survive a fork, so every process starts its own (with a fresh queue)
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid() or _queue_handler is None:
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            _queue_handler.queue = queue.Queue(-1)
+            _listener = logging.handlers.QueueListener(_queue_handler.queue, _file_handler, respect_handler_level=True)
+            _listener.start()
+            _listener_pid = os.getpid()
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {key: '<redacted>' if key in REDACTED_FIELDS else _redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+def _body(data, content_type):
+    """Body bytes as text, cut to BODY_LIMIT before decoding so large bodies are never copied whole"""
+    if BODY_LIMIT <= 0 or not data:
+        return None
+    if not any(content_type.startswith(t) for t in LOGGABLE_TYPES):
+        return f"<{content_type} not logged>"
+    if content_type.startswith('application/json') and any(key in data for key in _REDACTED_KEYS):
+        # Only bodies that may hold a password or token are parsed, and logged with those fields redacted
+        try:
+            data = json.dumps(_redact(json.loads(data))).encode('utf-8')
+        except ValueError:
+            return "<body with redacted fields not logged>"
+    if len(data) > BODY_LIMIT:
+        return data[:BODY_LIMIT].decode('utf-8', errors='replace') + "... [shortened]"
+    return data.decode('utf-8', errors='replace')
+
+def _headers(headers):
+    return {key: ('<redacted>' if key.lower() in REDACTED_HEADERS else value) for key, value in headers.items()}
+
+def install(app):
+    """Register the request/response logging hooks on a Flask app"""
+
+    @app.before_request
+    def log_request_info():
+        _ensure_listener()
+        g.log_started = time.perf_counter()
+        route = request.url_rule.rule if request.url_rule else None
+        g.log_route = route
+        g.log_sampled = random.random() < SAMPLING.get(route, 1.0)
+        g.log_details = route not in METADATA_ONLY
+        if g.log_sampled and g.log_details:
+            # read the request body now, the view may consume the stream
+            g.log_request_body = _body(request.get_data(), request.content_type or "")
+
+    @app.after_request
+    def log_response_info(response):
+        if not g.get('log_sampled', True) and response.status_code < 500:
+            return response # errors are always logged
+
+        event = {
+            'method': request.method,
+            'path': request.path,
+            'route': g.get('log_route'),
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.get('log_started', time.perf_counter())) * 1000, 3),
+            'source': request.remote_addr,
+            'query': dict(request.args) if request.args else None,
+            'request_bytes': request.content_length,
+            'response_bytes': None if response.is_streamed else response.calculate_content_length() # would buffer a stream
+        }
+        if g.get('log_details', True):
+            event['request_headers'] = _headers(request.headers)
+            event['request_body'] = g.get('log_request_body')
+            event['response_headers'] = _headers(response.headers)
+            if response.is_streamed or response.direct_passthrough:
+                event['response_body'] = "<streamed, not logged>"
+            else:
+                event['response_body'] = _body(response.get_data(), response.headers.get("Content-Type", ""))
+        app.logger.debug("%s %s %s", request.method, request.path, response.status_code, extra={'event': event})
+        return response
+
+def aiohttp_middleware():
+    """The same request/response logging as a middleware of an aiohttp application (the asyncio mode, asyncapp.py)"""
+    from aiohttp import web
+    logger = logging.getLogger('asyncapp')
+
+    @web.middleware
+    async def log_request_info(request, handler):
+        _ensure_listener()
+        started = time.perf_counter()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else None
+        sampled = random.random() < SAMPLING.get(route, 1.0)
+        details = route not in METADATA_ONLY
+        request_body = _body(await request.read(), request.content_type or "") if sampled and details and request.can_read_body else None
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            response = e # 404/405 of the router, logged like any other answer
+        if sampled or response.status >= 500:
+            event = {
+                'method': request.method,
+                'path': request.path,
+                'route': route,
+                'status': response.status,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+                'source': request.remote,
+                'query': dict(request.query) if request.query else None,
+                'request_bytes': request.content_length,
+                'response_bytes': response.content_length
+            }
+            if details:
+                event['request_headers'] = _headers(request.headers)
+                event['request_body'] = request_body
+                event['response_headers'] = _headers(response.headers)
+                body = getattr(response, 'body', None)
+                event['response_body'] = _body(body, response.content_type or "") if isinstance(body, bytes) else None
+            logger.debug("%s %s %s", request.method, request.path, response.status, extra={'event': event})
+        if isinstance(response, web.HTTPException):
+            raise response
+        return response
+
+    return log_request_info
@@ -0,0 +1,19 @@
+import sys
+
+# Helpers of the gunicorn.conf.py files of both services.
+
+def worker_count(default):
+    """
+    The number of worker processes gunicorn will start: -w/--workers of the command line, else of GUNICORN_CMD_ARGS,
+    else default (the workers setting of the config file). gunicorn applies those options after it has read the
+    config file, and imports the app (preload_app) before any server hook runs, so the config file works the final
+    number out itself, with gunicorn's own parser, for the settings that depend on it.
+    """
+    from gunicorn.config import Config
+    cfg = Config()
+    parser = cfg.parser()
+    for args in (sys.argv[1:], cfg.get_cmd_args_from_env()): # the command line wins
+        workers = parser.parse_args(args).workers
+        if workers is not None:
+            return workers
+    return default
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+# Signed tokens look like "<role>:<payload>.<signature>", so the role prefix reads the same as in random tokens.
+# The payload is base64url JSON with the username (sub), role, expiry (exp, unix time) and a unique id (jti);
+# the signature is a base64url HMAC-SHA256 over "<role>:<payload>".
+# The auth service signs and verifies tokens, the transaction service verifies them without asking the auth service.
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+def _signature(secret, message):
+    """base64url signature of the message bytes, as bytes"""
+    return base64.urlsafe_b64encode(hmac.new(secret, message, hashlib.sha256).digest()).rstrip(b'=')
+
+def sign_token(secret, username, role, lifetime):
+    """New signed token for username with role, valid for lifetime seconds"""
+    claims = {'sub': username, 'role': role, 'exp': int(time.time() + lifetime), 'jti': os.urandom(8).hex()}
+    message = f"{role}:{_b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))}"
+    return f"{message}.{_signature(secret, message.encode('utf-8')).decode('ascii')}"
+
+def read_token(secret, token):
+    """
+    Claims of a correctly signed, unexpired token, or None.
+    Only a constant-time HMAC comparison and a JSON decode, no shared state.
+    """
+    # The token is whatever the client sent: compared as bytes, so any character only makes it invalid
+    try:
+        message, _, signature = token.encode('utf-8').rpartition(b'.')
+    except (AttributeError, UnicodeError):
+        return None
+    if not message or not hmac.compare_digest(_signature(secret, message), signature):
+        return None
+    role, _, payload = message.partition(b':')
+    try:
+        role, claims = role.decode('utf-8'), json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get('role') != role:
+        return None
+    if not isinstance(claims.get('sub'), str) or not isinstance(claims.get('jti'), str):
+        return None
+    exp = claims.get('exp')
+    if isinstance(exp, bool) or not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    return claims
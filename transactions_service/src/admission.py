@@ -0,0 +1,131 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from common import metrics
+
+# Admission control: requests are turned away before any database work, so a flood from one caller cannot make
+# every other request wait behind the SQLite writer.
+# - overload: at most max_in_flight requests (and max_writes_in_flight writing requests) are handled at once, the
+#   rest is answered with 503 and Retry-After
+# - rate limits: token buckets per user (the Username header) and per role (all users of the role together);
+#   a request over either limit is answered with 429 and Retry-After, the seconds until its bucket has a token again
+# The limits are kept per process.
+
+rejections = metrics.Counter('admission_rejected_total', 'Requests shed by admission control, by reason (overload, writes, user, role)', ('reason',))
+
+def parse_limit(value):
+    """'<requests per second>/<burst>' (or just the rate, then the burst is one second of it) -> (rate, burst), None when off"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1.0)
+    return (rate, burst) if rate > 0 else None
+
+def parse_role_limits(value):
+    """'agent=20/40,administrator=100' -> {'agent': (20.0, 40.0), 'administrator': (100.0, 100.0)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        role, _, limit = item.partition('=')
+        limit = parse_limit(limit)
+        if limit:
+            limits[role.strip()] = limit
+    return limits
+
+class TokenBucket:
+    """Holds up to burst tokens, refilled at rate tokens per second; every admitted request takes one"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, now):
+        """Refill, then return 0 when a token is there, otherwise the seconds until there is one"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    """
+    enter()/leave() around every admitted request count the requests in flight, take() charges the rate limits.
+    Both return None when the request may go on, otherwise (status code, Retry-After seconds, error message).
+    """
+
+    def __init__(self, max_in_flight=0, max_writes_in_flight=0, user_limit=None, role_limits=None, max_users=100000, retry_after=1):
+        self.max_in_flight = max_in_flight # 0: no limit
+        self.max_writes_in_flight = max_writes_in_flight
+        self.user_limit = user_limit # (rate, burst) or None
+        self.role_limits = role_limits or {}
+        self.max_users = max_users
+        self.retry_after = retry_after
+        now = time.monotonic()
+        self._role_buckets = {role: TokenBucket(rate, burst, now) for role, (rate, burst) in self.role_limits.items()}
+        self._user_buckets = OrderedDict() # username -> TokenBucket, least recently used first
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._writes_in_flight = 0
+        self._stats = {'admitted': 0, 'rejected_overload': 0, 'rejected_writes': 0, 'rejected_user': 0, 'rejected_role': 0}
+
+    def _reject(self, reason, status_code, retry_after, message):
+        self._stats[f'rejected_{reason}'] += 1
+        rejections.inc(reason)
+        return status_code, retry_after, message
+
+    def enter(self, write=False):
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                return self._reject('overload', 503, self.retry_after, 'Service overloaded, retry later')
+            if write and self.max_writes_in_flight and self._writes_in_flight >= self.max_writes_in_flight:
+                return self._reject('writes', 503, self.retry_after, 'Too many writes in progress, retry later')
+            self._in_flight += 1
+            self._writes_in_flight += write
+        return None
+
+    def leave(self, write=False):
+        with self._lock:
+            self._in_flight -= 1
+            self._writes_in_flight -= write
+
+    def _user_bucket(self, username, now):
+        bucket = self._user_buckets.get(username)
+        if bucket is None:
+            bucket = self._user_buckets[username] = TokenBucket(*self.user_limit, now)
+            if len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(username)
+        return bucket
+
+    def take(self, username, role):
+        """One token from the bucket of the user and from the one of the role, or from neither when one is empty"""
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            if self.user_limit and username:
+                buckets.append(('user', self._user_bucket(username, now)))
+            if role in self._role_buckets:
+                buckets.append(('role', self._role_buckets[role]))
+            wait, reason = max(((bucket.wait(now), reason) for reason, bucket in buckets), default=(0.0, None))
+            if wait > 0:
+                return self._reject(reason, 429, max(1, math.ceil(wait)), f'Rate limit of this {reason} exceeded, retry later')
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+            self._stats['admitted'] += 1
+        return None
+
+    def in_flight(self):
+        return self._in_flight, self._writes_in_flight
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, in_flight=self._in_flight, writes_in_flight=self._writes_in_flight, users=len(self._user_buckets))
+        stats.update(max_in_flight=self.max_in_flight,
+                     max_writes_in_flight=self.max_writes_in_flight,
+                     user_limit=self.user_limit,
+                     role_limits=self.role_limits)
+        return stats
@@ -1,74 +1,35 @@
-from flask import Flask, request
-from flask_restx import Api, Resource, fields
+from flask import Flask, Response, request, g
+from flask_restx import Api, Resource, fields, reqparse, inputs
 from sqlalchemy.orm import Session
-from datetime import datetime
-import random
+from datetime import datetime, timedelta
 import requests
-from logging.config import dictConfig
+from common import requestlog
+from common import metrics
 
-from setupdb import Base, engine, Session
+from setupdb import engines, Sessions, WriteSessions
 import dbmodels
+import queries
+from queries import timestamp_arg, status_arg
+import dbwrites
+import export
+import rollups
+import shards
+import config
+from authclient import ALLOWED_ROLES, AuthClient, AuthServiceUnavailable
+from common.signedtokens import read_token
+from services import (response_cache, results_committed, statuses_committed, feature_store, pipelines, score_inline,
+                      transactions_committed, writers, combined_stats, archive_store, admission_control, WRITE_METHODS, change_feed, scoring_owner)
+from changefeed import InvalidCursor
+import json
+import time
+from concurrent.futures import TimeoutError as FuturesTimeout
 
 # From Flask documentation: "If possible, configure logging before creating the application object."
-dictConfig({
-    'version': 1,
-    'disable_existing_loggers': True,  # to disable console logging
-    'formatters': {
-        'default': {
-            'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-        }
-    },
-    'handlers': {
-        'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'filename': 'transaction_logging.log',
-            'maxBytes': 1000000,
-            'backupCount': 3,
-            'formatter': 'default',
-        }
-    },
-    'root': {
-        'level': 'DEBUG',
-        'handlers': ['file']
-    }
-})
+requestlog.configure_logging('transaction_logging.log')
 
 app = Flask(__name__)
-
-@app.before_request
-def log_request_info():
-    app.logger.debug("REQUEST --- Source: %s, Destination: %s, Headers: %s, Metadata: %s, Body: %s",
-        request.remote_addr,
-        request.url,
-        dict(request.headers),
-        dict(request.args) if request.args else None,
-        request.get_data(as_text=True)
-    )
-
-@app.after_request
-def log_response_info(response):
-    if response.direct_passthrough:
-        response.direct_passthrough = False
-
-    content_type = response.headers.get("Content-Type", "")
-    loggable_types = ["text/", "application/json", "application/xml"] # filter for these types of responses, to avoid large blobs of text
-
-    if not any(content_type.startswith(t) for t in loggable_types):
-        body = f"<{content_type} not logged>"
-    else:
-        try:
-            body = response.get_data(as_text=True)
-            # There are some large bodies of text during logging, we can make them shorter by uncommenting the following 2 lines:
-            # if len(body) > 1000:
-            #     body = body[:1000] + "... [shortened]"
-        except Exception:
-            body = "<body is unreadable>"
-    app.logger.debug("RESPONSE --- Source: %s, Destination: %s, Headers: %s, Metadata: %s, Body: %s",
-                     request.url,
-                     request.remote_addr,
-                     dict(response.headers),
-                     None, body)
-    return response
+requestlog.install(app)
+metrics.install(app)
 
 api = Api(app,
           title="Transaction Service",
@@ -87,19 +48,66 @@ api = Api(app,
               }
           })
 
-Base.metadata.create_all(bind=engine)
+# The tables of the shards are created at deploy time by "flask --app app init-db" (python app.py does it before
+# serving), not whenever a worker process imports the app
+@app.cli.command('init-db')
+def init_db():
+    """Create the missing tables and indexes of every shard"""
+    shards.init_shards()
+
+# Get DB session function: one session per request and shard, opened on first use.
+# Handlers that write ask for a write session, which takes the SQLite write lock when its transaction begins.
+def get_db(shard=0, write=False):
+    dbs = g.setdefault('dbs', {})
+    if (shard, write) not in dbs:
+        dbs[(shard, write)] = (WriteSessions if write else Sessions)[shard]()
+    return dbs[(shard, write)]
+
+@app.teardown_request
+def close_db(exception):
+    """Give the request's connections back to the pool, rolling back whatever was not committed"""
+    for db in g.pop('dbs', {}).values():
+        if exception is not None:
+            db.rollback()
+        db.close()
+
+# Work that fans out over the shards runs in other threads, with sessions of its own
+def read_shard(shard, fn):
+    db = Sessions[shard]()
+    try:
+        return fn(db)
+    finally:
+        db.close()
 
-# Get DB session function
-def get_db():
-    db = Session()
+def write_shard(shard, fn):
+    """Run fn(db) in one write transaction of the shard and commit it"""
+    db = WriteSessions[shard]()
     try:
-        return db
+        result = fn(db)
+        db.commit()
+        return result
     finally:
         db.close()
 
+def list_page(stmt, kind, shard_list, args):
+    """
+    One page of a list endpoint: the first limit + 1 rows of every shard, from its tables and its archive in one
+    read transaction, merged by id; returns (rows, next_after_id)
+    """
+    limit = args['limit']
+
+    def read(db):
+        return shards.merge_sorted([[row.to_dict() for row in db.scalars(stmt)], archive_store.page(db, kind, **args)], limit + 1)
+
+    pages = shards.fan_out(lambda shard: read_shard(shard, read), shard_list)
+    return queries.split_page(shards.merge_sorted(pages, limit + 1), limit)
+
 # Namespaces
 transaction_ns = api.namespace('transactions', description='Transaction Services')
 result_ns = api.namespace('results', description='Results ML Service')
+system_ns = api.namespace('system', description='Service internals and statistics')
+analytics_ns = api.namespace('analytics', description='Totals per customer, vendor and time bucket')
+feed_ns = api.namespace('feed', description='Change feed of new transactions, status changes and fraud results')
 
 transaction_m = api.model('Transaction', 
                     {
@@ -118,10 +126,48 @@ transaction_r = api.model('TransactionResponse',
                     'amount': fields.String(description = 'Transaction Amount')
                     })
 
+batch_item_r = api.model('BatchItemResponse', {
+    'index': fields.Integer(description = 'Position of the transaction in the submitted batch'),
+    'id': fields.Integer(description = 'Transaction ID, if it was created'),
+    'error': fields.String(description = 'Validation error, if it was rejected')
+})
+
+batch_r = api.model('BatchResponse', {
+    'created': fields.Integer(description = 'Number of created transactions'),
+    'failed': fields.Integer(description = 'Number of rejected transactions'),
+    'items': fields.List(fields.Nested(batch_item_r))
+})
+
 update_m = api.model('UpdateTransaction', {
     'status': fields.String(required=True, description = 'New Transaction Status')
 })
 
+status_filter_m = api.model('StatusUpdateFilter', {
+    'customer': fields.String(description = 'Customer Identifier'),
+    'vendor_id': fields.String(description = 'Vendor Identifier'),
+    'status': fields.String(description = 'Current Transaction Status'),
+    'since': fields.String(description = 'Only transactions with timestamp >= since (ISO 8601)'),
+    'until': fields.String(description = 'Only transactions with timestamp < until (ISO 8601)')
+})
+
+bulk_update_m = api.model('BulkUpdateTransactions', {
+    'status': fields.String(required=True, description = 'New Transaction Status'),
+    'ids': fields.List(fields.Integer, description = 'Transaction IDs to update (either ids or filter)'),
+    'filter': fields.Nested(status_filter_m, description = 'Update every transaction that matches (either ids or filter)'),
+    'from_status': fields.List(fields.String, description = 'Transition guard: only transactions currently in one of these statuses are updated, e.g. ["submitted"]')
+})
+
+bulk_update_item_r = api.model('BulkUpdateItemResponse', {
+    'id': fields.Integer(description = 'Transaction ID'),
+    'outcome': fields.String(description = 'updated, unchanged (already in the status), rejected (by the transition guard), archived (read-only) or not_found'),
+    'status': fields.String(description = 'Status of the transaction after the call')
+})
+
+bulk_update_r = api.model('BulkUpdateResponse', {
+    'updated': fields.Integer(description = 'Number of updated transactions'),
+    'items': fields.List(fields.Nested(bulk_update_item_r))
+})
+
 result_r = api.model('ResultResponse',{
                      'id': fields.Integer(description = 'Result ID'), 
                      'transaction_id':fields.Integer(description = 'Transaction ID'),
@@ -130,8 +176,165 @@ result_r = api.model('ResultResponse',{
                      'confidence': fields.Float(description = 'Prediction Confidence')
                     })
 
+# Query parameters of the paginated list endpoints
+page_parser = reqparse.RequestParser()
+page_parser.add_argument('limit', type=inputs.int_range(1, queries.PAGE_SIZE_MAX), default=queries.PAGE_SIZE_DEFAULT, location='args', help='Page size (max %d)' % queries.PAGE_SIZE_MAX)
+page_parser.add_argument('after_id', type=int, location='args', help='Cursor: return rows with an id greater than this (X-Next-After-Id of the previous page)')
+page_parser.add_argument('customer', type=str, location='args', help='Filter by customer identifier')
+page_parser.add_argument('vendor_id', type=str, location='args', help='Filter by vendor identifier')
+page_parser.add_argument('status', type=status_arg, location='args', help='Filter by transaction status')
+page_parser.add_argument('since', type=timestamp_arg, location='args', help='Only rows with timestamp >= since (ISO 8601)')
+page_parser.add_argument('until', type=timestamp_arg, location='args', help='Only rows with timestamp < until (ISO 8601)')
+
+result_page_parser = page_parser.copy()
+result_page_parser.add_argument('is_fraudulent', type=inputs.boolean, location='args', help='Filter by fraud prediction')
+
+bucket_parser = reqparse.RequestParser()
+bucket_parser.add_argument('since', type=timestamp_arg, location='args', help='Start of the first bucket (ISO 8601, default: 24 hours ago)')
+bucket_parser.add_argument('until', type=timestamp_arg, location='args', help='End of the last bucket (ISO 8601, default: now)')
+bucket_parser.add_argument('bucket', choices=('hour', 'day'), default='hour', location='args', help='Bucket size')
+
+# The exports take the same filters as the lists, without a page size
+def export_parser_from(parser):
+    export_parser = parser.copy().remove_argument('limit')
+    export_parser.add_argument('format', choices=tuple(export.FORMATS), default='ndjson', location='args', help='ndjson (one JSON object per line) or csv')
+    export_parser.add_argument('gzip', type=inputs.boolean, default=False, location='args', help='Compress the stream with gzip (Content-Encoding: gzip)')
+    return export_parser
+
+export_parser = export_parser_from(page_parser)
+result_export_parser = export_parser_from(result_page_parser)
+
+def page_headers(next_after_id):
+    """The cursor for the next page goes into a header, so the body stays a plain list"""
+    return {'X-Next-After-Id': str(next_after_id)} if next_after_id is not None else {}
+
+def export_response(stmt, columns, fmt, gzip, name, shard_list, filters):
+    """Streaming response of an export; rows are read and encoded while the response is sent"""
+    headers = {'Content-Disposition': f'attachment; filename={name}.{fmt}'}
+    if gzip:
+        headers['Content-Encoding'] = 'gzip'
+
+    def archived(conn):
+        return archive_store.export_chunks(conn, name, columns, config.EXPORT_CHUNK_SIZE, **filters)
+
+    streams = [export.read_rows(engines[shard], stmt, config.EXPORT_CHUNK_SIZE, archived=archived) for shard in shard_list]
+    if len(streams) == 1:
+        chunks = streams[0]
+    else:
+        # the shards are read in parallel and merged by id (the first column)
+        chunks = export.rechunk(shards.merged_stream(streams, key=lambda row: row[0]), config.EXPORT_CHUNK_SIZE)
+    return Response(export.stream_rows(chunks, columns, fmt=fmt, gzip=gzip), mimetype=export.FORMATS[fmt], headers=headers)
+
+def parse_status_update(data):
+    """Validate the body of PUT /transactions/status; returns (status, from_statuses, ids, filters, error)"""
+    if not isinstance(data, dict):
+        return None, None, None, None, 'Expected a JSON object'
+    try:
+        status = status_arg(data.get('status'))
+        from_statuses = data.get('from_status')
+        if from_statuses is not None and not isinstance(from_statuses, list):
+            raise ValueError("'from_status' must be a list of statuses")
+        from_statuses = [status_arg(value) for value in from_statuses or []]
+        ids, filters = data.get('ids'), data.get('filter')
+        if (ids is None) == (filters is None):
+            raise ValueError("Give either 'ids' or 'filter'")
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                raise ValueError("'ids' must be a list of transaction IDs")
+        else:
+            if not isinstance(filters, dict) or not filters:
+                raise ValueError("'filter' needs at least one of customer, vendor_id, status, since, until")
+            unknown = set(filters) - {'customer', 'vendor_id', 'status', 'since', 'until'}
+            if unknown:
+                raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+            filters = dict(filters)
+            # null would match every row (no condition), another type fails in the shard routing
+            for field in ('customer', 'vendor_id'):
+                if field in filters and (not isinstance(filters[field], str) or not filters[field]):
+                    raise ValueError(f"'{field}' must be a non-empty string")
+            if 'status' in filters:
+                filters['status'] = status_arg(filters['status'])
+            for field in ('since', 'until'):
+                if field in filters:
+                    filters[field] = timestamp_arg(filters[field])
+    except ValueError as e:
+        return None, None, None, None, str(e)
+    return status, from_statuses, ids, filters, None
+
+def parse_batch(request):
+    """Read the batch body as a JSON array or as NDJSON (one object per line); returns (items, error)"""
+    mimetype = request.mimetype
+    if mimetype in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        items = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                return None, f'Invalid JSON on line {number}'
+        return items, None
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return None, 'Expected a JSON array of transactions'
+    return items, None
+
+feed_event_r = api.model('FeedEvent', {
+    'type': fields.String(description = 'transaction (a new transaction), status (a status change: id and status) or result (a fraud result)'),
+    'data': fields.Raw(description = 'The transaction, status change or result'),
+    'cursor': fields.String(description = 'Cursor to continue after this change')
+})
+
+feed_r = api.model('FeedResponse', {
+    'events': fields.List(fields.Nested(feed_event_r), description = 'Changes in the order they were committed'),
+    'cursor': fields.String(description = 'Cursor to continue from')
+})
+
+def feed_timeout(value):
+    """Seconds a long-poll waits for the first change, at most FEED_POLL_TIMEOUT"""
+    return min(max(float(value), 0.0), config.FEED_POLL_TIMEOUT)
+
+feed_parser = reqparse.RequestParser()
+feed_parser.add_argument('cursor', type=str, location='args', help='Continue after this cursor (default: the Last-Event-ID header, else from now on; 0 replays all transactions)')
+feed_parser.add_argument('limit', type=inputs.int_range(1, queries.PAGE_SIZE_MAX), default=queries.PAGE_SIZE_DEFAULT, location='args', help='Changes per answer (max %d)' % queries.PAGE_SIZE_MAX)
+feed_parser.add_argument('timeout', type=feed_timeout, default=config.FEED_POLL_TIMEOUT, location='args', help='Seconds to wait for the first change (max %g)' % config.FEED_POLL_TIMEOUT)
+
+def event_stream(cursor, limit):
+    """Server-Sent Events: every change as an event named by its type, with its cursor as the event id"""
+    ends_at = time.monotonic() + config.FEED_STREAM_SECONDS
+    while time.monotonic() < ends_at:
+        events, cursor = change_feed.read(cursor, limit, min(config.FEED_HEARTBEAT_SECONDS, ends_at - time.monotonic()))
+        if not events:
+            yield ': keep-alive\n\n' # also tells the server when the client has gone
+        for event in events:
+            yield f"id: {event['cursor']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+pending_r = api.model('PendingResultResponse', {
+    'transaction_id': fields.Integer(description = 'Transaction ID'),
+    'status': fields.String(description = 'Always "pending": the fraud score has not been stored yet')
+})
+
 # Authentication middleware
+# AUTH_MODE=remote verifies tokens with the auth service; AUTH_MODE=header only checks the role prefix of the token.
+# With TOKEN_SECRET set, signed tokens of the auth service (TOKEN_MODE=signed) are verified locally instead, and
+# checked against the auth service's list of logged out tokens (AUTH_MODE=remote).
+auth_client = AuthClient(config.AUTH_SERVICE_URL,
+                         ttl=config.AUTH_CACHE_TTL,
+                         negative_ttl=config.AUTH_NEGATIVE_TTL,
+                         max_entries=config.AUTH_CACHE_SIZE,
+                         token_exp=config.TOKEN_EXP,
+                         timeout=config.AUTH_TIMEOUT,
+                         pool_size=config.AUTH_POOL_SIZE,
+                         revocation_refresh=config.TOKEN_REVOCATION_REFRESH) if config.AUTH_MODE == 'remote' else None
+
 def authenticate(request):
+    """(authorized, error message, role) of the request, checked once per request (admission control checks first)"""
+    if 'auth_result' not in g:
+        g.auth_result = verify_request(request)
+    return g.auth_result
+
+def verify_request(request):
     token = request.headers.get('Authorization')
     if not token:
         return False, "No token identified", None
@@ -140,20 +343,74 @@ def authenticate(request):
     if not username:
         return False, "No username provided", None
     
-    if token.startswith("administrator") or token.startswith("agent"):
-        role = token.split(':', 1)[0]
-        return True, "", role
-    else:
+    # Tokens issued by the auth service look like "<role>:<random string>"
+    role = token.split(':', 1)[0]
+    if role not in ALLOWED_ROLES:
         return False, "Invalid token format or unauthorized role", None
 
+    if config.TOKEN_SECRET:
+        # Signed tokens are verified locally; only the list of logged out ones comes from the auth service
+        claims = read_token(config.TOKEN_SECRET, token)
+        if claims is None or claims['sub'] != username:
+            return False, "Invalid or expired token", None
+        if auth_client is not None:
+            try:
+                if auth_client.is_revoked(claims['jti']):
+                    return False, "Invalid or expired token", None
+            except AuthServiceUnavailable:
+                return False, "Authentication service unavailable", None
+    elif auth_client is not None:
+        try:
+            if not auth_client.is_valid(username, token):
+                return False, "Invalid or expired token", None
+        except AuthServiceUnavailable:
+            return False, "Authentication service unavailable", None
+    return True, "", role
+
+
+# Admission control: shed load before the handler does any database work
+def rejected(status_code, retry_after, message):
+    return Response(json.dumps({'error': message}), status=status_code, mimetype='application/json', headers={'Retry-After': str(retry_after)})
+
+@app.before_request
+def check_admission():
+    if request.url_rule is None or request.url_rule.rule in config.ADMISSION_EXEMPT_ROUTES:
+        return None # 404s and the exempt routes (metrics, docs) are not limited
+    write = request.method in WRITE_METHODS
+    rejection = admission_control.enter(write)
+    if rejection:
+        return rejected(*rejection)
+    g.admission_write = write
+    # rate limits apply to verified users only, so nobody can use up another user's limit by sending their name;
+    # requests that fail authentication go on to the handler and get their 401 there
+    authorized, message, role = authenticate(request)
+    if authorized:
+        rejection = admission_control.take(request.headers.get('Username'), role)
+        if rejection:
+            return rejected(*rejection)
+    return None
+
+@app.teardown_request
+def leave_admission(exception):
+    if 'admission_write' in g:
+        admission_control.leave(g.pop('admission_write'))
+
+
+# Read-through cache of single-row lookups, holding the serialized JSON bodies
+def read_through(key, load):
+    """Answer a lookup from the response cache; load() returns (dict, status code) and only 200 answers are cached"""
+    if response_cache is not None:
+        body = response_cache.get(key)
+        if body is not None:
+            return Response(body, mimetype='application/json')
+    read_at = time.time() # before the query, so an invalidation committed meanwhile wins
+    data, status_code = load()
+    if status_code != 200 or response_cache is None:
+        return data, status_code
+    body = json.dumps(data).encode('utf-8')
+    response_cache.put(key, body, read_at)
+    return Response(body, mimetype='application/json')
 
-# Randomised ML prediction System
-def fraud_prediction_mock(transaction_id):
-    return {
-        'transaction_id': transaction_id,
-        'is_fraudulent': random.choice([True, False]),
-        'confidence': random.uniform(0.6, 0.99)
-    }
 
 @app.route('/')
 def home():
@@ -163,31 +420,24 @@ def home():
 @transaction_ns.route('/')
 class TransactionList(Resource):
     @api.doc('list_transactions', security=[{'apikey': []}, {'username': []}])
+    @api.expect(page_parser)
     @api.response(200, 'Success', [transaction_r])
+    @api.response(400, 'Invalid query parameters')
     @api.response(401, 'Unauthorized')
     def get(self):
-        """List existing transactions"""
+        """List existing transactions, one page at a time (keyset pagination on id)"""
         authorised, message, role = authenticate(request)
         if not authorised:
             return {'error': message}, 401
-        
-        db = get_db()
-        transactions = db.query(dbmodels.Transaction).all()
-        transactions_list = []
-        for t in transactions:
-            transactions_list.append({
-            'id': t.id,
-            'customer':t.customer,
-            'timestamp':t.timestamp.isoformat(), # normal datetime object is not JSON serializable, so we need ISO format
-            'status':t.status.value, # .value gets str representation
-            'vendor_id':t.vendor_id,
-            'amount':t.amount
-            })
-        return transactions_list, 200
+
+        args = page_parser.parse_args()
+        transactions, next_after_id = list_page(queries.transaction_page(**args), 'transactions', shards.shards_for(args['customer']), args)
+        return transactions, 200, page_headers(next_after_id)
         
     @api.doc('make_transaction', security=[{'apikey': []}, {'username': []}])
     @api.expect(transaction_m)
     @api.response(201, 'Successfull transaction', transaction_r)
+    @api.response(400, 'Invalid transaction')
     @api.response(401, 'Unauthorized')
     def post(self):
         """Make a transaction"""
@@ -195,39 +445,155 @@ class TransactionList(Resource):
         if not authorized:
             return {'error': message}, 401
         
-        data = request.json
-        db = get_db()
+        row, error = dbwrites.validate_transaction(request.get_json(silent=True))
+        if error:
+            return {'error': error}, 400
+
+        shard = shards.shard_of_customer(row['customer'])
+        if writers:
+            try:
+                return writers[shard].submit(row).result(timeout=config.GROUP_COMMIT_TIMEOUT), 201
+            except FuturesTimeout:
+                return {'error': 'Transaction was not committed in time, try again'}, 503
+
+        db = get_db(shard, write=True)
+
+        # transaction, result and rollups are committed together
+        response = dbwrites.insert_transactions_as_dicts(db, [row])[0]
+        results = score_inline([response])
+        dbwrites.insert_results(db, results, [response])
+        db.commit()
+        transactions_committed([response], results)
+        return response, 201
 
-        new_transaction = dbmodels.Transaction(
-            customer = data['customer'],
-            vendor_id = data['vendor_id'],
-            amount = data['amount'],
-            status = dbmodels.TransactionStatus.submitted
-        )
 
-        db.add(new_transaction)
-        db.commit()
-        db.refresh(new_transaction) # Session.refresh refreshes column-oriented attributes with the current value available in the current transaction
+@transaction_ns.route('/batch')
+class TransactionBatch(Resource):
+    @api.doc('make_transactions_batch', security=[{'apikey': []}, {'username': []}])
+    @api.expect([transaction_m])
+    @api.response(201, 'All transactions created', batch_r)
+    @api.response(207, 'Some transactions were rejected, the valid ones were created', batch_r)
+    @api.response(400, 'Invalid batch')
+    @api.response(401, 'Unauthorized')
+    @api.response(413, 'Batch too large')
+    def post(self):
+        """Make many transactions in one call: a JSON array, or NDJSON (Content-Type: application/x-ndjson)"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+
+        items, error = parse_batch(request)
+        if error:
+            return {'error': error}, 400
+        if len(items) > dbwrites.BATCH_SIZE_MAX:
+            return {'error': f'Batch too large, at most {dbwrites.BATCH_SIZE_MAX} transactions per call'}, 413
+
+        # Validate everything up front, so the database transaction only contains valid rows
+        rows, positions, outcome = [], [], []
+        for index, item in enumerate(items):
+            row, error = dbwrites.validate_transaction(item)
+            if error:
+                outcome.append({'index': index, 'error': error})
+            else:
+                outcome.append({'index': index})
+                rows.append(row)
+                positions.append(index)
+
+        if rows:
+            # One database transaction per shard, the shards are written in parallel
+            groups = shards.group_by_shard(range(len(rows)), lambda number: shards.shard_of_customer(rows[number]['customer']))
+
+            def insert(db, numbers):
+                transactions = dbwrites.insert_transactions_as_dicts(db, [rows[number] for number in numbers])
+                results = score_inline(transactions)
+                dbwrites.insert_results(db, results, transactions)
+                return transactions, results
+
+            written = shards.fan_out(lambda shard: write_shard(shard, lambda db: insert(db, groups[shard])), groups)
+            for numbers, (transactions, results) in zip(groups.values(), written):
+                transactions_committed(transactions, results)
+                for number, transaction in zip(numbers, transactions):
+                    outcome[positions[number]]['id'] = transaction['id']
+
+        if not rows:
+            status_code = 400
+        elif len(rows) < len(items):
+            status_code = 207
+        else:
+            status_code = 201
+        return {'created': len(rows), 'failed': len(items) - len(rows), 'items': outcome}, status_code
+
+
+@transaction_ns.route('/export')
+class TransactionExport(Resource):
+    @api.doc('export_transactions', security=[{'apikey': []}, {'username': []}])
+    @api.expect(export_parser)
+    @api.produces(list(export.FORMATS.values()))
+    @api.response(200, 'Stream of all matching transactions, ordered by id')
+    @api.response(400, 'Invalid query parameters')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Export all matching transactions as one NDJSON or CSV stream"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
 
-        prediction = fraud_prediction_mock(new_transaction.id)
+        args = export_parser.parse_args()
+        fmt, gzip = args.pop('format'), args.pop('gzip')
+        return export_response(queries.transaction_export(**args), queries.TRANSACTION_EXPORT_COLUMNS, fmt, gzip, 'transactions', shards.shards_for(args['customer']), args)
 
-        new_result = dbmodels.Result(
-            transaction_id = new_transaction.id,
-            is_fraudulent = prediction['is_fraudulent'],
-            confidence = prediction['confidence']
-        )
 
-        db.add(new_result)
-        db.commit()
+@transaction_ns.route('/status')
+class TransactionStatusUpdate(Resource):
+    @api.doc('update_transactions_status', security=[{'apikey': []}, {'username': []}])
+    @api.expect(bulk_update_m)
+    @api.response(200, 'Success', bulk_update_r)
+    @api.response(400, 'Invalid request')
+    @api.response(401, 'Unauthorized')
+    @api.response(413, 'Too many ids')
+    def put(self):
+        """Update the status of many transactions in one database transaction, by ids or by filter"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
 
-        return {
-        'id':new_transaction.id,
-        'customer':new_transaction.customer,
-        'timestamp':new_transaction.timestamp.isoformat(), 
-        'status':new_transaction.status.value, 
-        'vendor_id':new_transaction.vendor_id,
-        'amount':new_transaction.amount
-        }, 201
+        status, from_statuses, ids, filters, error = parse_status_update(request.get_json(silent=True))
+        if error:
+            return {'error': error}, 400
+        if ids is not None and len(ids) > dbwrites.STATUS_UPDATE_MAX:
+            return {'error': f'Too many ids, at most {dbwrites.STATUS_UPDATE_MAX} per call'}, 413
+
+        # One database transaction per shard, the shards are updated in parallel
+        if ids is not None:
+            groups = shards.group_by_shard(ids, shards.shard_of_id)
+            skipped = {i: ('not_found', None) for i in groups.pop(None, [])}
+
+            def update(db, shard_ids):
+                shard_updated, shard_skipped = dbwrites.update_status(db, shard_ids, status, from_statuses)
+                missing = [i for i, (outcome, _) in shard_skipped.items() if outcome == 'not_found']
+                for i, archived_status in archive_store.archived_statuses(db, missing).items():
+                    shard_skipped[i] = ('archived', dbmodels.TransactionStatus(archived_status)) # archived transactions are read-only
+                return shard_updated, shard_skipped
+
+            outcomes = shards.fan_out(lambda shard: write_shard(shard, lambda db: update(db, groups[shard])), groups)
+        else:
+            skipped = {}
+            outcomes = shards.fan_out(lambda shard: write_shard(shard, lambda db: (dbwrites.update_status_where(db, status, from_statuses, **filters), {})),
+                                      shards.shards_for(filters.get('customer')))
+        updated = []
+        for shard_updated, shard_skipped in outcomes:
+            updated += shard_updated
+            skipped.update(shard_skipped)
+        statuses_committed(updated, status)
+
+        items = [{'id': i, 'outcome': 'updated', 'status': status.value} for i in updated]
+        items += [{'id': i, 'outcome': outcome, 'status': current.value if current else None} for i, (outcome, current) in skipped.items()]
+        if ids is not None:
+            position = {transaction_id: number for number, transaction_id in enumerate(ids)}
+            items.sort(key=lambda item: position[item['id']]) # in the order of the request
+        else:
+            items.sort(key=lambda item: item['id'])
+        return {'updated': len(updated), 'items': items}, 200
 
 
 @transaction_ns.route('/<int:id>')
@@ -243,81 +609,93 @@ class TransactionsDetails(Resource):
         if not authorized:
             return {'error': message}, 401
         
-        db = get_db()
-        transaction = db.query(dbmodels.Transaction).filter_by(id=id).first() # Query WHERE id = id
-
-        if not transaction:
-            return {'error': 'Transaction not found'}, 404
-        
-        return {
-            'id':transaction.id,
-            'customer':transaction.customer,
-            'timestamp':transaction.timestamp.isoformat(),
-            'status':transaction.status.value,
-            'vendor_id':transaction.vendor_id,
-            'amount':transaction.amount
-            }, 200
+        def load():
+            shard = shards.shard_of_id(id)
+            if shard is None:
+                return {'error': 'Transaction not found'}, 404
+            db = get_db(shard)
+            transaction = db.query(dbmodels.Transaction).filter_by(id=id).first() # Query WHERE id = id
+
+            if not transaction:
+                archived = archive_store.transaction(db, id)
+                if archived is not None:
+                    return archived[0], 200
+                return {'error': 'Transaction not found'}, 404
+            return transaction.to_dict(), 200
+
+        return read_through(f'transaction:{id}', load)
     
     @api.doc('update_transaction', security=[{'apikey': []}, {'username': []}])
     @api.expect(update_m)
     @api.response(200, 'Success', transaction_r)
     @api.response(401, 'Unauthorized')
     @api.response(404, 'Transaction not found')
+    @api.response(409, 'Transaction is archived')
     def put(self, id):
         """Update status of transaction"""
         authorized, message, role = authenticate(request)
         if not authorized:
             return {'error': message}, 401
         
-        data = request.json
-        db = get_db()
-        transaction = db.query(dbmodels.Transaction).filter_by(id=id).first()
+        data = request.get_json(silent=True)
+        shard = shards.shard_of_id(id)
+        db = get_db(shard, write=True) if shard is not None else None
+        transaction = db.query(dbmodels.Transaction).filter_by(id=id).first() if db is not None else None
 
         if not transaction:
+            if db is not None and archive_store.transaction(db, id) is not None:
+                return {'error': 'Transaction is archived and can no longer be updated'}, 409
             return {'error': 'Transaction not found by this ID'}, 404
         
         # Update Transaction Status
         try:
             new_status = dbmodels.TransactionStatus(data['status'])
+            rollups.change_status(db, [dbmodels.Transaction.id == id], new_status)
             transaction.status = new_status
+            response = transaction.to_dict() # serialize before commit, a refresh after it would start another transaction
             db.commit()
-            db.refresh(transaction)
-        except ValueError:
+            statuses_committed([id], new_status)
+        except (ValueError, KeyError, TypeError):
             return {'error': 'Invalid Status code. Availabel codes: submitted, accepted, rejected'}, 400
         
-        return {
-            'id':transaction.id,
-            'customer':transaction.customer,
-            'timestamp':transaction.timestamp.isoformat(),
-            'status':transaction.status.value,
-            'vendor_id':transaction.vendor_id,
-            'amount':transaction.amount
-            }, 200
+        return response, 200
     
 
 @result_ns.route('/')
 class ResultList(Resource):
     @api.doc('list_results', security=[{'apikey': []}, {'username': []}])
+    @api.expect(result_page_parser)
     @api.response(200, 'Success', [result_r])
+    @api.response(400, 'Invalid query parameters')
     @api.response(401, 'Unauthorized')
     def get(self):
-        """Get all predictions"""
+        """Get predictions, one page at a time (keyset pagination on id)"""
         authorized, message, role = authenticate(request)
         if not authorized:
             return {'error':message}, 401
-        
-        db = get_db()
-        results = db.query(dbmodels.Result).all()
-        results_list = []
-        for r in results:
-            results_list.append({
-                'id':r.id,
-                'transaction_id':r.transaction_id,
-                'timestamp':r.timestamp.isoformat(),
-                'is_fraudulent':r.is_fraudulent,
-                'confidence':r.confidence
-            })
-        return results_list, 200
+
+        args = result_page_parser.parse_args()
+        results, next_after_id = list_page(queries.result_page(**args), 'results', shards.shards_for(args['customer']), args)
+        return results, 200, page_headers(next_after_id)
+
+
+@result_ns.route('/export')
+class ResultExport(Resource):
+    @api.doc('export_results', security=[{'apikey': []}, {'username': []}])
+    @api.expect(result_export_parser)
+    @api.produces(list(export.FORMATS.values()))
+    @api.response(200, 'Stream of all matching results with their transactions, ordered by result id')
+    @api.response(400, 'Invalid query parameters')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Export all matching results, joined with their transactions, as one NDJSON or CSV stream"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+
+        args = result_export_parser.parse_args()
+        fmt, gzip = args.pop('format'), args.pop('gzip')
+        return export_response(queries.result_export(**args), queries.RESULT_EXPORT_COLUMNS, fmt, gzip, 'results', shards.shards_for(args['customer']), args)
 
 
 @result_ns.route('/transaction/<int:transaction_id>')
@@ -325,6 +703,7 @@ class ResultList(Resource):
 class ResultByTransaction(Resource):
     @api.doc('get_result_by_transaction', security=[{'apikey': []}, {'username': []}])
     @api.response(200, 'Success', [result_r])
+    @api.response(202, 'Transaction is not scored yet', pending_r)
     @api.response(401, 'Unauthorized')
     @api.response(404, 'Result not found')
     def get(self, transaction_id):
@@ -333,20 +712,231 @@ class ResultByTransaction(Resource):
         if not authorized:
             return {'error': message}, 401
         
-        db = get_db()
-        result = db.query(dbmodels.Result).filter_by(transaction_id=transaction_id).first()
+        def load():
+            shard = shards.shard_of_id(transaction_id)
+            if shard is None:
+                return {'error': 'No result found for corresponding transaction'}, 404
+            db = get_db(shard)
+            result = db.query(dbmodels.Result).filter_by(transaction_id=transaction_id).first()
+
+            if not result:
+                # The scoring pipeline may not have reached this transaction yet
+                if db.query(dbmodels.Transaction.id).filter_by(id=transaction_id).first():
+                    return {'transaction_id': transaction_id, 'status': 'pending'}, 202
+                archived = archive_store.transaction(db, transaction_id)
+                if archived is not None and archived[1] is not None:
+                    return archived[1], 200
+                return {'error': 'No result found for corresponding transaction'}, 404
+            return result.to_dict(), 200
+
+        return read_through(f'result:{transaction_id}', load)
+
+
+
+@feed_ns.route('/')
+class FeedEvents(Resource):
+    @api.doc('read_change_feed', security=[{'apikey': []}, {'username': []}])
+    @api.expect(feed_parser)
+    @api.produces(['application/json', 'text/event-stream'])
+    @api.response(200, 'Changes after the cursor (long-poll), or an event stream with Accept: text/event-stream', feed_r)
+    @api.response(400, 'Invalid cursor or query parameters')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Changes after a cursor: new transactions, status changes and fraud results, in commit order"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
 
-        if not result:
-            return {'error': 'No result found for corresponding transaction'}, 404
-        
-        return {
-            'id':result.id,
-            'transaction_id':result.transaction_id,
-            'timestamp':result.timestamp.isoformat(),
-            'is_fraudulent':result.is_fraudulent,
-            'confidence':result.confidence,
-        }, 200
+        args = feed_parser.parse_args()
+        cursor = args['cursor'] or request.headers.get('Last-Event-ID')
+        try:
+            change_feed.parse(cursor)
+        except InvalidCursor as e:
+            return {'error': str(e)}, 400
+
+        # The stream outlives the request context: the request is not counted in flight while it is open
+        if request.accept_mimetypes.best == 'text/event-stream':
+            return Response(event_stream(cursor, args['limit']), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        events, cursor = change_feed.read(cursor, args['limit'], args['timeout'])
+        return {'events': events, 'cursor': cursor}, 200
+
+
+
+@analytics_ns.route('/customers/<string:customer>')
+@api.doc(params={'customer': 'Customer Identifier'})
+class CustomerAnalytics(Resource):
+    @api.doc('customer_analytics', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    @api.response(404, 'No transactions of this customer')
+    def get(self, customer):
+        """Totals, status counts and fraud rate of one customer"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        rollup = get_db(shards.shard_of_customer(customer)).get(dbmodels.CustomerRollup, customer)
+        if rollup is None:
+            return {'error': 'No transactions found for this customer'}, 404
+        return rollup.to_dict(), 200
+
+
+@analytics_ns.route('/vendors/<string:vendor_id>')
+@api.doc(params={'vendor_id': 'Vendor Identifier'})
+class VendorAnalytics(Resource):
+    @api.doc('vendor_analytics', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    @api.response(404, 'No transactions of this vendor')
+    def get(self, vendor_id):
+        """Totals, status counts and fraud rate of one vendor"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        # a vendor has transactions in every shard
+        rollup = rollups.combine(shards.fan_out(lambda shard: read_shard(shard, lambda db: db.get(dbmodels.VendorRollup, vendor_id))))
+        if rollup is None:
+            return {'error': 'No transactions found for this vendor'}, 404
+        return rollup.to_dict(), 200
+
+
+@analytics_ns.route('/volume')
+class VolumeAnalytics(Resource):
+    @api.doc('volume_analytics', security=[{'apikey': []}, {'username': []}])
+    @api.expect(bucket_parser)
+    @api.response(200, 'Success')
+    @api.response(400, 'Invalid query parameters')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Transaction volume and fraud rate per hour or per day (UTC); buckets without transactions are left out"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        args = bucket_parser.parse_args()
+        until = args['until'] or datetime.utcnow()
+        since = args['since'] or until - timedelta(hours=24)
+        shard_buckets = shards.fan_out(lambda shard: read_shard(shard, lambda db: rollups.buckets(db, since, until, args['bucket'])))
+        return rollups.bucket_dicts(shard_buckets, args['bucket']), 200
+
+
+
+@system_ns.route('/writer')
+class WriterStats(Resource):
+    @api.doc('group_commit_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Group commit statistics: batch sizes and wait times"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        if not writers:
+            return {'enabled': False}, 200
+        return dict(combined_stats(writers), enabled=True), 200
+
+
+
+@system_ns.route('/scoring')
+class ScoringStats(Resource):
+    @api.doc('scoring_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Fraud scoring pipeline statistics: queue depth and scored batches"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        stats = combined_stats(pipelines) if pipelines else {}
+        stats.update(mode=config.SCORING_MODE, scorer=config.SCORER)
+        if scoring_owner is not None:
+            stats['owner'] = scoring_owner.stats()
+        if feature_store is not None:
+            stats['feature_store'] = feature_store.stats()
+        return stats, 200
+
+
+
+@system_ns.route('/auth')
+class AuthStats(Resource):
+    @api.doc('auth_cache_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Token verification cache statistics"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        if auth_client is None:
+            return {'mode': config.AUTH_MODE}, 200
+        return dict(auth_client.stats(), mode=config.AUTH_MODE), 200
+
+
+
+@system_ns.route('/cache')
+class CacheStats(Resource):
+    @api.doc('response_cache_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Response cache statistics: hits, misses, evictions and invalidations"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        if response_cache is None:
+            return {'backend': 'off'}, 200
+        return response_cache.stats(), 200
+
+
+
+@system_ns.route('/archive')
+class ArchiveStats(Resource):
+    @api.doc('archive_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Cold tier statistics: archived days and transactions per shard, and the file cache"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        stats = archive_store.stats()
+        stats['shards'] = shards.fan_out(lambda shard: read_shard(shard, archive_store.summary))
+        return stats, 200
+
+
+
+@system_ns.route('/feed')
+class FeedStats(Resource):
+    @api.doc('feed_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Change feed statistics: buffered changes, waiting readers and catch-ups from the database"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        return change_feed.stats(), 200
+
+
+
+@system_ns.route('/admission')
+class AdmissionStats(Resource):
+    @api.doc('admission_stats', security=[{'apikey': []}, {'username': []}])
+    @api.response(200, 'Success')
+    @api.response(401, 'Unauthorized')
+    def get(self):
+        """Admission control statistics: requests in flight, limits and rejected requests per reason"""
+        authorized, message, role = authenticate(request)
+        if not authorized:
+            return {'error': message}, 401
+        return admission_control.stats(), 200
+
+
+# The Swagger spec is built once, when the app is loaded (with gunicorn's preload_app before the workers are forked),
+# and every GET /swagger.json is answered with the same bytes
+with app.test_request_context():
+    swagger_json = json.dumps(api.__schema__).encode('utf-8')
+app.view_functions['specs'] = lambda: Response(swagger_json, mimetype='application/json')
 
 
 if __name__ == '__main__':
+    shards.init_shards()
     app.run(debug=True, port=8001) # port 8000 might be taken by authentication_service if run simultaneously
\ No newline at end of file
@@ -0,0 +1,334 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import delete, func, select
+import config
+import dbmodels
+
+# Hot/cold tiering: transactions older than ARCHIVE_AFTER_DAYS are moved, with their results, out of the
+# transactions and results tables into one compressed columnar file per shard and day (numpy .npz, one array
+# per column, sorted by id). The hot tables stay small, and reads by id, lists and exports look into the
+# archive too. Archived transactions are read-only. The rollups keep counting them.
+#
+# The manifest of the files is the archive_partitions table of the shard (see dbmodels.ArchivePartition).
+# A day's file is written first and made visible by the same database transaction that deletes its rows,
+# so a reader sees every row exactly once: in the tables or in a file of its snapshot's manifest.
+# A day that is archived again (rows that came in late) gets a new file; replaced files are removed by a
+# later run, when no reader can still be using them.
+
+# Columns of a partition file: the transaction's, then its result's. A transaction without a result has
+# result_id 0, result_timestamp NaT, is_fraudulent -1 and confidence NaN.
+FILE_COLUMNS = ('id', 'customer', 'timestamp', 'status', 'vendor_id', 'amount', 'result_id', 'result_timestamp', 'is_fraudulent', 'confidence')
+
+# API field -> file column, per kind of row
+FIELDS = {
+    'transactions': {'id': 'id', 'customer': 'customer', 'timestamp': 'timestamp', 'status': 'status', 'vendor_id': 'vendor_id', 'amount': 'amount'},
+    'results': {'id': 'result_id', 'transaction_id': 'id', 'timestamp': 'result_timestamp', 'is_fraudulent': 'is_fraudulent', 'confidence': 'confidence',
+                'customer': 'customer', 'vendor_id': 'vendor_id', 'amount': 'amount', 'status': 'status'}
+}
+TRANSACTION_FIELDS = ('id', 'customer', 'timestamp', 'status', 'vendor_id', 'amount') # as Transaction.to_dict
+RESULT_FIELDS = ('id', 'transaction_id', 'timestamp', 'is_fraudulent', 'confidence') # as Result.to_dict
+
+DELETE_CHUNK = 500 # ids per DELETE statement, below SQLite's limit of bound parameters
+REPLACED_FILE_GRACE = 3600 # seconds before a file that is no longer in the manifest is removed
+
+def _values(part, column, idx):
+    """Python values of a file column at the positions idx"""
+    values = part[column][idx]
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[us]').astype(object).tolist() # datetime, None for NaT
+    if column == 'is_fraudulent':
+        return (values == 1).tolist()
+    return values.tolist()
+
+def _tuples(part, kind, names, idx):
+    return list(zip(*(_values(part, FIELDS[kind][name], idx) for name in names)))
+
+def _dict(names, row):
+    return {name: value.isoformat() if isinstance(value, datetime) else value for name, value in zip(names, row)}
+
+def _mask(part, kind, after_id=None, customer=None, vendor_id=None, status=None, since=None, until=None, is_fraudulent=None, **_):
+    """Rows of a partition that match the list filters; for results, since/until apply to the result's timestamp like in queries.py"""
+    key, timestamp = part[FIELDS[kind]['id']], part[FIELDS[kind]['timestamp']]
+    mask = key > max(after_id or 0, 0) # also drops the rows without a result from a result list
+    if customer is not None:
+        mask &= part['customer'] == customer
+    if vendor_id is not None:
+        mask &= part['vendor_id'] == vendor_id
+    if status is not None:
+        mask &= part['status'] == status.value
+    if since is not None:
+        mask &= timestamp >= np.datetime64(since, 'us')
+    if until is not None:
+        mask &= timestamp < np.datetime64(until, 'us')
+    if is_fraudulent is not None:
+        mask &= part['is_fraudulent'] == int(is_fraudulent)
+    return mask
+
+def _key_range(kind):
+    p = dbmodels.ArchivePartition
+    return (p.min_id, p.max_id) if kind == 'transactions' else (p.min_result_id, p.max_result_id)
+
+def _call(fn, *args):
+    return fn(*args)
+
+def _groups(entries, kind):
+    """
+    Manifest entries in id order, in groups whose id ranges overlap. Ids grow with time, so a group is
+    usually one day; rows only have to be sorted across the files of one group.
+    """
+    low, high = (name.key for name in _key_range(kind))
+    group, group_high = [], None
+    for entry in sorted(entries, key=lambda entry: getattr(entry, low)):
+        if group and getattr(entry, low) > group_high:
+            yield group
+            group = []
+        group.append(entry)
+        group_high = max(group_high or 0, getattr(entry, high))
+    if group:
+        yield group
+
+def _file_columns(rows):
+    """Arrays of the FILE_COLUMNS of (transaction, result) rows as selected by ArchiveStore.archive"""
+    ids, customers, timestamps, statuses, vendors, amounts, result_ids, result_timestamps, frauds, confidences = zip(*rows)
+    return {
+        'id': np.array(ids, dtype=np.int64),
+        'customer': np.array(customers, dtype=str),
+        'timestamp': np.array(timestamps, dtype='datetime64[us]'),
+        'status': np.array([status.value for status in statuses], dtype=str),
+        'vendor_id': np.array(vendors, dtype=str),
+        'amount': np.array(amounts, dtype=np.float64),
+        'result_id': np.array([i or 0 for i in result_ids], dtype=np.int64),
+        'result_timestamp': np.array(result_timestamps, dtype='datetime64[us]'), # None becomes NaT
+        'is_fraudulent': np.array([-1 if fraud is None else int(fraud) for fraud in frauds], dtype=np.int8),
+        'confidence': np.array(confidences, dtype=np.float64) # None becomes NaN
+    }
+
+class ArchiveStore:
+    """Reads and writes the archive files under directory; decompressed files are kept in an LRU cache"""
+
+    def __init__(self, directory, max_partitions=16):
+        self.directory = directory
+        self.max_partitions = max_partitions
+        self._partitions = OrderedDict() # file -> {column: array}; files are never changed, only replaced
+        self._lock = threading.Lock()
+        self._stats = {'loads': 0, 'hits': 0}
+
+    def _load(self, file):
+        with self._lock:
+            part = self._partitions.get(file)
+            if part is not None:
+                self._partitions.move_to_end(file)
+                self._stats['hits'] += 1
+                return part
+        with np.load(os.path.join(self.directory, file), allow_pickle=False) as data:
+            part = {name: data[name] for name in data.files}
+        with self._lock:
+            self._partitions[file] = part
+            while len(self._partitions) > self.max_partitions:
+                self._partitions.popitem(last=False)
+            self._stats['loads'] += 1
+        return part
+
+    def _entries(self, db, kind, after_id=None, since=None, until=None, **_):
+        """Manifest entries that can hold matching rows; db is a session or connection of the shard, in the reader's transaction"""
+        p = dbmodels.ArchivePartition
+        low, high = _key_range(kind)
+        stmt = select(p.__table__).where(high.is_not(None))
+        if after_id is not None:
+            stmt = stmt.where(high > after_id)
+        if kind == 'transactions':
+            if since is not None:
+                stmt = stmt.where(p.day >= since.date())
+            if until is not None:
+                stmt = stmt.where(p.day <= until.date())
+        return db.execute(stmt).all()
+
+    def _rows(self, group, kind, names, filters):
+        """Matching rows (tuples of names, id first) of a group of files, sorted by id"""
+        rows = []
+        for entry in group:
+            part = self._load(entry.file)
+            rows += _tuples(part, kind, names, np.flatnonzero(_mask(part, kind, **filters)))
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def page(self, db, kind, limit, run=_call, **filters):
+        """
+        The first limit + 1 matching archived transactions or results of a list page, as dicts like to_dict().
+        run(fn, *args) calls the functions that read the files, e.g. in a thread (see asyncapp.in_thread).
+        """
+        names = TRANSACTION_FIELDS if kind == 'transactions' else RESULT_FIELDS
+        rows = []
+        for group in _groups(self._entries(db, kind, **filters), kind):
+            rows += run(self._rows, group, kind, names, filters)
+            if len(rows) > limit: # the next groups only hold larger ids
+                break
+        return [_dict(names, row) for row in rows[:limit + 1]]
+
+    def export_chunks(self, conn, kind, names, chunk_size=1000, **filters):
+        """
+        Row chunks (tuples of names) of every matching archived row, ordered by id, for export.read_rows.
+        The manifest is read right away, in the caller's read transaction; the files are read as the chunks are consumed.
+        """
+        groups = list(_groups(self._entries(conn, kind, **filters), kind))
+
+        def chunks():
+            for group in groups:
+                rows = self._rows(group, kind, names, filters)
+                for start in range(0, len(rows), chunk_size):
+                    yield rows[start:start + chunk_size]
+
+        return chunks()
+
+    def transaction(self, db, id, run=_call):
+        """(transaction dict, result dict or None) of an archived transaction, or None if it is not archived; run as in page()"""
+        p = dbmodels.ArchivePartition
+        for entry in db.execute(select(p.__table__).where(p.min_id <= id, p.max_id >= id)).all():
+            part = run(self._load, entry.file)
+            position = np.searchsorted(part['id'], id)
+            if position < len(part['id']) and part['id'][position] == id:
+                transaction = _dict(TRANSACTION_FIELDS, _tuples(part, 'transactions', TRANSACTION_FIELDS, [position])[0])
+                if part['result_id'][position] == 0:
+                    return transaction, None
+                return transaction, _dict(RESULT_FIELDS, _tuples(part, 'results', RESULT_FIELDS, [position])[0])
+        return None
+
+    def archived_statuses(self, db, ids):
+        """{id: status} of the ids that belong to archived transactions"""
+        if not ids:
+            return {}
+        p = dbmodels.ArchivePartition
+        wanted = np.array(sorted(ids), dtype=np.int64)
+        found = {}
+        for entry in db.execute(select(p.__table__).where(p.max_id >= int(wanted[0]), p.min_id <= int(wanted[-1]))):
+            part = self._load(entry.file)
+            positions = np.flatnonzero(np.isin(part['id'], wanted))
+            found.update(zip(part['id'][positions].tolist(), part['status'][positions].tolist()))
+        return found
+
+    def rollup_rows(self, db):
+        """(transaction dicts, result dicts) of every archived day, so rollups.rebuild can count them"""
+        for entry in db.execute(select(dbmodels.ArchivePartition.__table__)):
+            part = self._load(entry.file)
+            transactions = [_dict(TRANSACTION_FIELDS, row) for row in _tuples(part, 'transactions', TRANSACTION_FIELDS, slice(None))]
+            results = [_dict(RESULT_FIELDS, row) for row in _tuples(part, 'results', RESULT_FIELDS, np.flatnonzero(part['result_id'] > 0))]
+            yield transactions, results
+
+    def _write(self, folder, day, columns):
+        file = f'{folder}/{day.isoformat()}.{uuid.uuid4().hex[:12]}.npz'
+        with open(os.path.join(self.directory, file), 'wb') as f:
+            np.savez_compressed(f, **columns)
+            f.flush()
+            os.fsync(f.fileno()) # on disk before the rows are deleted from the database
+        return file
+
+    def _remove_replaced(self, db, folder):
+        """Remove files that the manifest no longer names: replaced days, or files of a run that did not commit"""
+        referenced = set(db.scalars(select(dbmodels.ArchivePartition.file)))
+        for name in os.listdir(os.path.join(self.directory, folder)):
+            path = os.path.join(self.directory, folder, name)
+            if name.endswith('.npz') and f'{folder}/{name}' not in referenced and os.path.getmtime(path) < time.time() - REPLACED_FILE_GRACE:
+                os.remove(path)
+
+    def archive(self, shard, write_session_factory, before, batch_size=100000):
+        """
+        Move the transactions of a shard with a timestamp before `before`, and their results, into the archive.
+        Every batch is one write transaction: the files of its days are written, then the rows are deleted and
+        the manifest is updated. Returns the number of moved transactions and results.
+        """
+        t, r, p = dbmodels.Transaction, dbmodels.Result, dbmodels.ArchivePartition
+        folder = f'shard-{shard}'
+        os.makedirs(os.path.join(self.directory, folder), exist_ok=True)
+        moved = [0, 0]
+        while True:
+            db = write_session_factory()
+            try:
+                if moved == [0, 0]:
+                    self._remove_replaced(db, folder)
+                # The newest transaction and result always stay: a table created without AUTOINCREMENT would
+                # otherwise hand out the ids of archived rows again
+                stmt = (select(t.id, t.customer, t.timestamp, t.status, t.vendor_id, t.amount, r.id, r.timestamp, r.is_fraudulent, r.confidence)
+                        .outerjoin(r, r.transaction_id == t.id)
+                        .where(t.timestamp < before,
+                               t.id < select(func.max(t.id)).scalar_subquery(),
+                               r.id.is_(None) | (r.id < select(func.max(r.id)).scalar_subquery()))
+                        .order_by(t.timestamp, t.id)
+                        .limit(batch_size))
+                rows = {}
+                for row in db.execute(stmt):
+                    rows.setdefault(row[0], row) # one result per transaction is archived
+                if not rows:
+                    return tuple(moved)
+
+                days = {}
+                for row in rows.values():
+                    days.setdefault(row[2].date(), []).append(row)
+                for day, day_rows in days.items():
+                    columns = _file_columns(day_rows)
+                    entry = db.get(p, day)
+                    if entry is not None:
+                        # rows of a day that was archived before: the new rows win over an older copy
+                        old = self._load(entry.file)
+                        keep = ~np.isin(old['id'], columns['id'])
+                        columns = {name: np.concatenate((old[name][keep], values)) for name, values in columns.items()}
+                    order = np.argsort(columns['id'], kind='stable')
+                    columns = {name: columns[name][order] for name in FILE_COLUMNS}
+                    result_ids = columns['result_id'][columns['result_id'] > 0]
+                    values = dict(file=self._write(folder, day, columns),
+                                  rows=len(columns['id']),
+                                  min_id=int(columns['id'][0]),
+                                  max_id=int(columns['id'][-1]),
+                                  min_result_id=int(result_ids.min()) if len(result_ids) else None,
+                                  max_result_id=int(result_ids.max()) if len(result_ids) else None,
+                                  archived_at=datetime.utcnow())
+                    if entry is None:
+                        db.add(p(day=day, **values))
+                    else:
+                        for name, value in values.items():
+                            setattr(entry, name, value)
+
+                ids = list(rows)
+                for start in range(0, len(ids), DELETE_CHUNK):
+                    chunk = ids[start:start + DELETE_CHUNK]
+                    moved[1] += db.execute(delete(r).where(r.transaction_id.in_(chunk)).execution_options(synchronize_session=False)).rowcount
+                    db.execute(delete(t).where(t.id.in_(chunk)).execution_options(synchronize_session=False))
+                db.commit()
+                moved[0] += len(ids)
+            finally:
+                db.close()
+
+    def summary(self, db):
+        """Archived days and transactions of a shard"""
+        p = dbmodels.ArchivePartition
+        days, rows, first, last = db.execute(select(func.count(), func.coalesce(func.sum(p.rows), 0), func.min(p.day), func.max(p.day))).one()
+        return {'days': days, 'transactions': rows,
+                'first_day': first.isoformat() if first else None,
+                'last_day': last.isoformat() if last else None}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_partitions'] = len(self._partitions)
+        stats.update(directory=self.directory, max_partitions=self.max_partitions)
+        return stats
+
+
+if __name__ == '__main__':
+    # python archive.py run [days]
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'run':
+        sys.exit("usage: python archive.py run [age in days, default ARCHIVE_AFTER_DAYS]")
+    import shards
+    from setupdb import WriteSessions
+    shards.init_shards()
+    days = float(sys.argv[2]) if len(sys.argv) == 3 else config.ARCHIVE_AFTER_DAYS
+    before = datetime.utcnow() - timedelta(days=days)
+    store = ArchiveStore(config.ARCHIVE_DIR, max_partitions=config.ARCHIVE_CACHE_PARTITIONS)
+    for shard, WriteSession in enumerate(WriteSessions):
+        transactions, results = store.archive(shard, WriteSession, before, batch_size=config.ARCHIVE_BATCH_SIZE)
+        print(f"Shard {shard}: archived {transactions} transactions and {results} results from before {before.isoformat()}")
@@ -0,0 +1,367 @@
+import asyncio
+import json
+import time
+from aiohttp import web
+from flask_restx import inputs
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.util import await_only
+import config
+import dbmodels
+import dbwrites
+from common import metrics
+import queries
+from common import requestlog
+import rollups
+import shards
+from authclient import ALLOWED_ROLES, AsyncAuthClient, AuthServiceUnavailable
+from queries import status_arg, timestamp_arg
+from setupdb import make_async_engine, shard_url
+from cache import SharedResponseCache
+from common.signedtokens import read_token
+from services import (response_cache, statuses_committed, warm_up, writers, pipelines, score_inline, transactions_committed,
+                      archive_store, admission_control, WRITE_METHODS)
+
+# Asyncio serving mode of the transaction service: the routes of TransactionList, TransactionsDetails, ResultList
+# and ResultByTransaction on an aiohttp server, as an alternative to app.py (python asyncapp.py, same port).
+# All open connections are held by one event loop thread. The databases are reached through async SQLAlchemy
+# sessions over aiosqlite (one thread per pooled connection) and the auth service through an aiohttp session,
+# so a request that waits for either holds no thread. Scoring pipelines, group commit writers, the response
+# cache and the archive are the ones of app.py (see services.py).
+#
+# The queries, writes and rollup updates are the plain functions of queries.py, dbwrites.py, rollups.py and
+# archive.py. They run through AsyncSession.run_sync, which awaits every database call of the function.
+# The work in between that would hold the event loop (reading archive files, inline scoring) goes to a worker
+# thread with in_thread, and so do the reads and writes of the SQLite response cache.
+
+requestlog.configure_logging('transaction_logging.log')
+
+async_engines = [make_async_engine(shard_url(shard)) for shard in range(shards.shard_count())]
+AsyncSessions = [async_sessionmaker(engine) for engine in async_engines]
+AsyncWriteSessions = [async_sessionmaker(engine.execution_options(sqlite_immediate=True)) for engine in async_engines]
+
+# The writers of a shard queue on an asyncio lock instead of SQLite's busy handler (see setupdb.begin_transaction)
+write_locks = [asyncio.Lock() for _ in async_engines]
+
+def in_thread(fn, *args):
+    """From a function run by run_sync: fn(*args) in a worker thread, while the event loop serves other requests"""
+    return await_only(asyncio.to_thread(fn, *args))
+
+async def read_shard(shard, fn):
+    """Run fn(db) on a read session of the shard"""
+    async with AsyncSessions[shard]() as db:
+        return await db.run_sync(fn)
+
+async def write_shard(shard, fn):
+    """Run fn(db) in one write transaction of the shard and commit it"""
+    async with write_locks[shard]:
+        async with AsyncWriteSessions[shard]() as db:
+            result = await db.run_sync(fn)
+            await db.commit()
+            return result
+
+async def list_page(stmt, kind, shard_list, args):
+    """One page of a list endpoint, like app.list_page, with the shards read concurrently"""
+    limit = args['limit']
+
+    def read(db):
+        return shards.merge_sorted([[row.to_dict() for row in db.scalars(stmt)], archive_store.page(db, kind, run=in_thread, **args)], limit + 1)
+
+    pages = await asyncio.gather(*(read_shard(shard, read) for shard in shard_list))
+    return queries.split_page(shards.merge_sorted(pages, limit + 1), limit)
+
+# Query parameters of the paginated list endpoints, as the page parsers of app.py
+PAGE_ARGS = {
+    'limit': inputs.int_range(1, queries.PAGE_SIZE_MAX),
+    'after_id': int,
+    'customer': str,
+    'vendor_id': str,
+    'status': status_arg,
+    'since': timestamp_arg,
+    'until': timestamp_arg
+}
+RESULT_PAGE_ARGS = dict(PAGE_ARGS, is_fraudulent=inputs.boolean)
+
+def parse_args(request, types):
+    """Returns (args, error response or None); missing parameters are None, limit defaults to PAGE_SIZE_DEFAULT"""
+    args, errors = {}, {}
+    for name, convert in types.items():
+        value = request.query.get(name)
+        try:
+            args[name] = convert(value) if value is not None else None
+        except (TypeError, ValueError) as e:
+            errors[name] = str(e)
+    if errors:
+        return None, web.json_response({'errors': errors, 'message': 'Input payload validation failed'}, status=400)
+    if args['limit'] is None:
+        args['limit'] = queries.PAGE_SIZE_DEFAULT
+    return args, None
+
+def page_response(rows, next_after_id):
+    headers = {'X-Next-After-Id': str(next_after_id)} if next_after_id is not None else {}
+    return web.json_response(rows, headers=headers)
+
+async def json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+# Authentication, as in app.py, with the auth service called through aiohttp
+auth_client = AsyncAuthClient(config.AUTH_SERVICE_URL,
+                              ttl=config.AUTH_CACHE_TTL,
+                              negative_ttl=config.AUTH_NEGATIVE_TTL,
+                              max_entries=config.AUTH_CACHE_SIZE,
+                              token_exp=config.TOKEN_EXP,
+                              timeout=config.AUTH_TIMEOUT,
+                              pool_size=config.AUTH_POOL_SIZE,
+                              revocation_refresh=config.TOKEN_REVOCATION_REFRESH) if config.AUTH_MODE == 'remote' else None
+
+async def authenticate(request):
+    """(authorized, error message, role) of the request, checked once per request (admission control checks first)"""
+    if 'auth_result' not in request:
+        request['auth_result'] = await verify_request(request)
+    return request['auth_result']
+
+async def verify_request(request):
+    token = request.headers.get('Authorization')
+    if not token:
+        return False, "No token identified", None
+
+    username = request.headers.get('Username')
+    if not username:
+        return False, "No username provided", None
+
+    role = token.split(':', 1)[0]
+    if role not in ALLOWED_ROLES:
+        return False, "Invalid token format or unauthorized role", None
+
+    if config.TOKEN_SECRET:
+        claims = read_token(config.TOKEN_SECRET, token)
+        if claims is None or claims['sub'] != username:
+            return False, "Invalid or expired token", None
+        if auth_client is not None:
+            try:
+                if await auth_client.is_revoked(claims['jti']):
+                    return False, "Invalid or expired token", None
+            except AuthServiceUnavailable:
+                return False, "Authentication service unavailable", None
+    elif auth_client is not None:
+        try:
+            if not await auth_client.is_valid(username, token):
+                return False, "Invalid or expired token", None
+        except AuthServiceUnavailable:
+            return False, "Authentication service unavailable", None
+    return True, "", role
+
+@web.middleware
+async def check_admission(request, handler):
+    """Admission control of app.py: shed load before the handler does any database work"""
+    resource = request.match_info.route.resource
+    if resource is None or resource.canonical in config.ADMISSION_EXEMPT_ROUTES:
+        return await handler(request)
+    write = request.method in WRITE_METHODS
+    rejection = admission_control.enter(write)
+    if rejection:
+        return rejected(*rejection)
+    try:
+        authorized, message, role = await authenticate(request)
+        if authorized:
+            rejection = admission_control.take(request.headers.get('Username'), role)
+            if rejection:
+                return rejected(*rejection)
+        return await handler(request)
+    finally:
+        admission_control.leave(write)
+
+def rejected(status_code, retry_after, message):
+    return web.json_response({'error': message}, status=status_code, headers={'Retry-After': str(retry_after)})
+
+async def cache_call(fn, *args):
+    """A call of the response cache; the shared cache reads and writes its SQLite file, so it runs in a worker thread"""
+    if isinstance(response_cache, SharedResponseCache):
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args) # the in-process cache only takes a lock
+
+async def read_through(key, load):
+    """app.read_through for coroutines: await load() returns (dict, status code), only 200 answers are cached"""
+    if response_cache is not None:
+        body = await cache_call(response_cache.get, key)
+        if body is not None:
+            return web.Response(body=body, content_type='application/json')
+    read_at = time.time()
+    data, status_code = await load()
+    if status_code != 200 or response_cache is None:
+        return web.json_response(data, status=status_code)
+    body = json.dumps(data).encode('utf-8')
+    await cache_call(response_cache.put, key, body, read_at)
+    return web.Response(body=body, content_type='application/json')
+
+
+routes = web.RouteTableDef()
+
+@routes.get('/transactions/')
+async def list_transactions(request):
+    """List existing transactions, one page at a time (keyset pagination on id)"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+
+    args, error = parse_args(request, PAGE_ARGS)
+    if error:
+        return error
+    transactions, next_after_id = await list_page(queries.transaction_page(**args), 'transactions', shards.shards_for(args['customer']), args)
+    return page_response(transactions, next_after_id)
+
+@routes.post('/transactions/')
+async def make_transaction(request):
+    """Make a transaction"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+
+    row, error = dbwrites.validate_transaction(await json_body(request))
+    if error:
+        return web.json_response({'error': error}, status=400)
+
+    shard = shards.shard_of_customer(row['customer'])
+    if writers:
+        try:
+            future = asyncio.wrap_future(writers[shard].submit(row))
+            return web.json_response(await asyncio.wait_for(future, config.GROUP_COMMIT_TIMEOUT), status=201)
+        except TimeoutError:
+            return web.json_response({'error': 'Transaction was not committed in time, try again'}, status=503)
+
+    def insert(db):
+        # transaction, result and rollups are committed together
+        response = dbwrites.insert_transactions_as_dicts(db, [row])[0]
+        results = in_thread(score_inline, [response]) if not pipelines else [] # with pipelines, scored after the commit
+        dbwrites.insert_results(db, results, [response])
+        return response, results
+
+    response, results = await write_shard(shard, insert)
+    # a full scoring queue makes the submitter score the rest itself, which must not happen on the event loop
+    await asyncio.to_thread(transactions_committed, [response], results)
+    return web.json_response(response, status=201)
+
+@routes.get(r'/transactions/{id:\d+}')
+async def get_transaction(request):
+    """Query specific transaction"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+    id = int(request.match_info['id'])
+
+    def read(db):
+        transaction = db.query(dbmodels.Transaction).filter_by(id=id).first()
+        if transaction:
+            return transaction.to_dict(), 200
+        archived = archive_store.transaction(db, id, run=in_thread)
+        if archived is not None:
+            return archived[0], 200
+        return {'error': 'Transaction not found'}, 404
+
+    async def load():
+        shard = shards.shard_of_id(id)
+        if shard is None:
+            return {'error': 'Transaction not found'}, 404
+        return await read_shard(shard, read)
+
+    return await read_through(f'transaction:{id}', load)
+
+@routes.put(r'/transactions/{id:\d+}')
+async def update_transaction(request):
+    """Update status of transaction"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+    id = int(request.match_info['id'])
+    data = await json_body(request)
+
+    def update(db):
+        transaction = db.query(dbmodels.Transaction).filter_by(id=id).first()
+        if not transaction:
+            if archive_store.transaction(db, id, run=in_thread) is not None:
+                return {'error': 'Transaction is archived and can no longer be updated'}, 409
+            return {'error': 'Transaction not found by this ID'}, 404
+        try:
+            new_status = dbmodels.TransactionStatus(data['status'])
+        except (ValueError, KeyError, TypeError):
+            return {'error': 'Invalid Status code. Availabel codes: submitted, accepted, rejected'}, 400
+        rollups.change_status(db, [dbmodels.Transaction.id == id], new_status)
+        transaction.status = new_status
+        return transaction.to_dict(), 200
+
+    shard = shards.shard_of_id(id)
+    if shard is None:
+        return web.json_response({'error': 'Transaction not found by this ID'}, status=404)
+    response, status_code = await write_shard(shard, update)
+    if status_code == 200:
+        # the cache invalidation and the change feed can query SQLite, which must not happen on the event loop either
+        await asyncio.to_thread(statuses_committed, [id], dbmodels.TransactionStatus(response['status']))
+    return web.json_response(response, status=status_code)
+
+@routes.get('/results/')
+async def list_results(request):
+    """Get predictions, one page at a time (keyset pagination on id)"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+
+    args, error = parse_args(request, RESULT_PAGE_ARGS)
+    if error:
+        return error
+    results, next_after_id = await list_page(queries.result_page(**args), 'results', shards.shards_for(args['customer']), args)
+    return page_response(results, next_after_id)
+
+@routes.get(r'/results/transaction/{transaction_id:\d+}')
+async def get_result_by_transaction(request):
+    """Get the prediction result of one specific transaction"""
+    authorized, message, role = await authenticate(request)
+    if not authorized:
+        return web.json_response({'error': message}, status=401)
+    transaction_id = int(request.match_info['transaction_id'])
+
+    def read(db):
+        result = db.query(dbmodels.Result).filter_by(transaction_id=transaction_id).first()
+        if result:
+            return result.to_dict(), 200
+        # The scoring pipeline may not have reached this transaction yet
+        if db.query(dbmodels.Transaction.id).filter_by(id=transaction_id).first():
+            return {'transaction_id': transaction_id, 'status': 'pending'}, 202
+        archived = archive_store.transaction(db, transaction_id, run=in_thread)
+        if archived is not None and archived[1] is not None:
+            return archived[1], 200
+        return {'error': 'No result found for corresponding transaction'}, 404
+
+    async def load():
+        shard = shards.shard_of_id(transaction_id)
+        if shard is None:
+            return {'error': 'No result found for corresponding transaction'}, 404
+        return await read_shard(shard, read)
+
+    return await read_through(f'result:{transaction_id}', load)
+
+
+async def start(app):
+    # Replaying the recent transactions into the feature store takes a while; it must not happen on the event loop
+    await asyncio.to_thread(warm_up)
+
+async def close(app):
+    if auth_client is not None:
+        await auth_client.close()
+    for engine in async_engines:
+        await engine.dispose()
+
+def make_app(argv=None):
+    """The application; argv is there for python -m aiohttp.web -H <host> -P <port> asyncapp:make_app"""
+    app = web.Application(middlewares=[metrics.aiohttp_middleware(), requestlog.aiohttp_middleware(), check_admission])
+    app.add_routes(routes)
+    app.router.add_get('/metrics', metrics.aiohttp_handler)
+    app.on_startup.append(start)
+    app.on_cleanup.append(close)
+    return app
+
+
+if __name__ == '__main__':
+    shards.init_shards() # like python app.py; python -m aiohttp.web expects the databases set up by flask --app app init-db
+    web.run_app(make_app(), host='127.0.0.1', port=8001, backlog=1024) # serves instead of app.py, on the same port
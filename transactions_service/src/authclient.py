@@ -0,0 +1,236 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+
+# Roles that may use the transaction service
+ALLOWED_ROLES = ('administrator', 'agent')
+
+class AuthServiceUnavailable(Exception):
+    """The auth service could not be reached or gave an unexpected answer"""
+    pass
+
+class AuthClient:
+    """
+    Verifies (username, token) pairs against the auth service's /auth/authenticate.
+    Calls go through one pooled keep-alive requests.Session, verdicts are kept in a TTL + LRU cache
+    (positive ones at most token_exp seconds, negative ones briefly), and concurrent misses for
+    the same pair wait for a single upstream call instead of each making their own.
+    For signed tokens, which are verified locally, it keeps the ids of the logged out ones from /auth/revoked,
+    fetched again every revocation_refresh seconds and trusted for at most ttl seconds, like a valid verdict.
+    """
+
+    def __init__(self, base_url, ttl=60, negative_ttl=5, max_entries=10000, token_exp=3600, timeout=2.0, pool_size=20, revocation_refresh=5):
+        self.url = base_url.rstrip('/') + '/auth/authenticate'
+        self.revoked_url = base_url.rstrip('/') + '/auth/revoked'
+        self.revocation_refresh = revocation_refresh
+        self.ttl = min(ttl, token_exp)
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._cache = OrderedDict() # (username, token) -> (valid, expires_at)
+        self._inflight = {} # (username, token) -> threading.Event of the call in progress
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._revoked = frozenset() # ids (jti) of logged out signed tokens
+        self._revoked_at = float('-inf') # time.monotonic() of the last successful fetch
+        self._refresh_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'upstream_calls': 0, 'upstream_errors': 0, 'evictions': 0, 'revocation_refreshes': 0}
+
+    def _http(self):
+        # One session per process, a forked worker must not share the parent's sockets
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def _cached(self, key, now):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, valid, now):
+        self._cache[key] = (valid, now + (self.ttl if valid else self.negative_ttl))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _call(self, username, token):
+        with self._lock:
+            self._stats['upstream_calls'] += 1
+            http = self._http()
+        try:
+            response = http.post(self.url, json={'username': username, 'token': token}, timeout=self.timeout)
+            response.raise_for_status()
+            return bool(response.json()['validity'])
+        except (requests.RequestException, ValueError, KeyError) as e:
+            with self._lock:
+                self._stats['upstream_errors'] += 1
+            raise AuthServiceUnavailable(str(e))
+
+    def is_valid(self, username, token):
+        """True if the auth service accepts the token for this user; raises AuthServiceUnavailable"""
+        key = (username, token)
+        while True:
+            with self._lock:
+                valid = self._cached(key, time.monotonic())
+                if valid is not None:
+                    self._stats['hits'] += 1
+                    return valid
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    # This thread makes the upstream call, others with the same key wait for it
+                    self._stats['misses'] += 1
+                    done = self._inflight[key] = threading.Event()
+                    break
+            waiting.wait(self.timeout)
+            # Back to the top: the leader's verdict is cached now, or it failed and this thread takes over
+        try:
+            valid = self._call(username, token)
+            with self._lock:
+                self._store(key, valid, time.monotonic())
+            return valid
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            done.set()
+
+    def _refresh_revoked(self):
+        started = time.monotonic()
+        with self._lock:
+            self._stats['revocation_refreshes'] += 1
+            http = self._http()
+        try:
+            response = http.get(self.revoked_url, timeout=self.timeout)
+            response.raise_for_status()
+            revoked = frozenset(response.json()['revoked'])
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            with self._lock:
+                self._stats['upstream_errors'] += 1
+            return
+        self._revoked, self._revoked_at = revoked, started
+
+    def is_revoked(self, jti):
+        """True if the signed token with this id was logged out; raises AuthServiceUnavailable"""
+        age = time.monotonic() - self._revoked_at
+        if age >= self.revocation_refresh:
+            # One thread fetches the list; the others go on with the previous one unless it is too old to trust
+            if self._refresh_lock.acquire(blocking=age >= self.ttl):
+                try:
+                    if time.monotonic() - self._revoked_at >= self.revocation_refresh:
+                        self._refresh_revoked()
+                finally:
+                    self._refresh_lock.release()
+        if time.monotonic() - self._revoked_at >= self.ttl:
+            raise AuthServiceUnavailable('No recent list of revoked tokens')
+        return jti in self._revoked
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._cache)
+        stats['revoked'] = len(self._revoked)
+        return stats
+
+class AsyncAuthClient(AuthClient):
+    """
+    AuthClient for the asyncio mode (asyncapp.py), with the same cache: upstream calls go through one aiohttp
+    session with at most pool_size connections, and concurrent misses for the same pair await a single call.
+    All methods run on the event loop, which is one thread, so the cache needs no waiting on locks.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_session = None
+        self._refresh = None # the fetch of the revoked token ids in progress
+
+    def _http(self):
+        import aiohttp
+        # Created on first use, inside the running event loop
+        if self._async_session is None:
+            self._async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                        timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._async_session
+
+    async def _call(self, username, token):
+        import aiohttp
+        self._stats['upstream_calls'] += 1
+        try:
+            async with self._http().post(self.url, json={'username': username, 'token': token}) as response:
+                response.raise_for_status()
+                return bool((await response.json())['validity'])
+        except (aiohttp.ClientError, TimeoutError, ValueError, KeyError) as e:
+            self._stats['upstream_errors'] += 1
+            raise AuthServiceUnavailable(str(e))
+
+    async def is_valid(self, username, token):
+        """True if the auth service accepts the token for this user; raises AuthServiceUnavailable"""
+        key = (username, token)
+        while True:
+            valid = self._cached(key, time.monotonic())
+            if valid is not None:
+                self._stats['hits'] += 1
+                return valid
+            waiting = self._inflight.get(key)
+            if waiting is None:
+                self._stats['misses'] += 1
+                done = self._inflight[key] = asyncio.Event()
+                break
+            try:
+                await asyncio.wait_for(waiting.wait(), self.timeout)
+            except TimeoutError:
+                pass
+        try:
+            valid = await self._call(username, token)
+            self._store(key, valid, time.monotonic())
+            return valid
+        finally:
+            del self._inflight[key]
+            done.set()
+
+    async def _refresh_revoked(self):
+        import aiohttp
+        started = time.monotonic()
+        self._stats['revocation_refreshes'] += 1
+        try:
+            async with self._http().get(self.revoked_url) as response:
+                response.raise_for_status()
+                revoked = frozenset((await response.json())['revoked'])
+        except (aiohttp.ClientError, TimeoutError, ValueError, KeyError, TypeError):
+            self._stats['upstream_errors'] += 1
+            return
+        self._revoked, self._revoked_at = revoked, started
+
+    async def is_revoked(self, jti):
+        """True if the signed token with this id was logged out; raises AuthServiceUnavailable"""
+        age = time.monotonic() - self._revoked_at
+        if age >= self.revocation_refresh:
+            # As in the threaded client: the request that starts the fetch waits for it, the others only when the list is too old
+            refresh, started = self._refresh, self._refresh is None
+            if started:
+                refresh = self._refresh = asyncio.ensure_future(self._refresh_revoked())
+                refresh.add_done_callback(lambda _: setattr(self, '_refresh', None))
+            if started or age >= self.ttl:
+                await asyncio.shield(refresh)
+        if time.monotonic() - self._revoked_at >= self.ttl:
+            raise AuthServiceUnavailable('No recent list of revoked tokens')
+        return jti in self._revoked
+
+    async def close(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Read-through cache of serialized response bodies (JSON bytes) of single-row lookups.
+# Writers invalidate keys after their commit. An invalidation leaves a marker with its time behind,
+# and a body read from the database before that time is not cached, so a reader that raced a
+# writer cannot put the old row back.
+
+class ResponseCache:
+    """In-process LRU + TTL cache of one worker"""
+
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (body or None for an invalidation marker, stored_at, expires_at)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'stale_rejected': 0}
+
+    def get(self, key):
+        """Cached body, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None or entry[0] is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, body, read_at):
+        """Cache a body that was read from the database at time read_at (taken before the query)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is None and entry[1] >= read_at and entry[2] > now:
+                self._stats['stale_rejected'] += 1
+                return
+            self._store(key, (body, now, now + self.ttl))
+
+    def invalidate(self, keys):
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                self._store(key, (None, now, now + self.ttl))
+                self._stats['invalidations'] += 1
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats.update(backend='local', max_entries=self.max_entries, ttl=self.ttl)
+        return stats
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    The same cache in a SQLite file, shared by every worker process on the host, so an invalidation
+    by one worker is seen by all of them. Put the file on a RAM disk (e.g. /dev/shm) to keep it off the disk.
+    Entries are bounded like the token store of the auth service: the ones closest to expiry go first.
+    Counters are per process.
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=30):
+        super().__init__(max_entries, ttl)
+        self.path = path
+        self._local = threading.local()
+        self._db().executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB, -- NULL: invalidation marker
+                stored_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at);
+
+            CREATE TABLE IF NOT EXISTS response_count (n INTEGER NOT NULL);
+            INSERT INTO response_count (n) SELECT COUNT(*) FROM responses WHERE NOT EXISTS (SELECT 1 FROM response_count);
+            CREATE TRIGGER IF NOT EXISTS responses_count_insert AFTER INSERT ON responses BEGIN UPDATE response_count SET n = n + 1; END;
+            CREATE TRIGGER IF NOT EXISTS responses_count_delete AFTER DELETE ON responses BEGIN UPDATE response_count SET n = n - 1; END;
+        """)
+
+    def _db(self):
+        # One connection per thread and process; sqlite3 connections must not cross either
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None) # autocommit, transactions are explicit
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF") # a cache can lose its last writes
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key):
+        row = self._db().execute("SELECT body FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        if row is None or row[0] is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return row[0]
+
+    def put(self, key, body, read_at):
+        now = time.time()
+        # the upsert keeps a newer invalidation marker in place of the body
+        changed = self._write("""
+            INSERT INTO responses (key, body, stored_at, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET body = excluded.body, stored_at = excluded.stored_at, expires_at = excluded.expires_at
+            WHERE responses.body IS NOT NULL OR responses.stored_at < ? OR responses.expires_at <= ?
+        """, [(key, body, now, now + self.ttl, read_at, now)])
+        if not changed:
+            self._count('stale_rejected')
+
+    def invalidate(self, keys):
+        now = time.time()
+        rows = [(key, now, now + self.ttl) for key in keys]
+        # an upsert, not INSERT OR REPLACE: REPLACE deletes without running the delete trigger
+        self._write("""
+            INSERT INTO responses (key, body, stored_at, expires_at) VALUES (?, NULL, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET body = NULL, stored_at = excluded.stored_at, expires_at = excluded.expires_at
+        """, rows)
+        self._count('invalidations', len(rows))
+
+    def _write(self, sql, rows):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            changed = db.executemany(sql, rows).rowcount
+            excess = db.execute("SELECT n FROM response_count").fetchone()[0] - self.max_entries
+            if excess > 0:
+                db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires_at LIMIT ?)", (excess,))
+                self._count('evictions', excess)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return changed
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['entries'] = self._db().execute("SELECT n FROM response_count").fetchone()[0]
+        stats.update(backend='sqlite', path=self.path, max_entries=self.max_entries, ttl=self.ttl)
+        return stats
@@ -0,0 +1,292 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from sqlalchemy import text
+from common import metrics
+import queries
+import shards
+
+# Change feed (GET /feed/): the new transactions, status changes and fraud results, in the order they were committed,
+# for consumers that would otherwise poll the list endpoints.
+# - Changes are published after their commit into an in-memory ring buffer of this process; readers wait on it.
+# - Transactions committed by other processes (worker processes, tools) are read back from the table into the buffer:
+#   every sync_interval seconds while readers wait, and when published ids leave a gap. Results are read back too
+#   while results_elsewhere() says that another process does the scoring. Status changes are only in the buffer of
+#   the process that made them.
+# - A cursor is "<buffer>.<sequence number>.<transaction id per shard>": the ids are positions up to which the reader
+#   has seen every new transaction of the shard.
+# - A cursor that fell out of the buffer (the reader fell behind, or the cursor is of another process or of before
+#   a restart) catches up with an id-range query: the transactions above its ids, in their current status and with
+#   their results. Status changes and results of transactions the reader saw before are not replayed then.
+
+CATCH_UP = '0' # buffer name of cursors that read from the database; the cursor "0" replays every transaction in the tables
+
+published = metrics.Counter('feed_events_published_total', 'Changes published to the change feed, by type', ('type',))
+catch_ups = metrics.Counter('feed_catch_ups_total', 'Change feed reads answered from the database, for cursors outside the buffer')
+read_back = metrics.Counter('feed_read_back_total', 'Changes committed by other processes and read back from the tables into the buffer, by type', ('type',))
+
+class InvalidCursor(ValueError):
+    pass
+
+class ChangeFeed:
+    """
+    Ring buffer of the last capacity changes: (sequence number, type, data, positions after the change).
+    Types are 'transaction' (the transaction dict), 'status' ({'id', 'status'}) and 'result' (the result dict).
+    """
+
+    def __init__(self, session_factories, capacity=10000, max_gap=1000, sync_interval=1.0, results_elsewhere=None):
+        self.session_factories = session_factories # one per shard, for the catch-up and read-back queries
+        self.capacity = capacity
+        self.max_gap = max_gap
+        self.sync_interval = sync_interval # 0: only read back when a gap grows past max_gap
+        self.results_elsewhere = results_elsewhere # callable, True while another process scores; its results are read back
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Per process: the buffer is started lazily, and again empty in a forked worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.epoch = f'{os.getpid():x}{time.time_ns() // 1000000:x}'
+            self._events = deque(maxlen=self.capacity)
+            self._seq = 0
+            self._changed = threading.Condition()
+            # Per shard: the highest id up to which every transaction is in the buffer, and the published ids above it.
+            # Ids of a shard are handed out in commit order, but two requests may publish theirs in the other order,
+            # and ids committed by other processes are only filled in by a read-back.
+            self._positions = [self._max_id(shard, 'transactions') for shard in range(len(self.session_factories))]
+            self._ahead = [set() for _ in self.session_factories]
+            # Per shard: the highest result id read back, when results are read back
+            self._result_positions = [self._max_id(shard, 'results') for shard in range(len(self.session_factories))]
+            self._sync_lock = threading.Lock()
+            self._synced_at = time.monotonic()
+            self._stats = {'catch_ups': 0, 'waiting': 0, 'read_back': 0}
+            self._pid = os.getpid()
+
+    def _max_id(self, shard, table):
+        """The last id handed out by the shard for the table, also when its row was archived since"""
+        db = self.session_factories[shard]()
+        try:
+            return db.scalar(text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {'name': table}) or shard << shards.ID_SHARD_BITS
+        finally:
+            db.close()
+
+    def _advance(self, shard):
+        ahead = self._ahead[shard]
+        while self._positions[shard] + 1 in ahead:
+            self._positions[shard] += 1
+            ahead.remove(self._positions[shard])
+
+    def _append(self, kind, data):
+        # under the condition's lock
+        self._seq += 1
+        self._events.append((self._seq, kind, data, tuple(self._positions)))
+
+    def publish(self, kind, items):
+        """Append committed changes of one type"""
+        if not items:
+            return
+        self._ensure_started()
+        if kind == 'result' and self._unseen(items):
+            self.sync(wait=True) # a transaction of another process goes into the buffer before its result
+        with self._changed:
+            for data in items:
+                if kind == 'transaction':
+                    shard = shards.shard_of_id(data['id'])
+                    if data['id'] <= self._positions[shard]:
+                        continue # read back from the table already
+                    self._ahead[shard].add(data['id'])
+                    self._advance(shard)
+                self._append(kind, data)
+            gap = any(len(ahead) > self.max_gap for ahead in self._ahead)
+            self._changed.notify_all()
+        published.inc(kind, amount=len(items))
+        if gap:
+            # ids missing for this long were committed by another process or a tool
+            self.sync()
+
+    def _unseen(self, results):
+        """Whether the transaction of one of the results is not in the buffer yet"""
+        with self._changed:
+            for result in results:
+                shard = shards.shard_of_id(result['transaction_id'])
+                if result['transaction_id'] > self._positions[shard] and result['transaction_id'] not in self._ahead[shard]:
+                    return True
+        return False
+
+    def _read_back(self, shard, after_id, after_result_id):
+        """(transaction dicts, result dicts) above the ids, at most capacity of each; no results for after_result_id None"""
+        db = self.session_factories[shard]()
+        try:
+            # Results first: the transaction of every result read here is committed before the second query
+            results = [] if after_result_id is None else [
+                {'transaction_id': result.transaction_id, 'is_fraudulent': result.is_fraudulent, 'confidence': result.confidence, 'id': result.id}
+                for result in db.scalars(queries.feed_results(after_result_id, self.capacity))]
+            transactions = [transaction.to_dict() for transaction, _ in db.execute(queries.feed_catch_up(after_id, self.capacity))]
+            return transactions, results
+        finally:
+            db.close()
+
+    def sync(self, wait=False):
+        """Read the transactions and results that were committed but not published here back into the buffer"""
+        self._ensure_started()
+        if not self._sync_lock.acquire(blocking=wait):
+            return # another thread is reading them back
+        try:
+            self._synced_at = time.monotonic()
+            full = True
+            while full: # more than capacity were committed since the last read-back
+                results = self.results_elsewhere is not None and self.results_elsewhere()
+                with self._changed:
+                    positions = list(self._positions)
+                    result_positions = list(self._result_positions) if results else [None] * len(positions)
+                pages = shards.fan_out(lambda shard: self._read_back(shard, positions[shard], result_positions[shard]), range(len(positions)))
+                full = any(len(rows) >= self.capacity for page in pages for rows in page)
+                counts = {'transaction': 0, 'result': 0}
+                with self._changed:
+                    for shard, (transactions, results) in enumerate(pages):
+                        for transaction in transactions:
+                            if transaction['id'] <= self._positions[shard]:
+                                continue # published meanwhile
+                            # every lower id of the shard was in this read or is in the buffer
+                            self._positions[shard] = transaction['id']
+                            if transaction['id'] in self._ahead[shard]:
+                                self._ahead[shard].remove(transaction['id'])
+                            else:
+                                self._append('transaction', transaction)
+                                counts['transaction'] += 1
+                            self._advance(shard)
+                        for result in results:
+                            if result['id'] > self._result_positions[shard]:
+                                self._result_positions[shard] = result.pop('id')
+                                self._append('result', result)
+                                counts['result'] += 1
+                    self._stats['read_back'] += sum(counts.values())
+                    if any(counts.values()):
+                        self._changed.notify_all()
+                for kind, count in counts.items():
+                    if count:
+                        read_back.inc(kind, amount=count)
+        finally:
+            self._sync_lock.release()
+
+    def parse(self, cursor):
+        """(buffer, sequence number, positions) of a cursor; (None, None, None) for no cursor, meaning from now on"""
+        if not cursor:
+            return None, None, None
+        if cursor == CATCH_UP:
+            return CATCH_UP, 0, [0] * len(self.session_factories)
+        try:
+            epoch, seq, positions = cursor.split('.')
+            seq, positions = int(seq), [int(position) for position in positions.split('-')]
+        except ValueError:
+            raise InvalidCursor('Invalid cursor')
+        if len(positions) != len(self.session_factories):
+            raise InvalidCursor('Cursor of another shard count, start again with the cursor 0')
+        return epoch, seq, positions
+
+    @staticmethod
+    def _cursor(epoch, seq, positions):
+        return f"{epoch}.{seq}.{'-'.join(map(str, positions))}"
+
+    def _take(self, seq, positions, limit):
+        """Up to limit buffered changes after seq, each with the cursor after it; returns (events, seq, positions)"""
+        seen = positions # transactions up to these were delivered already, by the catch-up query
+        start = seq - self._events[0][0] + 1 if self._events else 0
+        events = []
+        for seq, kind, data, after in itertools.islice(self._events, start, None):
+            positions = [max(position, other) for position, other in zip(positions, after)]
+            if kind == 'transaction' and data['id'] <= seen[shards.shard_of_id(data['id'])]:
+                continue
+            events.append({'type': kind, 'data': data, 'cursor': self._cursor(self.epoch, seq, positions)})
+            if len(events) >= limit:
+                break
+        return events, seq, positions
+
+    def _catch_up(self, positions, limit):
+        """
+        The transactions above positions with their results, from the tables, as at most limit events; returns
+        (events, positions, caught up). A transaction and its result are never split, so with limit 1 a transaction
+        that has a result still comes with it.
+        """
+        def read(shard):
+            db = self.session_factories[shard]()
+            try:
+                return [(transaction.to_dict(), result) for transaction, result in db.execute(queries.feed_catch_up(positions[shard], limit))]
+            finally:
+                db.close()
+
+        pages = shards.fan_out(read, range(len(positions)))
+        rows = shards.merge_sorted(pages, limit, key=lambda row: row[0]['id'])
+        positions = list(positions)
+        events = []
+        taken = 0
+        for transaction, result in rows:
+            if events and len(events) + (1 if result is None else 2) > limit:
+                break # the next read starts with this transaction
+            taken += 1
+            positions[shards.shard_of_id(transaction['id'])] = transaction['id']
+            cursor = self._cursor(CATCH_UP, 0, positions)
+            events.append({'type': 'transaction', 'data': transaction, 'cursor': cursor})
+            if result is not None:
+                events.append({'type': 'result', 'cursor': cursor,
+                               'data': {'transaction_id': result.transaction_id, 'is_fraudulent': result.is_fraudulent, 'confidence': result.confidence}})
+        caught_up = taken == sum(map(len, pages)) and all(len(page) < limit for page in pages)
+        with self._changed:
+            self._stats['catch_ups'] += 1
+        catch_ups.inc()
+        return events, positions, caught_up
+
+    def read(self, cursor=None, limit=100, timeout=0.0):
+        """
+        The changes after cursor, waiting up to timeout seconds for the first one.
+        Returns (events, cursor to continue from); events are {'type', 'data', 'cursor'} dicts. Raises InvalidCursor.
+        """
+        self._ensure_started()
+        deadline = time.monotonic() + timeout
+        epoch, seq, positions = self.parse(cursor)
+        while True:
+            if self.sync_interval and time.monotonic() >= self._synced_at + self.sync_interval:
+                self.sync()
+            with self._changed:
+                if epoch is None:
+                    epoch, seq, positions = self.epoch, self._seq, list(self._positions)
+                oldest = self._events[0][0] if self._events else self._seq + 1
+                if epoch == self.epoch and oldest - 1 <= seq <= self._seq:
+                    events, seq, positions = self._take(seq, positions, limit)
+                    remaining = deadline - time.monotonic()
+                    if events or remaining <= 0:
+                        return events, self._cursor(epoch, seq, positions)
+                    if self.sync_interval:
+                        remaining = min(remaining, self._synced_at + self.sync_interval - time.monotonic()) # wake up for the next sync
+                    self._stats['waiting'] += 1
+                    try:
+                        self._changed.wait(max(remaining, 0))
+                    finally:
+                        self._stats['waiting'] -= 1
+                    continue
+                # Changes published from here on are read from the buffer after the catch-up. Transactions that are
+                # both in the catch-up and in the buffer are skipped there by their positions.
+                seq = self._seq
+            events, positions, caught_up = self._catch_up(positions, limit)
+            epoch = self.epoch if caught_up else CATCH_UP
+            cursor = self._cursor(epoch, seq, positions)
+            if events:
+                events[-1]['cursor'] = cursor
+            if events or not caught_up or time.monotonic() >= deadline:
+                return events, cursor
+
+    def stats(self):
+        self._ensure_started()
+        with self._changed:
+            return dict(self._stats,
+                        sequence=self._seq,
+                        buffered=len(self._events),
+                        capacity=self.capacity,
+                        oldest=self._events[0][0] if self._events else None,
+                        positions=list(self._positions))
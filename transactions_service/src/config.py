@@ -0,0 +1,95 @@
+import os
+
+# Service settings, read from environment variables so deployments can tune them without code changes
+
+def env_flag(name, default=False):
+    return os.environ.get(name, '1' if default else '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+# Group commit: POST /transactions/ hands its rows to one writer thread that commits them in batches
+GROUP_COMMIT_ENABLED = env_flag('GROUP_COMMIT_ENABLED')
+GROUP_COMMIT_WINDOW_MS = env_float('GROUP_COMMIT_WINDOW_MS', 5) # how long the writer waits for more rows after the first one
+GROUP_COMMIT_MAX_BATCH = env_int('GROUP_COMMIT_MAX_BATCH', 500) # rows per database transaction
+GROUP_COMMIT_TIMEOUT = env_float('GROUP_COMMIT_TIMEOUT', 10) # seconds a request waits for its commit
+
+# Fraud scoring: "async" scores in a background pipeline, "inline" in the request's database transaction,
+# "owner" in the background pipeline of one process of the host, for the transactions of all processes
+SCORING_MODE = os.environ.get('SCORING_MODE', 'async')
+SCORING_QUEUE_SIZE = env_int('SCORING_QUEUE_SIZE', 10000) # bound of the scoring queue
+SCORING_BATCH_SIZE = env_int('SCORING_BATCH_SIZE', 256) # transactions per score_batch call and commit
+SCORING_WORKERS = env_int('SCORING_WORKERS', 2)
+SCORING_ENQUEUE_TIMEOUT = env_float('SCORING_ENQUEUE_TIMEOUT', 1.0) # seconds to wait for queue space before scoring in the request thread
+SCORING_LOCK_PATH = os.environ.get('SCORING_LOCK_PATH', 'scoring.lock') # file whose lock elects the scoring process (owner mode)
+SCORING_POLL_SECONDS = env_float('SCORING_POLL_SECONDS', 0.5) # how often the scoring process looks for transactions of the other processes
+
+# Fraud scorer: "features" scores with the incremental feature store, "mock" with random predictions
+SCORER = os.environ.get('SCORER', 'features')
+FEATURE_MAX_KEYS = env_int('FEATURE_MAX_KEYS', 100000) # customers (and vendors) kept in memory, least recently used are evicted
+FEATURE_VELOCITY_HALF_LIFE = env_float('FEATURE_VELOCITY_HALF_LIFE', 3600) # seconds
+FEATURE_AMOUNT_HALF_LIFE = env_float('FEATURE_AMOUNT_HALF_LIFE', 86400) # seconds
+FEATURE_WARMUP_HOURS = env_float('FEATURE_WARMUP_HOURS', 168) # history replayed from the transactions table at startup
+FEATURE_WARMUP_MAX_ROWS = env_int('FEATURE_WARMUP_MAX_ROWS', 1000000)
+
+# Token verification: "remote" asks the auth service (with a local cache), "header" only checks the role prefix of the token
+AUTH_MODE = os.environ.get('AUTH_MODE', 'remote')
+AUTH_SERVICE_URL = os.environ.get('AUTH_SERVICE_URL', 'http://127.0.0.1:8000')
+AUTH_CACHE_TTL = env_float('AUTH_CACHE_TTL', 60) # seconds a valid token is trusted without asking again
+AUTH_NEGATIVE_TTL = env_float('AUTH_NEGATIVE_TTL', 5) # seconds a rejected token stays rejected
+AUTH_CACHE_SIZE = env_int('AUTH_CACHE_SIZE', 10000)
+AUTH_TIMEOUT = env_float('AUTH_TIMEOUT', 2.0)
+AUTH_POOL_SIZE = env_int('AUTH_POOL_SIZE', 20) # keep-alive connections to the auth service
+TOKEN_EXP = env_int('TOKEN_EXP', 3600) # token lifetime of the auth service, caps AUTH_CACHE_TTL
+TOKEN_REVOCATION_REFRESH = env_float('TOKEN_REVOCATION_REFRESH', 5) # seconds between fetches of the logged out signed tokens from the auth service
+TOKEN_SECRET = os.environ.get('TOKEN_SECRET', '').encode('utf-8') # signing key shared with the auth service, enables local verification of signed tokens
+
+# Admission control (admission.py), per worker process; 0 or empty turns a limit off
+ADMISSION_MAX_IN_FLIGHT = env_int('ADMISSION_MAX_IN_FLIGHT', 256) # requests handled at once, more are answered with 503
+ADMISSION_MAX_WRITES_IN_FLIGHT = env_int('ADMISSION_MAX_WRITES_IN_FLIGHT', 64) # POST/PUT requests at once, they all queue on the SQLite writer
+ADMISSION_RETRY_AFTER = env_int('ADMISSION_RETRY_AFTER', 1) # Retry-After of the 503 answers, seconds
+ADMISSION_EXEMPT_ROUTES = set(filter(None, os.environ.get('ADMISSION_EXEMPT_ROUTES', '/,/metrics,/swagger.json').split(',')))
+RATE_LIMIT_USER = os.environ.get('RATE_LIMIT_USER', '') # token bucket of every user: "<requests per second>/<burst>", e.g. "20/40"
+RATE_LIMIT_ROLES = os.environ.get('RATE_LIMIT_ROLES', '') # token bucket of all users of a role together, e.g. "agent=100/200,administrator=500"
+RATE_LIMIT_MAX_USERS = env_int('RATE_LIMIT_MAX_USERS', 100000) # user buckets kept, the least recently used are dropped
+
+# Database and connection pool
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///bank_system.db')
+SHARD_COUNT = env_int('SHARD_COUNT', 1) # databases the transactions are spread over by customer; shard 0 is DATABASE_URL
+SHARD_URL_TEMPLATE = os.environ.get('SHARD_URL_TEMPLATE', 'sqlite:///bank_system_{shard}.db') # databases of shards 1 and up
+SHARD_WORKERS = env_int('SHARD_WORKERS', 8) # threads that query the shards in parallel
+DB_POOL_SIZE = env_int('DB_POOL_SIZE', 20)
+DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 20)
+DB_POOL_TIMEOUT = env_float('DB_POOL_TIMEOUT', 10) # seconds to wait for a free connection
+
+# SQLite performance profile, applied to every new connection
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)
+SQLITE_CACHE_SIZE = env_int('SQLITE_CACHE_SIZE', -65536) # negative: KiB, so 64 MiB of page cache per connection
+SQLITE_MMAP_SIZE = env_int('SQLITE_MMAP_SIZE', 268435456) # bytes of the database file read through memory mapping
+
+# Bulk exports (GET /transactions/export, /results/export)
+EXPORT_CHUNK_SIZE = env_int('EXPORT_CHUNK_SIZE', 1000) # rows fetched from the cursor and encoded at a time
+
+# Cold tier: transactions older than ARCHIVE_AFTER_DAYS are moved into compressed per-day files by "python archive.py run"
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = env_float('ARCHIVE_AFTER_DAYS', 90)
+ARCHIVE_BATCH_SIZE = env_int('ARCHIVE_BATCH_SIZE', 100000) # transactions moved per database transaction
+ARCHIVE_CACHE_PARTITIONS = env_int('ARCHIVE_CACHE_PARTITIONS', 16) # decompressed day files kept in memory per process
+
+# Change feed (GET /feed/) of new transactions, status changes and results, per process
+FEED_BUFFER_SIZE = env_int('FEED_BUFFER_SIZE', 10000) # changes kept in memory, older cursors catch up from the database
+FEED_POLL_TIMEOUT = env_float('FEED_POLL_TIMEOUT', 25) # default and longest wait of a long-poll for the first change, seconds
+FEED_STREAM_SECONDS = env_float('FEED_STREAM_SECONDS', 300) # an event stream ends after this long, the client reconnects with Last-Event-ID
+FEED_HEARTBEAT_SECONDS = env_float('FEED_HEARTBEAT_SECONDS', 15) # comment line sent on an idle event stream
+FEED_SYNC_SECONDS = env_float('FEED_SYNC_SECONDS', 1) # how often waiting readers read back what other processes committed, 0 turns it off
+
+# Response cache of GET /transactions/<id> and /results/transaction/<id>: "local" (per process), "sqlite" (shared by the workers of a host) or "off"
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'local')
+RESPONSE_CACHE_SIZE = env_int('RESPONSE_CACHE_SIZE', 10000)
+RESPONSE_CACHE_TTL = env_float('RESPONSE_CACHE_TTL', 30) # seconds
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH', 'response_cache.db') # file of the sqlite backend
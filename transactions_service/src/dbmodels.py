@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, Boolean, DateTime, ForeignKey, Enum, Integer
+from sqlalchemy import Column, String, Float, Boolean, Date, DateTime, ForeignKey, Enum, Integer, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import enum
@@ -21,6 +21,26 @@ class Transaction(Base):
 
     results = relationship("Result", back_populates="transaction")
 
+    # Composite indexes for keyset pagination: every filter column is paired with id,
+    # so "WHERE <filter> AND id > :after_id ORDER BY id LIMIT n" is a bounded index range scan
+    __table_args__ = (
+        Index("ix_transactions_customer_id", "customer", "id"),
+        Index("ix_transactions_vendor_id_id", "vendor_id", "id"),
+        Index("ix_transactions_status_id", "status", "id"),
+        Index("ix_transactions_timestamp_id", "timestamp", "id"),
+        {"sqlite_autoincrement": True}, # ids of a shard start at its own offset (see shards.py) and are never reused
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'customer': self.customer,
+            'timestamp': self.timestamp.isoformat(), # normal datetime object is not JSON serializable, so we need ISO format
+            'status': self.status.value, # .value gets str representation
+            'vendor_id': self.vendor_id,
+            'amount': self.amount
+        }
+
 class Result(Base):
     __tablename__ = "results"
 
@@ -30,4 +50,97 @@ class Result(Base):
     is_fraudulent = Column("is_fraudulent", Boolean)
     confidence = Column("confidence", Float, nullable=False)
     
-    transaction = relationship("Transaction", back_populates="results")
\ No newline at end of file
+    transaction = relationship("Transaction", back_populates="results")
+
+    __table_args__ = (
+        Index("ix_results_transaction_id", "transaction_id"),
+        Index("ix_results_is_fraudulent_id", "is_fraudulent", "id"),
+        Index("ix_results_timestamp_id", "timestamp", "id"),
+        {"sqlite_autoincrement": True},
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'transaction_id': self.transaction_id,
+            'timestamp': self.timestamp.isoformat(),
+            'is_fraudulent': self.is_fraudulent,
+            'confidence': self.confidence
+        }
+
+# Rollups: running totals per customer, per vendor and per hour, kept up to date in the same database
+# transaction as the rows they count (see rollups.py), so the analytics endpoints read one row per key or bucket
+def rollup_totals(transaction_count, total_amount, scored_count, fraud_count):
+    return {
+        'transaction_count': transaction_count,
+        'total_amount': total_amount,
+        'average_amount': total_amount / transaction_count if transaction_count else None,
+        'scored_count': scored_count,
+        'fraud_count': fraud_count,
+        'fraud_rate': fraud_count / scored_count if scored_count else None
+    }
+
+class RollupColumns:
+    transaction_count = Column("transaction_count", Integer, nullable=False, default=0)
+    total_amount = Column("total_amount", Float, nullable=False, default=0.0)
+    scored_count = Column("scored_count", Integer, nullable=False, default=0)
+    fraud_count = Column("fraud_count", Integer, nullable=False, default=0)
+
+    def totals(self):
+        return rollup_totals(self.transaction_count, self.total_amount, self.scored_count, self.fraud_count)
+
+class PartyRollupColumns(RollupColumns):
+    submitted_count = Column("submitted_count", Integer, nullable=False, default=0)
+    accepted_count = Column("accepted_count", Integer, nullable=False, default=0)
+    rejected_count = Column("rejected_count", Integer, nullable=False, default=0)
+    first_transaction_at = Column("first_transaction_at", DateTime)
+    last_transaction_at = Column("last_transaction_at", DateTime)
+
+    def to_dict(self):
+        return dict(self.totals(),
+                    submitted_count=self.submitted_count,
+                    accepted_count=self.accepted_count,
+                    rejected_count=self.rejected_count,
+                    first_transaction_at=self.first_transaction_at.isoformat() if self.first_transaction_at else None,
+                    last_transaction_at=self.last_transaction_at.isoformat() if self.last_transaction_at else None)
+
+class CustomerRollup(PartyRollupColumns, Base):
+    __tablename__ = "customer_rollups"
+
+    customer = Column("customer", String, primary_key=True)
+
+    def to_dict(self):
+        return dict(super().to_dict(), customer=self.customer)
+
+class VendorRollup(PartyRollupColumns, Base):
+    __tablename__ = "vendor_rollups"
+
+    vendor_id = Column("vendor_id", String, primary_key=True)
+
+    def to_dict(self):
+        return dict(super().to_dict(), vendor_id=self.vendor_id)
+
+class HourlyRollup(RollupColumns, Base):
+    __tablename__ = "hourly_rollups"
+
+    hour = Column("hour", DateTime, primary_key=True) # start of the hour (UTC) of the transactions' timestamps
+
+    def to_dict(self):
+        return dict(self.totals(), hour=self.hour.isoformat())
+
+class ArchivePartition(Base):
+    """
+    One file of the cold tier (see archive.py): the archived transactions of one day, with their results.
+    The table is the manifest of the archive. It lives in the database of the shard, so moving rows out of the
+    transactions table and pointing the manifest at their file are one database transaction.
+    """
+    __tablename__ = "archive_partitions"
+
+    day = Column("day", Date, primary_key=True) # UTC date of the transactions' timestamps
+    file = Column("file", String, nullable=False) # path relative to ARCHIVE_DIR
+    rows = Column("rows", Integer, nullable=False)
+    min_id = Column("min_id", Integer, nullable=False)
+    max_id = Column("max_id", Integer, nullable=False)
+    min_result_id = Column("min_result_id", Integer) # NULL when no transaction of the day was scored
+    max_result_id = Column("max_result_id", Integer)
+    archived_at = Column("archived_at", DateTime, default = datetime.utcnow)
@@ -0,0 +1,123 @@
+import math
+from datetime import datetime
+from sqlalchemy import insert, select, update
+import dbmodels
+import queries
+import rollups
+
+# Upper bound for one POST /transactions/batch call
+BATCH_SIZE_MAX = 50000
+
+# Upper bound of ids for one PUT /transactions/status call, and ids per UPDATE statement
+# (below SQLite's limit of bound parameters per statement, which is 999 before version 3.32)
+STATUS_UPDATE_MAX = 50000
+STATUS_UPDATE_CHUNK = 500
+
+def validate_transaction(data):
+    """
+    Check one incoming transaction.
+    Returns (row, None) with the row ready for insertion, or (None, error message).
+    """
+    if not isinstance(data, dict):
+        return None, 'Transaction must be a JSON object'
+    for field in ('customer', 'vendor_id'):
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None, f"'{field}' must be a non-empty string"
+    amount = data.get('amount')
+    # bool is a subclass of int, so it has to be excluded explicitly
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not math.isfinite(amount):
+        return None, "'amount' must be a number"
+    return {
+        'customer': data['customer'],
+        'vendor_id': data['vendor_id'],
+        'amount': float(amount),
+        'status': dbmodels.TransactionStatus.submitted
+    }, None
+
+def insert_transactions(db, rows):
+    """
+    Insert many transactions with one executemany statement, without committing.
+    Returns the new ids in the same order as rows.
+    """
+    if not rows:
+        return []
+    stmt = insert(dbmodels.Transaction).returning(dbmodels.Transaction.id, sort_by_parameter_order=True)
+    return list(db.scalars(stmt, rows))
+
+def insert_transactions_as_dicts(db, rows):
+    """
+    Like insert_transactions, but returns the inserted transactions in their API representation,
+    and adds them to the rollups.
+    The timestamp is set here instead of by the column default, so no rows have to be read back.
+    """
+    now = datetime.utcnow()
+    rows = [dict(row, timestamp=row.get('timestamp', now)) for row in rows]
+    ids = insert_transactions(db, rows)
+    transactions = [
+        {
+            'id': transaction_id,
+            'customer': row['customer'],
+            'timestamp': row['timestamp'].isoformat(),
+            'status': row['status'].value,
+            'vendor_id': row['vendor_id'],
+            'amount': row['amount']
+        }
+        for row, transaction_id in zip(rows, ids)
+    ]
+    rollups.add_transactions(db, transactions)
+    return transactions
+
+def insert_results(db, predictions, transactions):
+    """
+    Insert many results (dicts with transaction_id, is_fraudulent, confidence) with one executemany statement, without committing.
+    transactions are the scored transaction dicts, for the rollups.
+    """
+    if predictions:
+        db.execute(insert(dbmodels.Result), predictions)
+        rollups.add_results(db, predictions, transactions)
+
+def _status_update(db, conditions, status, from_statuses):
+    """
+    UPDATE of the status of the transactions that match conditions, skipping rows already in the status and,
+    with from_statuses, rows not in one of those. The rollups are moved along first. Returns the updated ids.
+    """
+    conditions = list(conditions) + [dbmodels.Transaction.status != status]
+    if from_statuses:
+        conditions.append(dbmodels.Transaction.status.in_(from_statuses))
+    rollups.change_status(db, conditions, status)
+    stmt = update(dbmodels.Transaction).values(status=status).where(*conditions)
+    return list(db.scalars(stmt.returning(dbmodels.Transaction.id).execution_options(synchronize_session=False)))
+
+def update_status(db, ids, status, from_statuses=None):
+    """
+    Set the status of many transactions with set-based UPDATEs (one per chunk of ids), without committing.
+    Returns (updated ids, {id: (outcome, current status)} for the ids that were not updated), where outcome is
+    'unchanged' (already in the status), 'rejected' (the current status is not in from_statuses) or 'not_found'.
+    """
+    ids = list(dict.fromkeys(ids)) # drop repeated ids, keep the order
+    updated = []
+    for start in range(0, len(ids), STATUS_UPDATE_CHUNK):
+        chunk = ids[start:start + STATUS_UPDATE_CHUNK]
+        updated.extend(_status_update(db, [dbmodels.Transaction.id.in_(chunk)], status, from_statuses))
+
+    # Only the ids that were left alone are looked up, to explain why
+    updated_ids = set(updated)
+    skipped = [i for i in ids if i not in updated_ids]
+    current = {}
+    for start in range(0, len(skipped), STATUS_UPDATE_CHUNK):
+        chunk = skipped[start:start + STATUS_UPDATE_CHUNK]
+        current.update(db.execute(select(dbmodels.Transaction.id, dbmodels.Transaction.status).where(dbmodels.Transaction.id.in_(chunk))).all())
+    outcome = {}
+    for transaction_id in skipped:
+        if transaction_id not in current:
+            outcome[transaction_id] = ('not_found', None)
+        elif current[transaction_id] == status:
+            outcome[transaction_id] = ('unchanged', status)
+        else:
+            outcome[transaction_id] = ('rejected', current[transaction_id])
+    return updated, outcome
+
+def update_status_where(db, status, from_statuses=None, **filters):
+    """Set the status of every transaction that matches the list filters with one UPDATE, without committing; returns the updated ids"""
+    return _status_update(db, queries.transaction_conditions(**filters), status, from_statuses)
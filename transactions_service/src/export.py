@@ -0,0 +1,80 @@
+import csv
+import enum
+import heapq
+import io
+import itertools
+import json
+import zlib
+from datetime import datetime
+
+# Bulk export: rows are read in chunks of a server-side cursor and encoded chunk by chunk,
+# so memory use does not depend on the size of the table
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+def _ndjson(columns, rows):
+    return ''.join(json.dumps(dict(zip(columns, map(_value, row)))) + '\n' for row in rows)
+
+def _csv(columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_value(v) for v in row] for row in rows)
+    return buffer.getvalue()
+
+def _csv_header(columns):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(columns)
+    return buffer.getvalue()
+
+def read_rows(engine, stmt, chunk_size=1000, archived=None):
+    """
+    Generator of row chunks of a SELECT, read from a server-side cursor.
+    It opens its own connection, because it keeps running after the view function has returned.
+    archived(conn) gives the row chunks of the archive (see archive.py); they are read in the same
+    transaction as the SELECT, so no row is missed or repeated while it is being archived, and merged in by id.
+    """
+    with engine.connect() as conn:
+        archived_chunks = archived(conn) if archived is not None else None
+        chunks = conn.execution_options(yield_per=chunk_size).execute(stmt).partitions()
+        if archived_chunks is None:
+            yield from chunks
+            return
+        rows = heapq.merge(itertools.chain.from_iterable(archived_chunks), itertools.chain.from_iterable(chunks), key=lambda row: row[0])
+        yield from rechunk(rows, chunk_size)
+
+def rechunk(rows, chunk_size=1000):
+    """Row chunks of a stream of single rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def stream_rows(chunks, columns, fmt='ndjson', gzip=False):
+    """
+    Generator of encoded export chunks (bytes) for row chunks (see read_rows).
+    With gzip, every chunk is compressed and flushed right away, so the client receives a valid gzip stream as it goes.
+    """
+    encode = _ndjson if fmt == 'ndjson' else _csv
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None # wbits 31: gzip header and trailer
+
+    def out(text):
+        data = text.encode('utf-8')
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+
+    # The first chunk (the CSV header, or nothing for NDJSON) goes out before the query runs, so the response starts at once
+    yield out(_csv_header(columns) if fmt == 'csv' else '')
+    for rows in chunks:
+        yield out(encode(columns, rows))
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select
+import dbmodels
+
+def epoch_seconds(timestamp):
+    """Stored timestamps are naive UTC; accepts a datetime or its ISO string"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+class DecayedStats:
+    """
+    Exponentially decayed count, sum and sum of squares of amounts per key.
+    Each key owns one slot in preallocated NumPy arrays, so memory is fixed by max_keys;
+    an update or read is O(1), and the least recently used key is evicted when the arrays are full.
+    """
+
+    def __init__(self, max_keys, velocity_half_life, amount_half_life):
+        self.max_keys = max_keys
+        self.velocity_rate = math.log(2) / velocity_half_life
+        self.amount_rate = math.log(2) / amount_half_life
+        self.slots = OrderedDict() # key -> slot, in LRU order
+        self.free = list(range(max_keys - 1, -1, -1))
+        self.evictions = 0
+        self.last_seen = np.zeros(max_keys)
+        self.velocity = np.zeros(max_keys) # decayed transaction count, short half-life
+        self.count = np.zeros(max_keys) # decayed transaction count, long half-life
+        self.total = np.zeros(max_keys) # decayed sum of amounts
+        self.total_sq = np.zeros(max_keys) # decayed sum of squared amounts
+
+    def _slot(self, key):
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.slots.move_to_end(key)
+            return slot
+        if not self.free:
+            _, evicted = self.slots.popitem(last=False)
+            self.free.append(evicted)
+            self.evictions += 1
+        slot = self.free.pop()
+        self.slots[key] = slot
+        self.last_seen[slot] = self.velocity[slot] = self.count[slot] = self.total[slot] = self.total_sq[slot] = 0.0
+        return slot
+
+    def read(self, key, now):
+        """(velocity, count, mean, std) for key as of now, without updating it"""
+        slot = self.slots.get(key)
+        if slot is None:
+            return 0.0, 0.0, 0.0, 0.0
+        elapsed = max(now - self.last_seen[slot], 0.0)
+        velocity = self.velocity[slot] * math.exp(-self.velocity_rate * elapsed)
+        decay = math.exp(-self.amount_rate * elapsed)
+        count = self.count[slot] * decay
+        if count <= 0:
+            return velocity, 0.0, 0.0, 0.0
+        mean = self.total[slot] * decay / count
+        variance = max(self.total_sq[slot] * decay / count - mean * mean, 0.0)
+        return velocity, count, mean, math.sqrt(variance)
+
+    def update(self, key, now, amount):
+        slot = self._slot(key)
+        elapsed = max(now - self.last_seen[slot], 0.0)
+        decay = math.exp(-self.amount_rate * elapsed)
+        self.velocity[slot] = self.velocity[slot] * math.exp(-self.velocity_rate * elapsed) + 1.0
+        self.count[slot] = self.count[slot] * decay + 1.0
+        self.total[slot] = self.total[slot] * decay + amount
+        self.total_sq[slot] = self.total_sq[slot] * decay + amount * amount
+        self.last_seen[slot] = max(self.last_seen[slot], now)
+
+class FeatureStore:
+    """
+    In-memory features per customer and per vendor, updated incrementally with every scored transaction.
+    Per customer it also remembers the most recently used vendors (at most max_vendors), for distinct-vendor counts.
+    """
+
+    # Order of the columns returned by features()
+    FEATURE_NAMES = ('amount_zscore', 'customer_velocity', 'customer_history', 'new_vendor', 'distinct_vendors', 'vendor_velocity', 'vendor_amount_ratio')
+
+    def __init__(self, max_keys=100000, velocity_half_life=3600, amount_half_life=86400, vendor_window=86400, max_vendors=32):
+        self.half_lives = (velocity_half_life, amount_half_life)
+        self.customers = DecayedStats(max_keys, *self.half_lives)
+        self.vendors = DecayedStats(max_keys, *self.half_lives)
+        self.vendor_window = vendor_window
+        self.max_vendors = max_vendors
+        self.customer_vendors = OrderedDict() # customer -> OrderedDict(vendor_id -> last seen), evicted with the customer's LRU order
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self._warmed = False
+
+    def features(self, transaction):
+        """Feature vector of one transaction against the state before it"""
+        now = epoch_seconds(transaction['timestamp'])
+        amount = transaction['amount']
+        velocity, count, mean, std = self.customers.read(transaction['customer'], now)
+        vendor_velocity, vendor_count, vendor_mean, _ = self.vendors.read(transaction['vendor_id'], now)
+        vendors = self.customer_vendors.get(transaction['customer'], {})
+        distinct = sum(1 for seen in vendors.values() if now - seen <= self.vendor_window)
+        return (
+            (amount - mean) / max(std, 1.0) if count >= 1 else 0.0,
+            velocity,
+            count,
+            1.0 if count >= 1 and transaction['vendor_id'] not in vendors else 0.0,
+            float(distinct),
+            vendor_velocity,
+            amount / vendor_mean if vendor_count >= 1 and vendor_mean > 0 else 1.0
+        )
+
+    def update(self, transaction):
+        now = epoch_seconds(transaction['timestamp'])
+        customer = transaction['customer']
+        self.customers.update(customer, now, transaction['amount'])
+        self.vendors.update(transaction['vendor_id'], now, transaction['amount'])
+
+        vendors = self.customer_vendors.get(customer)
+        if vendors is None:
+            vendors = self.customer_vendors[customer] = OrderedDict()
+            if len(self.customer_vendors) > self.max_keys:
+                self.customer_vendors.popitem(last=False)
+        else:
+            self.customer_vendors.move_to_end(customer)
+        vendors[transaction['vendor_id']] = now
+        vendors.move_to_end(transaction['vendor_id'])
+        if len(vendors) > self.max_vendors:
+            vendors.popitem(last=False)
+
+    def observe(self, transactions):
+        """Feature matrix for a batch, updating the store after each row so later rows see the earlier ones"""
+        matrix = np.empty((len(transactions), len(self.FEATURE_NAMES)))
+        with self.lock:
+            for i, transaction in enumerate(transactions):
+                matrix[i] = self.features(transaction)
+                self.update(transaction)
+        return matrix
+
+    def warm_up(self, session_factories, hours=168, max_rows=1000000):
+        """
+        Replay recent transactions from the databases (one per shard), merged in time order, once.
+        A worker process forked after the warm-up (gunicorn with preload_app) starts with the replayed state.
+        """
+        with self.lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            since = datetime.utcnow() - timedelta(hours=hours)
+            stmt = (select(dbmodels.Transaction.customer, dbmodels.Transaction.vendor_id, dbmodels.Transaction.amount, dbmodels.Transaction.timestamp)
+                    .where(dbmodels.Transaction.timestamp >= since)
+                    .order_by(dbmodels.Transaction.timestamp, dbmodels.Transaction.id)
+                    .limit(max_rows)
+                    .execution_options(yield_per=10000))
+            sessions = [session_factory() for session_factory in session_factories]
+            try:
+                rows = heapq.merge(*(db.execute(stmt) for db in sessions), key=lambda row: row.timestamp)
+                for customer, vendor_id, amount, timestamp in itertools.islice(rows, max_rows):
+                    self.update({'customer': customer, 'vendor_id': vendor_id, 'amount': amount, 'timestamp': timestamp})
+            finally:
+                for db in sessions:
+                    db.close()
+
+    def reset(self):
+        """Forget every customer and vendor, so the next warm_up replays from scratch"""
+        with self.lock:
+            self.customers = DecayedStats(self.max_keys, *self.half_lives)
+            self.vendors = DecayedStats(self.max_keys, *self.half_lives)
+            self.customer_vendors = OrderedDict()
+            self._warmed = False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'customers': len(self.customers.slots),
+                'vendors': len(self.vendors.slots),
+                'max_keys': self.max_keys,
+                'customer_evictions': self.customers.evictions,
+                'vendor_evictions': self.vendors.evictions
+            }
@@ -0,0 +1,110 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+import dbwrites
+
+class GroupCommitWriter:
+    """
+    One dedicated writer thread for new transactions.
+    Request threads submit validated rows and wait on a Future; the writer collects whatever is queued
+    within a short window (or up to max_batch rows) and inserts it in one SQLite transaction,
+    so concurrent requests share one commit instead of competing for the write lock.
+    """
+
+    def __init__(self, session_factory, window_ms=5, max_batch=500, predict=None, on_commit=None):
+        self.session_factory = session_factory
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.predict = predict # transaction dicts -> result dicts, inserted in the same transaction; None to skip
+        self.on_commit = on_commit # called with the committed transaction dicts and result dicts
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {'batches': 0, 'rows': 0, 'failed_batches': 0, 'max_batch_size': 0, 'wait_seconds_total': 0.0, 'max_wait_seconds': 0.0}
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork), since threads do not survive into forked worker processes
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name='group-commit-writer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, row):
+        """Queue one validated transaction row; the Future resolves to the committed transaction as a dict"""
+        self._ensure_started()
+        row = dict(row, timestamp=datetime.utcnow())
+        future = Future()
+        self._queue.put((row, future, time.monotonic()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Anything that queued up meanwhile goes into the same commit, without waiting further
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            rows = [row for row, _, _ in batch]
+            db = self.session_factory()
+            try:
+                committed = dbwrites.insert_transactions_as_dicts(db, rows)
+                results = self.predict(committed) if self.predict is not None else []
+                dbwrites.insert_results(db, results, committed)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                with self._lock:
+                    self._stats['failed_batches'] += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                db.close()
+
+            now = time.monotonic()
+            waits = [now - queued_at for _, _, queued_at in batch]
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['rows'] += len(batch)
+                self._stats['max_batch_size'] = max(self._stats['max_batch_size'], len(batch))
+                self._stats['wait_seconds_total'] += sum(waits)
+                self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], max(waits))
+            for (_, future, _), transaction in zip(batch, committed):
+                future.set_result(transaction)
+            if self.on_commit is not None:
+                try:
+                    self.on_commit(committed, results)
+                except Exception:
+                    logging.getLogger(__name__).exception('Group commit on_commit callback failed')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['window_ms'] = self.window * 1000
+        stats['max_batch'] = self.max_batch
+        stats['mean_batch_size'] = stats['rows'] / stats['batches'] if stats['batches'] else 0.0
+        stats['mean_wait_seconds'] = stats['wait_seconds_total'] / stats['rows'] if stats['rows'] else 0.0
+        return stats
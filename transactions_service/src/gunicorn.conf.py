@@ -0,0 +1,42 @@
+import os
+from common.serving import worker_count
+
+# Production serving of the transaction service: "python -m gunicorn app:app" in this folder (gunicorn reads this
+# file from there), after "flask --app app init-db" has set up the databases.
+# The master process imports the app once (preload_app) and forks WEB_WORKERS worker processes with WEB_THREADS
+# request threads each, so the workers start without importing anything and share the memory of what the master
+# loaded until they write to it. Settings come from environment variables:
+# WEB_BIND       address to listen on (default 127.0.0.1:8001)
+# WEB_WORKERS    worker processes (default: one per core; -w/--workers of the command line override it)
+# WEB_THREADS    request threads per worker (default 8)
+# WEB_BACKLOG    connections waiting to be accepted (default 2048)
+# WEB_TIMEOUT    seconds a busy worker may not answer the master before it is restarted (default 60)
+
+bind = os.environ.get('WEB_BIND', '127.0.0.1:8001')
+workers = worker_count(int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))) # -w on the command line counts too
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread'
+preload_app = True
+backlog = int(os.environ.get('WEB_BACKLOG', 2048))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+def when_ready(server):
+    # Runs in the master after the app was loaded and before the workers are forked: every worker starts with a warm feature store
+    import services
+    services.warm_up()
+
+# Unless set, several workers share the sqlite response cache (a cache of each worker would keep serving what another
+# worker has invalidated), and one of them scores the transactions of all (the feature store of each worker would
+# only know the transactions of its worker)
+raw_env = []
+if workers > 1 and 'RESPONSE_CACHE_BACKEND' not in os.environ:
+    raw_env.append('RESPONSE_CACHE_BACKEND=sqlite')
+if workers > 1 and 'SCORING_MODE' not in os.environ:
+    raw_env.append('SCORING_MODE=owner')
+
+def post_worker_init(worker):
+    # Every worker waits for the scoring lock from its start, not from its first request
+    import services
+    if services.scoring_owner is not None:
+        services.scoring_owner.start()
@@ -0,0 +1,108 @@
+from datetime import timezone
+from flask_restx import inputs
+from sqlalchemy import select
+import dbmodels
+
+# Page sizes for the keyset (cursor) paginated list endpoints
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+
+# Columns of the bulk exports, in output order; the result export carries the transaction's columns along
+TRANSACTION_EXPORT_COLUMNS = ('id', 'customer', 'timestamp', 'status', 'vendor_id', 'amount')
+RESULT_EXPORT_COLUMNS = ('id', 'transaction_id', 'timestamp', 'is_fraudulent', 'confidence', 'customer', 'vendor_id', 'amount', 'status')
+
+# Parsers of the filter values, used by the request parsers of app.py and asyncapp.py
+def timestamp_arg(value):
+    """ISO 8601 timestamp; timezone-aware values are converted to naive UTC like the stored timestamps"""
+    parsed = inputs.datetime_from_iso8601(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def status_arg(value):
+    try:
+        return dbmodels.TransactionStatus(value)
+    except ValueError:
+        raise ValueError('Invalid Status code. Availabel codes: submitted, accepted, rejected')
+
+def transaction_conditions(after_id=None, customer=None, vendor_id=None, status=None, since=None, until=None):
+    """WHERE conditions of the transaction filters, shared by the SELECTs and the bulk status UPDATE"""
+    conditions = []
+    if customer is not None:
+        conditions.append(dbmodels.Transaction.customer == customer)
+    if vendor_id is not None:
+        conditions.append(dbmodels.Transaction.vendor_id == vendor_id)
+    if status is not None:
+        conditions.append(dbmodels.Transaction.status == status)
+    if since is not None:
+        conditions.append(dbmodels.Transaction.timestamp >= since)
+    if until is not None:
+        conditions.append(dbmodels.Transaction.timestamp < until)
+    if after_id is not None:
+        conditions.append(dbmodels.Transaction.id > after_id)
+    return conditions
+
+def filter_transactions(stmt, **filters):
+    return stmt.where(*transaction_conditions(**filters)).order_by(dbmodels.Transaction.id)
+
+def filter_results(stmt, joined=False, after_id=None, is_fraudulent=None, since=None, until=None, customer=None, vendor_id=None, status=None):
+    """Filters on the transaction (customer, vendor, status) are applied through a join on transaction_id"""
+    if not joined and (customer is not None or vendor_id is not None or status is not None):
+        stmt = stmt.join(dbmodels.Transaction, dbmodels.Result.transaction_id == dbmodels.Transaction.id)
+    if customer is not None:
+        stmt = stmt.where(dbmodels.Transaction.customer == customer)
+    if vendor_id is not None:
+        stmt = stmt.where(dbmodels.Transaction.vendor_id == vendor_id)
+    if status is not None:
+        stmt = stmt.where(dbmodels.Transaction.status == status)
+    if is_fraudulent is not None:
+        stmt = stmt.where(dbmodels.Result.is_fraudulent == is_fraudulent)
+    if since is not None:
+        stmt = stmt.where(dbmodels.Result.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(dbmodels.Result.timestamp < until)
+    if after_id is not None:
+        stmt = stmt.where(dbmodels.Result.id > after_id)
+    return stmt.order_by(dbmodels.Result.id)
+
+def transaction_page(limit=PAGE_SIZE_DEFAULT, **filters):
+    """
+    SELECT statement for one page of transactions, ordered by id.
+    Fetches limit + 1 rows so the caller can tell whether there is a next page.
+    """
+    return filter_transactions(select(dbmodels.Transaction), **filters).limit(limit + 1)
+
+def result_page(limit=PAGE_SIZE_DEFAULT, **filters):
+    """SELECT statement for one page of results, ordered by id"""
+    return filter_results(select(dbmodels.Result), **filters).limit(limit + 1)
+
+def transaction_export(**filters):
+    """SELECT of plain rows (no ORM objects) of every matching transaction, ordered by id"""
+    columns = [getattr(dbmodels.Transaction, name) for name in TRANSACTION_EXPORT_COLUMNS]
+    return filter_transactions(select(*columns), **filters)
+
+def result_export(**filters):
+    """SELECT of plain rows of every matching result, joined with its transaction"""
+    columns = [getattr(dbmodels.Result, name) for name in RESULT_EXPORT_COLUMNS[:5]]
+    columns += [getattr(dbmodels.Transaction, name) for name in RESULT_EXPORT_COLUMNS[5:]]
+    stmt = select(*columns).join(dbmodels.Transaction, dbmodels.Result.transaction_id == dbmodels.Transaction.id)
+    return filter_results(stmt, joined=True, **filters)
+
+def feed_catch_up(after_id, limit):
+    """SELECT of the first limit transactions above after_id with their results (None when not scored yet), for the change feed"""
+    return (select(dbmodels.Transaction, dbmodels.Result)
+            .outerjoin(dbmodels.Result, dbmodels.Result.transaction_id == dbmodels.Transaction.id)
+            .where(dbmodels.Transaction.id > after_id)
+            .order_by(dbmodels.Transaction.id)
+            .limit(limit))
+
+def feed_results(after_id, limit):
+    """SELECT of the first limit results above after_id, for the change feed"""
+    return select(dbmodels.Result).where(dbmodels.Result.id > after_id).order_by(dbmodels.Result.id).limit(limit)
+
+def split_page(rows, limit):
+    """Cut the extra look-ahead row off a page of row dicts; returns (rows, next_after_id or None)"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1]['id']
+    return rows, None
@@ -0,0 +1,171 @@
+import sys
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import archive
+import config
+import dbmodels
+
+# Incremental rollups: every write that adds transactions, results or status changes also adds its deltas
+# to the per-customer, per-vendor and per-hour totals, with one upsert per table in the same database transaction.
+# Rows that are written without these functions are picked up by a rebuild: python rollups.py rebuild
+
+PARTIES = ((dbmodels.CustomerRollup, 'customer'), (dbmodels.VendorRollup, 'vendor_id'))
+STATUS_COUNTS = {status: f'{status.value}_count' for status in dbmodels.TransactionStatus}
+
+def hour_of(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def _upsert(db, model, key, rows):
+    """Add delta rows (key plus counter columns, all rows with the same columns) to a rollup table"""
+    if not rows:
+        return
+    table = model.__table__
+    stmt = sqlite_insert(table)
+    values = {}
+    for name in rows[0]:
+        if name == 'first_transaction_at':
+            values[name] = func.min(func.coalesce(table.c[name], stmt.excluded[name]), stmt.excluded[name]) # scalar min() of SQLite
+        elif name == 'last_transaction_at':
+            values[name] = func.max(func.coalesce(table.c[name], stmt.excluded[name]), stmt.excluded[name])
+        elif name != key:
+            values[name] = table.c[name] + stmt.excluded[name]
+    db.execute(stmt.on_conflict_do_update(index_elements=[key], set_=values), rows)
+
+def add_transactions(db, transactions):
+    """Count new transactions (dicts in their API representation)"""
+    parties = {key: {} for _, key in PARTIES}
+    hours = {}
+    for t in transactions:
+        timestamp = datetime.fromisoformat(t['timestamp'])
+        for _, key in PARTIES:
+            row = parties[key].get(t[key])
+            if row is None:
+                row = parties[key][t[key]] = dict({key: t[key], 'transaction_count': 0, 'total_amount': 0.0,
+                                                   'first_transaction_at': timestamp, 'last_transaction_at': timestamp},
+                                                  **{name: 0 for name in STATUS_COUNTS.values()})
+            row['transaction_count'] += 1
+            row['total_amount'] += t['amount']
+            row[STATUS_COUNTS[dbmodels.TransactionStatus(t['status'])]] += 1
+            row['first_transaction_at'] = min(row['first_transaction_at'], timestamp)
+            row['last_transaction_at'] = max(row['last_transaction_at'], timestamp)
+        row = hours.setdefault(hour_of(timestamp), {'hour': hour_of(timestamp), 'transaction_count': 0, 'total_amount': 0.0})
+        row['transaction_count'] += 1
+        row['total_amount'] += t['amount']
+    for model, key in PARTIES:
+        _upsert(db, model, key, list(parties[key].values()))
+    _upsert(db, dbmodels.HourlyRollup, 'hour', list(hours.values()))
+
+def add_results(db, predictions, transactions):
+    """Count new results; transactions are the scored transaction dicts, they give customer, vendor and hour"""
+    by_id = {t['id']: t for t in transactions}
+    counts = {key: defaultdict(lambda: [0, 0]) for _, key in PARTIES}
+    counts['hour'] = defaultdict(lambda: [0, 0])
+    for prediction in predictions:
+        t = by_id[prediction['transaction_id']]
+        for key, value in (('customer', t['customer']), ('vendor_id', t['vendor_id']), ('hour', hour_of(datetime.fromisoformat(t['timestamp'])))):
+            counts[key][value][0] += 1
+            counts[key][value][1] += int(bool(prediction['is_fraudulent']))
+    for model, key in PARTIES + ((dbmodels.HourlyRollup, 'hour'),):
+        _upsert(db, model, key, [{key: value, 'scored_count': n, 'fraud_count': fraud} for value, (n, fraud) in counts[key].items()])
+
+def change_status(db, conditions, status):
+    """
+    Move the transactions that match conditions (and are not in status yet) to the count of the new status.
+    Call it before the UPDATE, with the UPDATE's conditions: the old statuses are counted with one GROUP BY.
+    """
+    conditions = list(conditions) + [dbmodels.Transaction.status != status]
+    for model, key in PARTIES:
+        column = getattr(dbmodels.Transaction, key)
+        grouped = db.execute(select(column, dbmodels.Transaction.status, func.count())
+                             .where(*conditions)
+                             .group_by(column, dbmodels.Transaction.status)).all()
+        rows = {}
+        for value, old_status, n in grouped:
+            row = rows.setdefault(value, dict({key: value}, **{name: 0 for name in STATUS_COUNTS.values()}))
+            row[STATUS_COUNTS[old_status]] -= n
+            row[STATUS_COUNTS[status]] += n
+        _upsert(db, model, key, list(rows.values()))
+
+COUNTERS = ('transaction_count', 'total_amount', 'scored_count', 'fraud_count') + tuple(STATUS_COUNTS.values())
+
+def combine(rows):
+    """One rollup of the rollups of the same key from several shards (a vendor has transactions in every shard)"""
+    rows = [row for row in rows if row is not None]
+    if len(rows) <= 1:
+        return rows[0] if rows else None
+    combined = type(rows[0])(**{name: sum(getattr(row, name) for row in rows) for name in COUNTERS if hasattr(rows[0], name)})
+    for name in type(rows[0]).__table__.primary_key.columns.keys():
+        setattr(combined, name, getattr(rows[0], name))
+    if hasattr(rows[0], 'first_transaction_at'):
+        combined.first_transaction_at = min((row.first_transaction_at for row in rows if row.first_transaction_at), default=None)
+        combined.last_transaction_at = max((row.last_transaction_at for row in rows if row.last_transaction_at), default=None)
+    return combined
+
+def buckets(db, since, until, bucket='hour'):
+    """
+    (bucket start, transaction_count, total_amount, scored_count, fraud_count) per hour or per day between since (inclusive)
+    and until (exclusive), read from the hourly rollups
+    """
+    h = dbmodels.HourlyRollup
+    start = h.hour if bucket == 'hour' else func.date(h.hour)
+    stmt = (select(start, func.sum(h.transaction_count), func.sum(h.total_amount), func.sum(h.scored_count), func.sum(h.fraud_count))
+            .where(h.hour >= hour_of(since), h.hour < until)
+            .group_by(start).order_by(start))
+    return [tuple(row) for row in db.execute(stmt)]
+
+def bucket_dicts(shard_buckets, bucket='hour'):
+    """API representation of the buckets of several shards, added up per bucket"""
+    totals = {}
+    for rows in shard_buckets:
+        for start, *counts in rows:
+            totals[start] = [a + b for a, b in zip(totals[start], counts)] if start in totals else counts
+    return [dict(dbmodels.rollup_totals(*counts), **{bucket: start.isoformat() if bucket == 'hour' else start})
+            for start, counts in sorted(totals.items())]
+
+def rebuild(db):
+    """Recompute all rollups from the transactions and results tables and the archive, without committing"""
+    t, r = dbmodels.Transaction, dbmodels.Result
+    for model in (dbmodels.CustomerRollup, dbmodels.VendorRollup, dbmodels.HourlyRollup):
+        db.execute(delete(model))
+
+    totals = [func.count(t.id), func.coalesce(func.sum(t.amount), 0.0), func.count(r.id), func.coalesce(func.sum(case((r.is_fraudulent, 1), else_=0)), 0)]
+    total_names = ['transaction_count', 'total_amount', 'scored_count', 'fraud_count']
+
+    def joined(stmt):
+        return stmt.select_from(t).outerjoin(r, r.transaction_id == t.id)
+
+    for model, key in PARTIES:
+        column = getattr(t, key)
+        status_counts = [func.sum(case((t.status == status, 1), else_=0)) for status in STATUS_COUNTS]
+        stmt = joined(select(column, *totals, *status_counts, func.min(t.timestamp), func.max(t.timestamp))).group_by(column)
+        names = [key] + total_names + list(STATUS_COUNTS.values()) + ['first_transaction_at', 'last_transaction_at']
+        db.execute(insert(model).from_select(names, stmt))
+
+    hour = func.strftime('%Y-%m-%d %H:00:00.000000', t.timestamp) # the storage format of DateTime in SQLite
+    db.execute(insert(dbmodels.HourlyRollup).from_select(['hour'] + total_names, joined(select(hour, *totals)).group_by(hour)))
+
+    # archived transactions are no longer in the tables, but still count
+    for transactions, results in archive.ArchiveStore(config.ARCHIVE_DIR, max_partitions=1).rollup_rows(db):
+        add_transactions(db, transactions)
+        add_results(db, results, transactions)
+
+
+if __name__ == '__main__':
+    # python rollups.py rebuild
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebuild':
+        sys.exit("usage: python rollups.py rebuild")
+    import shards
+    from setupdb import WriteSessions
+    shards.init_shards()
+    for shard, WriteSession in enumerate(WriteSessions):
+        db = WriteSession()
+        try:
+            rebuild(db)
+            db.commit()
+            print(f"Shard {shard}: rebuilt rollups of {db.scalar(select(func.count()).select_from(dbmodels.CustomerRollup))} customers, "
+                  f"{db.scalar(select(func.count()).select_from(dbmodels.VendorRollup))} vendors and "
+                  f"{db.scalar(select(func.count()).select_from(dbmodels.HourlyRollup))} hours")
+        finally:
+            db.close()
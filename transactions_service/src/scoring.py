@@ -0,0 +1,284 @@
+import fcntl
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+from sqlalchemy import func, select
+import dbmodels
+import dbwrites
+
+class MockScorer:
+    """Randomised ML prediction System, scoring a whole batch with one vectorized call"""
+
+    def score_batch(self, transactions):
+        """Returns (is_fraudulent, confidence) arrays, one entry per transaction dict"""
+        rng = np.random.default_rng() # Generators are not thread-safe, so every call gets its own
+        n = len(transactions)
+        return rng.random(n) < 0.5, rng.uniform(0.6, 0.99, n)
+
+class FeatureScorer:
+    """
+    Logistic fraud score over the incremental features of a FeatureStore.
+    Features are gathered per transaction (the store is sequential by nature), the model runs once per batch.
+    """
+
+    # One weight per FeatureStore.FEATURE_NAMES column, applied after transform()
+    WEIGHTS = np.array([0.6, 0.9, -0.3, 0.8, 0.5, -0.1, 0.4])
+    BIAS = -3.0
+
+    def __init__(self, store, session_factories=(), warmup_hours=168, warmup_max_rows=1000000):
+        self.store = store
+        self.session_factories = session_factories # one per shard, to warm the store up from
+        self.warmup_hours = warmup_hours
+        self.warmup_max_rows = warmup_max_rows
+
+    @staticmethod
+    def transform(matrix):
+        zscore, velocity, history, new_vendor, distinct, vendor_velocity, ratio = matrix.T
+        return np.column_stack((
+            np.clip(zscore, -5, 10),
+            np.log1p(velocity),
+            np.log1p(history),
+            new_vendor,
+            np.log1p(distinct),
+            np.log1p(vendor_velocity),
+            np.log(np.clip(ratio, 0.01, 100))
+        ))
+
+    def score_batch(self, transactions):
+        """Returns (is_fraudulent, confidence) arrays, one entry per transaction dict"""
+        if self.session_factories:
+            self.store.warm_up(self.session_factories, hours=self.warmup_hours, max_rows=self.warmup_max_rows)
+        probability = 1 / (1 + np.exp(-(self.transform(self.store.observe(transactions)) @ self.WEIGHTS + self.BIAS)))
+        return probability >= 0.5, np.maximum(probability, 1 - probability)
+
+def predict(scorer, transactions):
+    """Score transaction dicts and turn the scores into Result rows"""
+    if not transactions:
+        return []
+    is_fraudulent, confidence = scorer.score_batch(transactions)
+    return [
+        {'transaction_id': t['id'], 'is_fraudulent': bool(fraud), 'confidence': float(conf)}
+        for t, fraud, conf in zip(transactions, is_fraudulent, confidence)
+    ]
+
+class ScoringPipeline:
+    """
+    Fraud scoring off the request path.
+    Committed transactions go onto a bounded queue; a pool of worker threads drains it in micro-batches,
+    scores each batch with one score_batch call and bulk-inserts the Result rows in one commit.
+    Until then GET /results/transaction/<id> reports the transaction as pending.
+    """
+
+    def __init__(self, session_factory, scorer, queue_size=10000, batch_size=256, workers=2, enqueue_timeout=1.0, on_scored=None, poll_interval=None):
+        self.session_factory = session_factory
+        self.scorer = scorer
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self.on_scored = on_scored # called with the inserted result dicts
+        self.poll_interval = poll_interval # seconds; when set, transactions committed by other processes are picked up from the table too
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._inflight = set() # ids that are queued or being scored, so recovery and requests never queue one twice
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {'batches': 0, 'scored': 0, 'failed_batches': 0, 'scored_inline': 0}
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork), since threads do not survive into forked worker processes
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._inflight = set()
+            for number in range(self.workers):
+                threading.Thread(target=self._run, name=f'scoring-worker-{number}', daemon=True).start()
+            self._pid = os.getpid()
+        threading.Thread(target=self._recover if self.poll_interval is None else self._poll, name='scoring-recovery', daemon=True).start()
+
+    def start(self):
+        """Start the worker threads now rather than with the first submit"""
+        self._ensure_started()
+
+    def submit(self, transactions):
+        """
+        Queue committed transaction dicts for scoring.
+        When the queue stays full for enqueue_timeout, the rest is scored in the calling thread instead,
+        so a backlog slows submitters down rather than growing without bound.
+        """
+        self._ensure_started()
+        for position, transaction in enumerate(transactions):
+            try:
+                self._enqueue(transaction, timeout=self.enqueue_timeout)
+            except queue.Full:
+                for start in range(position, len(transactions), self.batch_size):
+                    self.score(transactions[start:start + self.batch_size])
+                with self._lock:
+                    self._stats['scored_inline'] += len(transactions) - position
+                return
+
+    def _enqueue(self, transaction, timeout=None):
+        with self._lock:
+            if transaction['id'] in self._inflight:
+                return
+            self._inflight.add(transaction['id'])
+        try:
+            self._queue.put(transaction, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._inflight.discard(transaction['id'])
+            raise
+
+    def score(self, transactions):
+        """Score transactions and insert their results in one commit"""
+        db = self.session_factory()
+        try:
+            # Skip transactions that already have a result, e.g. queued both by a request and by recovery
+            ids = [t['id'] for t in transactions]
+            scored = set(db.scalars(select(dbmodels.Result.transaction_id).where(dbmodels.Result.transaction_id.in_(ids))))
+            unique = {t['id']: t for t in transactions if t['id'] not in scored}
+            results = predict(self.scorer, list(unique.values()))
+            dbwrites.insert_results(db, results, transactions)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        if self.on_scored is not None:
+            try:
+                self.on_scored(results)
+            except Exception:
+                logging.getLogger(__name__).exception('Scoring on_scored callback failed')
+        return results
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.score(batch)
+            except Exception:
+                logging.getLogger(__name__).exception('Scoring a batch of %d transactions failed', len(batch))
+                with self._lock:
+                    self._stats['failed_batches'] += 1
+                    self._inflight.difference_update(t['id'] for t in batch)
+                continue
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['scored'] += len(batch)
+                self._inflight.difference_update(t['id'] for t in batch)
+
+    def _recover(self):
+        """Queue transactions that were committed but never scored, e.g. because the process stopped with a backlog"""
+        db = self.session_factory()
+        try:
+            stmt = (select(dbmodels.Transaction)
+                    .outerjoin(dbmodels.Result, dbmodels.Result.transaction_id == dbmodels.Transaction.id)
+                    .where(dbmodels.Result.id.is_(None))
+                    .order_by(dbmodels.Transaction.id))
+            pending = [t.to_dict() for t in db.scalars(stmt.limit(self.queue_size))]
+        finally:
+            db.close()
+        for transaction in pending:
+            self._enqueue(transaction)
+
+    def _poll(self):
+        """Recovery, then every poll_interval the transactions committed since, by this or any other process"""
+        db = self.session_factory()
+        try:
+            after_id = db.scalar(select(func.max(dbmodels.Transaction.id))) or 0
+        finally:
+            db.close()
+        self._recover()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                after_id = self._queue_new(after_id)
+            except Exception:
+                logging.getLogger(__name__).exception('Looking for new transactions to score failed')
+
+    def _queue_new(self, after_id):
+        """Queue the unscored transactions above after_id; returns the id to continue after"""
+        db = self.session_factory()
+        try:
+            stmt = (select(dbmodels.Transaction, dbmodels.Result.id)
+                    .outerjoin(dbmodels.Result, dbmodels.Result.transaction_id == dbmodels.Transaction.id)
+                    .where(dbmodels.Transaction.id > after_id)
+                    .order_by(dbmodels.Transaction.id)
+                    .limit(self.queue_size))
+            rows = db.execute(stmt).all()
+            pending = [transaction.to_dict() for transaction, result_id in rows if result_id is None]
+            after_id = rows[-1][0].id if rows else after_id
+        finally:
+            db.close()
+        for transaction in pending:
+            self._enqueue(transaction)
+        return after_id
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['queue_size'] = self.queue_size
+        stats['batch_size'] = self.batch_size
+        stats['workers'] = self.workers
+        return stats
+
+class ScoringOwner:
+    """
+    Elects the one process of the host that scores (SCORING_MODE=owner): the process holding an exclusive lock on a file.
+    Every process waits for the lock in a thread; when the owner exits, the kernel releases its lock and the next
+    waiting process takes over. on_acquired(takeover) is called in the new owner, takeover is True when another
+    process of the same gunicorn master scored before it.
+    """
+
+    def __init__(self, path, on_acquired):
+        self.path = path
+        self.on_acquired = on_acquired
+        self._lock = threading.Lock()
+        self._pid = None
+        self._owner = None
+
+    def start(self):
+        # Per process: a forked worker competes with a thread of its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._owner = None
+            threading.Thread(target=self._acquire, name='scoring-owner', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _acquire(self):
+        file = open(self.path, 'a+') # stays open, closing it would release the lock
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.seek(0)
+        previous = file.read().split()
+        file.seek(0)
+        file.truncate()
+        file.write(f'{os.getppid()} {os.getpid()}')
+        file.flush()
+        self._file = file
+        try:
+            self.on_acquired(len(previous) == 2 and previous[0] == str(os.getppid()))
+        except Exception:
+            logging.getLogger(__name__).exception('Taking over the scoring failed')
+        self._owner = os.getpid()
+
+    def is_owner(self):
+        self.start()
+        return self._owner == os.getpid()
+
+    def stats(self):
+        return {'owner': self.is_owner(), 'lock_path': self.path}
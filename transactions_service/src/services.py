@@ -0,0 +1,128 @@
+import config
+from common import metrics
+import shards
+from admission import AdmissionController, parse_limit, parse_role_limits
+from setupdb import Sessions, WriteSessions
+from archive import ArchiveStore
+from cache import ResponseCache, SharedResponseCache
+from changefeed import ChangeFeed
+from features import FeatureStore
+from groupcommit import GroupCommitWriter
+from scoring import FeatureScorer, MockScorer, ScoringOwner, ScoringPipeline, predict
+
+# The components behind the routes, built from config once per process. They are shared by both ways to
+# serve the transaction service: the Flask app (app.py) and the asyncio mode (asyncapp.py).
+
+# Read-through cache of single-row lookups, holding the serialized JSON bodies
+if config.RESPONSE_CACHE_BACKEND == 'sqlite':
+    response_cache = SharedResponseCache(config.RESPONSE_CACHE_PATH, max_entries=config.RESPONSE_CACHE_SIZE, ttl=config.RESPONSE_CACHE_TTL)
+elif config.RESPONSE_CACHE_BACKEND == 'local':
+    response_cache = ResponseCache(max_entries=config.RESPONSE_CACHE_SIZE, ttl=config.RESPONSE_CACHE_TTL)
+else:
+    response_cache = None
+
+def invalidate(keys):
+    """Drop cached responses after the commit that changed them"""
+    if response_cache is not None and keys:
+        response_cache.invalidate(keys)
+
+# Change feed of the committed changes, read by GET /feed/. In a process that leaves the scoring to the owner
+# (SCORING_MODE=owner), the results are read back from the tables.
+change_feed = ChangeFeed(Sessions, capacity=config.FEED_BUFFER_SIZE, sync_interval=config.FEED_SYNC_SECONDS,
+                         results_elsewhere=lambda: scoring_owner is not None and not scoring_owner.is_owner())
+
+
+def results_committed(results):
+    invalidate([f"result:{r['transaction_id']}" for r in results])
+    change_feed.publish('result', results)
+
+def statuses_committed(ids, status):
+    """Called after status changes are committed"""
+    invalidate([f'transaction:{i}' for i in ids])
+    change_feed.publish('status', [{'id': i, 'status': status.value} for i in ids])
+
+
+# Fraud scoring: either inline in the request's database transaction, or in the background scoring pipeline.
+# The feature store only knows the transactions its process scored, so with several worker processes (gunicorn)
+# one of them, the owner, scores for all: the others leave their transactions to its polling pipelines.
+feature_store = FeatureStore(max_keys=config.FEATURE_MAX_KEYS,
+                             velocity_half_life=config.FEATURE_VELOCITY_HALF_LIFE,
+                             amount_half_life=config.FEATURE_AMOUNT_HALF_LIFE) if config.SCORER == 'features' else None
+scorer = FeatureScorer(feature_store, Sessions,
+                       warmup_hours=config.FEATURE_WARMUP_HOURS,
+                       warmup_max_rows=config.FEATURE_WARMUP_MAX_ROWS) if feature_store is not None else MockScorer()
+# One pipeline per shard, since a result is written to the shard of its transaction
+pipelines = [ScoringPipeline(WriteSessions[shard], scorer,
+                             queue_size=config.SCORING_QUEUE_SIZE,
+                             batch_size=config.SCORING_BATCH_SIZE,
+                             workers=config.SCORING_WORKERS,
+                             enqueue_timeout=config.SCORING_ENQUEUE_TIMEOUT,
+                             on_scored=results_committed,
+                             poll_interval=config.SCORING_POLL_SECONDS if config.SCORING_MODE == 'owner' else None)
+             for shard in range(shards.shard_count())] if config.SCORING_MODE in ('async', 'owner') else []
+
+def warm_up():
+    """Startup work of the process: the replay of the feature store. gunicorn.conf.py runs it before forking the workers"""
+    if feature_store is not None:
+        feature_store.warm_up(Sessions, hours=config.FEATURE_WARMUP_HOURS, max_rows=config.FEATURE_WARMUP_MAX_ROWS)
+
+def take_over_scoring(takeover):
+    """Start scoring in the process that became the owner"""
+    if takeover and feature_store is not None:
+        # the previous owner scored transactions this process never saw since it was forked
+        feature_store.reset()
+        warm_up()
+    for pipeline in pipelines:
+        pipeline.start()
+
+scoring_owner = ScoringOwner(config.SCORING_LOCK_PATH, take_over_scoring) if config.SCORING_MODE == 'owner' else None
+
+def score_inline(transactions):
+    """Result rows to insert together with the transactions, or none when the pipeline scores them later"""
+    return predict(scorer, transactions) if not pipelines else []
+
+def transactions_committed(transactions, results=()):
+    """Called after new transactions are committed, with the results scored inline in the same commit"""
+    change_feed.publish('transaction', transactions)
+    if pipelines:
+        if scoring_owner is not None and not scoring_owner.is_owner():
+            return # found by the owner's pipelines within SCORING_POLL_SECONDS
+        for shard, group in shards.group_by_shard(transactions, lambda t: shards.shard_of_id(t['id'])).items():
+            pipelines[shard].submit(group)
+    else:
+        results_committed(results)
+
+# Optional group commit writers for POST /transactions/, one per shard: the shards are written in parallel
+writers = [GroupCommitWriter(WriteSessions[shard],
+                             window_ms=config.GROUP_COMMIT_WINDOW_MS,
+                             max_batch=config.GROUP_COMMIT_MAX_BATCH,
+                             predict=score_inline,
+                             on_commit=transactions_committed)
+           for shard in range(shards.shard_count())] if config.GROUP_COMMIT_ENABLED else []
+
+def combined_stats(components):
+    """Statistics of per-shard components: as they are for a single shard, otherwise listed per shard"""
+    if len(components) == 1:
+        return components[0].stats()
+    return {'shards': [component.stats() for component in components]}
+
+# Queues behind the requests, read at every scrape of GET /metrics
+metrics.Gauge('scoring_queue_depth', 'Committed transactions waiting to be scored, by shard', ('shard',),
+              function=lambda: {(str(shard),): pipeline.stats()['queued'] for shard, pipeline in enumerate(pipelines)})
+metrics.Gauge('group_commit_queue_depth', 'New transactions waiting for the group commit writer, by shard', ('shard',),
+              function=lambda: {(str(shard),): writer.stats()['queued'] for shard, writer in enumerate(writers)})
+metrics.Gauge('response_cache_entries', 'Responses in the response cache', function=lambda: response_cache.stats()['entries'] if response_cache else 0)
+
+# Admission control of the requests of both servers: in-flight limits and rate limits per user and role
+admission_control = AdmissionController(max_in_flight=config.ADMISSION_MAX_IN_FLIGHT,
+                                        max_writes_in_flight=config.ADMISSION_MAX_WRITES_IN_FLIGHT,
+                                        user_limit=parse_limit(config.RATE_LIMIT_USER),
+                                        role_limits=parse_role_limits(config.RATE_LIMIT_ROLES),
+                                        max_users=config.RATE_LIMIT_MAX_USERS,
+                                        retry_after=config.ADMISSION_RETRY_AFTER)
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+metrics.Gauge('admission_in_flight', 'Admitted requests being handled, all of them and the writing ones', ('kind',),
+              function=lambda: dict(zip([('all',), ('write',)], admission_control.in_flight())))
+
+# Cold tier: transactions moved out of the tables by "python archive.py run" are still read from the archive files
+archive_store = ArchiveStore(config.ARCHIVE_DIR, max_partitions=config.ARCHIVE_CACHE_PARTITIONS)
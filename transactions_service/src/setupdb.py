@@ -1,10 +1,99 @@
-from sqlalchemy import create_engine, ForeignKey, Column, String, Integer, CHAR, DateTime, FLOAT, BOOLEAN, Enum
+from sqlalchemy import create_engine, event, make_url, ForeignKey, Column, String, Integer, CHAR, DateTime, FLOAT, BOOLEAN, Enum
 from datetime import datetime
 import enum
+import os
+import threading
 from sqlalchemy.orm import sessionmaker, declarative_base
+import config
+from common import metrics
 
 Base = declarative_base()
 
-engine = create_engine("sqlite:///bank_system.db", connect_args={"check_same_thread":False}) # check_same_thread - SQLite specific; allow Flask multiple threads
+# SQLite has one writer at a time per database file. Writers of this process queue on a lock per file instead
+# of polling SQLite's busy handler, which lets a waiting thread starve when many threads write at once.
+_write_locks = {}
 
-Session = sessionmaker(bind=engine)
\ No newline at end of file
+def _reset_write_locks():
+    for url in _write_locks:
+        _write_locks[url] = threading.Lock() # a forked child must not inherit a lock held by a thread of the parent
+
+os.register_at_fork(after_in_child=_reset_write_locks)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLite performance profile, applied to every new connection of the pool"""
+    dbapi_connection.isolation_level = None # the driver must not emit BEGIN itself, begin_transaction does
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}") # WAL: readers do not block behind the writer
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}") # NORMAL is safe with WAL and fsyncs far less than FULL
+    cursor.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}") # wait for the write lock instead of "database is locked"
+    cursor.execute(f"PRAGMA cache_size={int(config.SQLITE_CACHE_SIZE)}")
+    cursor.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+def begin_transaction(connection):
+    """
+    Write sessions take the write lock up front (BEGIN IMMEDIATE), so busy_timeout applies to them.
+    A deferred transaction that reads first and writes later fails at once with "database is locked"
+    when another writer committed in between.
+    """
+    if not connection.get_execution_options().get("sqlite_immediate"):
+        connection.exec_driver_sql("BEGIN")
+        return
+    # after the timeout, BEGIN IMMEDIATE waits in SQLite's busy handler like a writer of another process.
+    # Engines of the asyncio mode have no lock here: a thread lock would block the event loop, asyncapp.py queues its writers itself
+    lock = _write_locks.get(str(connection.engine.url))
+    if lock is not None and lock.acquire(timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000):
+        connection.info["write_lock"] = lock
+    try:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    except Exception:
+        release_write_lock(connection)
+        raise
+
+def release_write_lock(connection):
+    lock = connection.info.pop("write_lock", None)
+    if lock is not None:
+        lock.release()
+
+def make_engine(url):
+    engine = create_engine(url,
+                           connect_args={"check_same_thread":False}, # check_same_thread - SQLite specific; allow Flask multiple threads
+                           pool_size=config.DB_POOL_SIZE, # connections kept open, about the number of concurrent requests
+                           max_overflow=config.DB_MAX_OVERFLOW, # extra connections under bursts, closed when returned
+                           pool_timeout=config.DB_POOL_TIMEOUT)
+    _write_locks[str(engine.url)] = threading.Lock()
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(engine, "begin", begin_transaction)
+    event.listen(engine, "commit", release_write_lock)
+    event.listen(engine, "rollback", release_write_lock)
+    metrics.instrument_engine(engine)
+    return engine
+
+def make_async_engine(url):
+    """The same engine for the asyncio mode (asyncapp.py), over the aiosqlite driver"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+    engine = create_async_engine(make_url(url).set(drivername="sqlite+aiosqlite"),
+                                 pool_size=config.DB_POOL_SIZE,
+                                 max_overflow=config.DB_MAX_OVERFLOW,
+                                 pool_timeout=config.DB_POOL_TIMEOUT)
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    event.listen(engine.sync_engine, "begin", begin_transaction)
+    metrics.instrument_engine(engine.sync_engine)
+    return engine
+
+def shard_url(shard):
+    """Shard 0 is the database of DATABASE_URL, so an unsharded deployment keeps its file"""
+    return config.DATABASE_URL if shard == 0 else config.SHARD_URL_TEMPLATE.format(shard=shard)
+
+# One engine per shard (see shards.py); with SHARD_COUNT=1 there is just the one database
+engines = [make_engine(shard_url(shard)) for shard in range(config.SHARD_COUNT)]
+
+def _drop_inherited_connections():
+    for engine in engines:
+        engine.dispose(close=False) # a forked worker opens its own connections, the parent's (e.g. of the warm-up before gunicorn forks) stay with the parent
+
+os.register_at_fork(after_in_child=_drop_inherited_connections)
+Sessions = [sessionmaker(bind=e) for e in engines]
+WriteSessions = [sessionmaker(bind=e.execution_options(sqlite_immediate=True)) for e in engines]
+
+engine, Session, WriteSession = engines[0], Sessions[0], WriteSessions[0]
@@ -0,0 +1,211 @@
+import contextvars
+import csv
+import heapq
+import itertools
+import os
+import queue
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, insert, make_url, select, text
+import config
+import dbmodels
+from setupdb import Base, engines, make_engine, shard_url
+
+# Hash sharding: a transaction and its result live in the database of shard crc32(customer) % SHARD_COUNT.
+# Ids are globally unique because every shard hands out ids from its own range: the shard number sits in the
+# bits above ID_SHARD_BITS, so the shard of an id is known without asking any database. Shard 0 starts at 0,
+# which keeps the ids of an unsharded database valid.
+
+ID_SHARD_BITS = 40 # about 10^12 ids per shard
+ID_TABLES = ('transactions', 'results')
+
+def shard_count():
+    return len(engines)
+
+def shard_of_customer(customer, count=None):
+    # crc32, not hash(): it has to be the same in every process and after every restart
+    return zlib.crc32(customer.encode('utf-8')) % (count or shard_count())
+
+def shard_of_id(id):
+    """Shard of a transaction or result id, or None if the id belongs to no shard"""
+    shard = id >> ID_SHARD_BITS
+    return shard if 0 <= shard < shard_count() else None
+
+def shards_for(customer=None):
+    """Shards a query has to ask: the customer's one, or all of them"""
+    return [shard_of_customer(customer)] if customer is not None else list(range(shard_count()))
+
+def group_by_shard(items, shard_of):
+    """{shard: items of that shard}, keeping the order of items within a shard"""
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_of(item), []).append(item)
+    return groups
+
+def init_database(engine, shard):
+    """Create missing tables and indexes, and start the id sequences of the shard at its offset"""
+    Base.metadata.create_all(bind=engine)
+    # create_all only creates indexes together with new tables, so add missing ones to an existing database file
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    base = shard << ID_SHARD_BITS
+    if base:
+        with engine.begin() as conn:
+            for name in ID_TABLES:
+                params = {'name': name, 'base': base}
+                conn.execute(text("UPDATE sqlite_sequence SET seq = :base WHERE name = :name AND seq < :base"), params)
+                conn.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT :name, :base WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"), params)
+
+def init_shards():
+    for shard, engine in enumerate(engines):
+        init_database(engine, shard)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _executor():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid(): # the threads of a pool do not survive a fork
+            _pool = ThreadPoolExecutor(max_workers=max(1, min(config.SHARD_WORKERS, shard_count())), thread_name_prefix='shard')
+            _pool_pid = os.getpid()
+        return _pool
+
+def fan_out(fn, shards=None):
+    """Call fn(shard) for every given shard (default: all), in parallel when there are several; returns the results in shard order"""
+    shards = list(range(shard_count())) if shards is None else list(shards)
+    if len(shards) == 1:
+        return [fn(shards[0])]
+    # Every call runs in a copy of the caller's context, so e.g. its SQL time counts for the caller's route (metrics.current_route)
+    futures = [_executor().submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+    return [future.result() for future in futures]
+
+def merge_sorted(lists, limit, key=lambda row: row['id']):
+    """The first limit rows of lists that are each sorted by key"""
+    return list(itertools.islice(heapq.merge(*lists, key=key), limit))
+
+_END = object()
+
+def merged_stream(streams, key):
+    """
+    Merge streams of row chunks that are each sorted by key into one stream of rows.
+    Every stream is read ahead by its own thread (a few chunks at most), so the shards are queried in parallel
+    while the merge goes on. Closing the generator stops the readers.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=2) for _ in streams]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(stream, q):
+        try:
+            for chunk in stream:
+                if not put(q, chunk):
+                    break
+            else:
+                put(q, _END)
+        except Exception as e:
+            put(q, e)
+        finally:
+            stream.close()
+
+    def rows(q):
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    for stream, q in zip(streams, queues):
+        threading.Thread(target=contextvars.copy_context().run, args=(read, stream, q), name='shard-reader', daemon=True).start()
+    try:
+        yield from heapq.merge(*(rows(q) for q in queues), key=key)
+    finally:
+        stop.set()
+
+def rebalance(count, target_dir, chunk_size=10000):
+    """
+    Copy all transactions and results into count new shard databases in target_dir, routed by the new shard count.
+    Rows get new ids (the shard is part of the id); the old -> new ids are written to target_dir/id_map.csv.
+    The current databases are only read. Returns the number of copied transactions and results.
+    """
+    import rollups
+    from sqlalchemy.orm import Session
+    for source in engines:
+        with source.connect() as conn:
+            if conn.scalar(select(func.count()).select_from(dbmodels.ArchivePartition)):
+                raise ValueError("The shards have archived transactions (see archive.py), which rebalance does not move")
+    os.makedirs(target_dir, exist_ok=True)
+    targets = []
+    for shard in range(count):
+        path = os.path.join(target_dir, os.path.basename(make_url(shard_url(shard)).database))
+        target = make_engine(f'sqlite:///{path}')
+        init_database(target, shard)
+        targets.append(target)
+
+    t, r = dbmodels.Transaction, dbmodels.Result
+    transaction_columns = ('customer', 'timestamp', 'status', 'vendor_id', 'amount')
+    result_columns = ('transaction_id', 'timestamp', 'is_fraudulent', 'confidence')
+    new_ids = {} # old transaction id -> new transaction id, needed for the results
+    copied = [0, 0]
+    with open(os.path.join(target_dir, 'id_map.csv'), 'w', newline='') as f:
+        id_map = csv.writer(f)
+        id_map.writerow(('table', 'old_id', 'new_id'))
+        sessions = [Session(bind=target) for target in targets]
+        try:
+            for source in engines:
+                with source.connect() as conn:
+                    stmt = select(t.id, *(getattr(t, name) for name in transaction_columns)).order_by(t.id)
+                    for rows in conn.execution_options(yield_per=chunk_size).execute(stmt).partitions():
+                        for shard, group in group_by_shard(rows, lambda row: shard_of_customer(row.customer, count)).items():
+                            ids = sessions[shard].scalars(insert(t).returning(t.id, sort_by_parameter_order=True),
+                                                          [dict(zip(transaction_columns, row[1:])) for row in group]).all()
+                            for row, new_id in zip(group, ids):
+                                new_ids[row.id] = new_id
+                                id_map.writerow(('transactions', row.id, new_id))
+                            copied[0] += len(group)
+                        for db in sessions:
+                            db.commit()
+
+                    stmt = select(r.id, *(getattr(r, name) for name in result_columns)).order_by(r.id)
+                    for rows in conn.execution_options(yield_per=chunk_size).execute(stmt).partitions():
+                        rows = [row for row in rows if row.transaction_id in new_ids] # results without their transaction are dropped
+                        for shard, group in group_by_shard(rows, lambda row: new_ids[row.transaction_id] >> ID_SHARD_BITS).items():
+                            values = [dict(zip(result_columns, (new_ids[row.transaction_id],) + tuple(row[2:]))) for row in group]
+                            ids = sessions[shard].scalars(insert(r).returning(r.id, sort_by_parameter_order=True), values).all()
+                            id_map.writerows(('results', row.id, new_id) for row, new_id in zip(group, ids))
+                            copied[1] += len(group)
+                        for db in sessions:
+                            db.commit()
+            for db in sessions:
+                rollups.rebuild(db)
+                db.commit()
+        finally:
+            for db in sessions:
+                db.close()
+    return tuple(copied)
+
+
+if __name__ == '__main__':
+    # python shards.py rebalance <shard count> <target folder>
+    if len(sys.argv) != 4 or sys.argv[1] != 'rebalance':
+        sys.exit("usage: python shards.py rebalance <shard count> <target folder>")
+    try:
+        transactions, results = rebalance(int(sys.argv[2]), sys.argv[3])
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f"Copied {transactions} transactions and {results} results into {sys.argv[2]} shards in {sys.argv[3]}. "
+          f"Stop the service, move the files in place of the current databases and start it with SHARD_COUNT={sys.argv[2]}")
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The service reads its settings from the environment when its modules are imported, so they are set first:
+# fresh SQLite files in a temporary folder, two shards, inline scoring and tokens only checked for their role prefix.
+# Run from transactions_service: python -m pytest tests
+FOLDER = tempfile.mkdtemp(prefix='transactions_service_tests_')
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(FOLDER, 'bank_system.db'),
+    'SHARD_COUNT': '2',
+    'SHARD_URL_TEMPLATE': 'sqlite:///' + os.path.join(FOLDER, 'bank_system_{shard}.db'),
+    'RESPONSE_CACHE_PATH': os.path.join(FOLDER, 'response_cache.db'),
+    'SCORING_LOCK_PATH': os.path.join(FOLDER, 'scoring.lock'),
+    'ARCHIVE_DIR': os.path.join(FOLDER, 'archive'),
+    'AUTH_MODE': 'header',
+    'SCORING_MODE': 'inline',
+    'SCORER': 'mock',
+    'FEED_SYNC_SECONDS': '0',
+})
+os.environ.pop('TOKEN_SECRET', None)
+os.chdir(FOLDER) # the request log file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+import app as service # noqa: E402
+import shards # noqa: E402
+
+shards.init_shards()
+
+@pytest.fixture
+def client():
+    return service.app.test_client()
+
+@pytest.fixture
+def admin():
+    """Headers of an administrator; AUTH_MODE=header only checks the role prefix of the token"""
+    return {'Authorization': 'administrator:test', 'Username': 'admin'}
@@ -0,0 +1,65 @@
+import json
+import uuid
+import dbwrites
+
+def transaction(customer=None, amount=10.0):
+    return {'customer': customer or uuid.uuid4().hex, 'vendor_id': 'vendor', 'amount': amount}
+
+def test_all_valid_transactions_are_created(client, admin):
+    items = [transaction(amount=amount) for amount in (1, 2.5, 3)]
+    response = client.post('/transactions/batch', json=items, headers=admin)
+    assert response.status_code == 201
+    assert response.json['created'] == 3 and response.json['failed'] == 0
+    for item, outcome in zip(items, response.json['items']):
+        created = client.get(f"/transactions/{outcome['id']}", headers=admin).json
+        assert created['customer'] == item['customer'] and created['amount'] == item['amount']
+        assert created['status'] == 'submitted'
+
+def test_invalid_transactions_are_reported_by_index(client, admin):
+    items = [transaction(), {'customer': '', 'vendor_id': 'vendor', 'amount': 1}, transaction(),
+             {'customer': 'c', 'vendor_id': 'vendor', 'amount': True}, 'not an object',
+             {'customer': 'c', 'vendor_id': None, 'amount': 1}, {'customer': 'c', 'vendor_id': 'vendor', 'amount': '5'}]
+    response = client.post('/transactions/batch', json=items, headers=admin)
+    assert response.status_code == 207
+    assert response.json['created'] == 2 and response.json['failed'] == 5
+    outcome = response.json['items']
+    assert [item['index'] for item in outcome] == list(range(len(items)))
+    assert 'id' in outcome[0] and 'id' in outcome[2]
+    assert outcome[1]['error'] == "'customer' must be a non-empty string"
+    assert outcome[3]['error'] == "'amount' must be a number"
+    assert outcome[4]['error'] == 'Transaction must be a JSON object'
+    assert outcome[5]['error'] == "'vendor_id' must be a non-empty string"
+    assert outcome[6]['error'] == "'amount' must be a number"
+    assert all('id' not in item for number, item in enumerate(outcome) if number not in (0, 2))
+
+def test_batch_without_valid_transactions_is_rejected(client, admin):
+    response = client.post('/transactions/batch', json=[{'customer': 'c'}], headers=admin)
+    assert response.status_code == 400
+    assert response.json['created'] == 0 and response.json['failed'] == 1
+
+def test_body_must_be_an_array(client, admin):
+    for body in ({'customer': 'c', 'vendor_id': 'v', 'amount': 1}, None):
+        response = client.post('/transactions/batch', json=body, headers=admin)
+        assert response.status_code == 400
+        assert response.json == {'error': 'Expected a JSON array of transactions'}
+    response = client.post('/transactions/batch', data='[{', content_type='application/json', headers=admin)
+    assert response.status_code == 400
+
+def test_ndjson(client, admin):
+    body = '\n'.join(json.dumps(item) for item in (transaction(), transaction())) + '\n\n'
+    response = client.post('/transactions/batch', data=body, content_type='application/x-ndjson', headers=admin)
+    assert response.status_code == 201 and response.json['created'] == 2
+
+    body = json.dumps(transaction()) + '\n{"customer": \n'
+    response = client.post('/transactions/batch', data=body, content_type='application/x-ndjson', headers=admin)
+    assert response.status_code == 400
+    assert response.json == {'error': 'Invalid JSON on line 2'}
+
+def test_batch_size_limit(client, admin, monkeypatch):
+    monkeypatch.setattr(dbwrites, 'BATCH_SIZE_MAX', 2)
+    response = client.post('/transactions/batch', json=[transaction() for _ in range(3)], headers=admin)
+    assert response.status_code == 413
+
+def test_batch_needs_a_token(client):
+    response = client.post('/transactions/batch', json=[transaction()])
+    assert response.status_code == 401
@@ -0,0 +1,92 @@
+import uuid
+import app as service
+
+def create(client, admin, count=1):
+    ids = []
+    for _ in range(count):
+        response = client.post('/transactions/', json={'customer': uuid.uuid4().hex, 'vendor_id': 'vendor', 'amount': 10.0}, headers=admin)
+        assert response.status_code == 201
+        ids.append(response.json['id'])
+    return ids
+
+def feed(client, admin, cursor=None, limit=None, status_code=200):
+    query = {'timeout': 0}
+    if cursor is not None:
+        query['cursor'] = cursor
+    if limit is not None:
+        query['limit'] = limit
+    response = client.get('/feed/', query_string=query, headers=admin)
+    assert response.status_code == status_code, response.json
+    return response.json
+
+def read_all(client, admin, cursor, limit):
+    """Every event after cursor, read limit at a time; returns (events, cursor, answers)"""
+    events, answers = [], []
+    while True:
+        answer = feed(client, admin, cursor, limit)
+        if not answer['events']:
+            return events, answer['cursor'], answers
+        answers.append(answer['events'])
+        events += answer['events']
+        cursor = answer['cursor']
+
+def changes(events):
+    return [(event['type'], event['data'].get('id') if event['type'] != 'result' else event['data']['transaction_id']) for event in events]
+
+def test_feed_starts_from_now_and_continues_after_the_cursor(client, admin):
+    cursor = feed(client, admin)['cursor']
+    first, second = create(client, admin, 2)
+    client.put(f'/transactions/{first}', json={'status': 'accepted'}, headers=admin)
+    answer = feed(client, admin, cursor)
+    assert changes(answer['events']) == [('transaction', first), ('result', first), ('transaction', second), ('result', second), ('status', first)]
+    assert answer['events'][-1]['data'] == {'id': first, 'status': 'accepted'}
+    assert answer['cursor'] == answer['events'][-1]['cursor']
+    assert feed(client, admin, answer['cursor'])['events'] == []
+    # every event's cursor continues right after it
+    assert changes(feed(client, admin, answer['events'][1]['cursor'])['events']) == changes(answer['events'][2:])
+
+def test_buffered_reads_respect_the_limit(client, admin):
+    cursor = feed(client, admin)['cursor']
+    ids = create(client, admin, 3)
+    events, _, answers = read_all(client, admin, cursor, limit=2)
+    assert [len(answer) for answer in answers] == [2, 2, 2]
+    assert changes(events) == [change for i in ids for change in (('transaction', i), ('result', i))]
+
+def test_catch_up_from_zero_replays_every_transaction_within_the_limit(client, admin):
+    ids = create(client, admin, 5)
+    events, cursor, answers = read_all(client, admin, '0', limit=3)
+    assert all(len(answer) <= 3 for answer in answers)
+    replayed = changes(events)
+    transactions = [i for kind, i in replayed if kind == 'transaction']
+    assert len(transactions) == len(set(transactions)) and set(ids) <= set(transactions)
+    assert transactions == sorted(transactions) # merged over the shards in id order
+    for position, (kind, i) in enumerate(replayed):
+        if kind == 'result':
+            assert replayed[position - 1] == ('transaction', i) # right after its transaction, in the same answer
+    # caught up: the cursor is one of the buffer now, new transactions follow
+    assert not cursor.startswith('0.')
+    new = create(client, admin)[0]
+    assert changes(feed(client, admin, cursor)['events']) == [('transaction', new), ('result', new)]
+
+def test_catch_up_does_not_split_a_transaction_and_its_result(client, admin):
+    create(client, admin, 2)
+    answer = feed(client, admin, '0', limit=1)
+    assert [event['type'] for event in answer['events']] == ['transaction', 'result']
+    assert answer['events'][0]['data']['id'] == answer['events'][1]['data']['transaction_id']
+    following = feed(client, admin, answer['cursor'], limit=1)['events']
+    assert following[0]['type'] == 'transaction' and following[0]['data']['id'] != answer['events'][0]['data']['id']
+
+def test_cursor_out_of_the_buffer_catches_up_from_the_database(client, admin):
+    cursor = feed(client, admin)['cursor']
+    ids = create(client, admin, 2)
+    epoch, seq, positions = cursor.split('.')
+    stale = f'gone.{seq}.{positions}' # e.g. of a restarted process: only its positions are used
+    events, cursor, _ = read_all(client, admin, stale, limit=100)
+    # in id order, merged over the shards, rather than in the order of the commits
+    assert changes(events) == [change for i in sorted(ids) for change in (('transaction', i), ('result', i))]
+    assert cursor.split('.')[0] == service.change_feed.epoch
+
+def test_invalid_cursors_are_rejected(client, admin):
+    for cursor in ('abc', 'x.y.1-2', 'x.1.1-2-3', 'x.1.a-b', 'x.1'):
+        assert 'error' in feed(client, admin, cursor, status_code=400)
+    assert feed(client, admin, 'x.1.1', status_code=400)['error'] == 'Cursor of another shard count, start again with the cursor 0'
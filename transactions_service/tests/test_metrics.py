@@ -0,0 +1,18 @@
+from common import metrics
+
+def statements(route):
+    return metrics.route_statements._values.get((route,), 0)
+
+def test_sql_of_the_shard_fan_out_counts_for_the_route(client, admin):
+    client.get('/transactions/', headers=admin) # connections and archive manifests of both shards are set up
+    before, background = statements('/transactions/'), statements('background')
+    response = client.get('/transactions/', headers=admin)
+    assert response.status_code == 200
+    assert statements('/transactions/') - before >= 2 # one page query per shard, both run by the fan-out threads
+    assert statements('background') == background
+
+def test_metrics_are_served(client, admin):
+    client.get('/transactions/', headers=admin)
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'http_requests_total{route="/transactions/",method="GET",status="200"}' in body
+    assert 'sql_route_seconds_total{route="/transactions/"}' in body
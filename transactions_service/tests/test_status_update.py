@@ -0,0 +1,58 @@
+import uuid
+
+def create(client, admin, customer, count=2, vendor_id='vendor'):
+    items = [{'customer': customer, 'vendor_id': vendor_id, 'amount': 10.0} for _ in range(count)]
+    response = client.post('/transactions/batch', json=items, headers=admin)
+    assert response.status_code == 201
+    return [item['id'] for item in response.json['items']]
+
+def statuses(client, admin, ids):
+    return [client.get(f'/transactions/{i}', headers=admin).json['status'] for i in ids]
+
+def test_update_by_filter_only_touches_matching_rows(client, admin):
+    customer, other = uuid.uuid4().hex, uuid.uuid4().hex
+    ids, other_ids = create(client, admin, customer), create(client, admin, other)
+    response = client.put('/transactions/status', json={'status': 'accepted', 'filter': {'customer': customer}}, headers=admin)
+    assert response.status_code == 200
+    assert response.json['updated'] == 2
+    assert [item['id'] for item in response.json['items']] == sorted(ids)
+    assert statuses(client, admin, ids) == ['accepted', 'accepted']
+    assert statuses(client, admin, other_ids) == ['submitted', 'submitted']
+
+def test_update_by_ids_with_transition_guard(client, admin):
+    ids = create(client, admin, uuid.uuid4().hex)
+    client.put('/transactions/status', json={'status': 'accepted', 'ids': ids[:1]}, headers=admin)
+    response = client.put('/transactions/status', json={'status': 'rejected', 'ids': ids + [0], 'from_status': ['submitted']}, headers=admin)
+    assert response.status_code == 200
+    assert [(item['id'], item['outcome']) for item in response.json['items']] == [(ids[0], 'rejected'), (ids[1], 'updated'), (0, 'not_found')]
+    assert statuses(client, admin, ids) == ['accepted', 'rejected']
+
+def test_invalid_filter_values_are_rejected(client, admin):
+    ids = create(client, admin, uuid.uuid4().hex)
+    for filters, error in (({'customer': None}, "'customer' must be a non-empty string"),
+                           ({'customer': ''}, "'customer' must be a non-empty string"),
+                           ({'customer': 5}, "'customer' must be a non-empty string"),
+                           ({'vendor_id': ['a']}, "'vendor_id' must be a non-empty string"),
+                           ({'vendor_id': None}, "'vendor_id' must be a non-empty string"),
+                           ({'status': None}, None), ({'since': None}, None), ({'until': 5}, None),
+                           ({'amount': 1}, 'Unknown filter fields: amount'), ({}, None), (None, None), ('customer', None)):
+        body = {'status': 'rejected', 'filter': filters} if filters is not None else {'status': 'rejected'}
+        response = client.put('/transactions/status', json=body, headers=admin)
+        assert response.status_code == 400, filters
+        if error:
+            assert response.json['error'] == error
+    assert statuses(client, admin, ids) == ['submitted', 'submitted']
+
+def test_from_status_must_be_a_list(client, admin):
+    customer = uuid.uuid4().hex
+    ids = create(client, admin, customer)
+    for from_status in ('submitted', {'submitted': 1}, 5, ['unknown']):
+        response = client.put('/transactions/status', json={'status': 'accepted', 'filter': {'customer': customer}, 'from_status': from_status}, headers=admin)
+        assert response.status_code == 400, from_status
+    assert statuses(client, admin, ids) == ['submitted', 'submitted']
+
+def test_ids_and_filter_are_exclusive(client, admin):
+    ids = create(client, admin, uuid.uuid4().hex)
+    for body in ({'status': 'accepted', 'ids': ids, 'filter': {'customer': 'c'}}, {'status': 'accepted', 'ids': ['1']},
+                 {'status': 'accepted', 'ids': [True]}, {'ids': ids}, ['accepted']):
+        assert client.put('/transactions/status', json=body, headers=admin).status_code == 400, body
@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import pytest
+import requests
+import app as service
+from authclient import AuthClient, AuthServiceUnavailable
+from common.signedtokens import sign_token
+
+SECRET = b'test secret'
+
+class FakeAuthClient:
+    """Stands in for the auth service's list of logged out tokens"""
+
+    def __init__(self, revoked=(), available=True):
+        self.revoked = set(revoked)
+        self.available = available
+
+    def is_revoked(self, jti):
+        if not self.available:
+            raise AuthServiceUnavailable('down')
+        return jti in self.revoked
+
+@pytest.fixture
+def signed(monkeypatch):
+    """Signed tokens are verified with SECRET; returns the fake auth client"""
+    auth_client = FakeAuthClient()
+    monkeypatch.setattr(service.config, 'TOKEN_SECRET', SECRET)
+    monkeypatch.setattr(service, 'auth_client', auth_client)
+    return auth_client
+
+def get(client, token, username='alice'):
+    return client.get('/transactions/', headers={'Authorization': token, 'Username': username})
+
+def test_signed_token_is_accepted(client, signed):
+    assert get(client, sign_token(SECRET, 'alice', 'agent', 60)).status_code == 200
+
+def test_tampered_tokens_are_rejected(client, signed):
+    token = sign_token(SECRET, 'alice', 'agent', 60)
+    message, _, signature = token.rpartition('.')
+    role, _, payload = message.partition(':')
+    for tampered in (f"{message}.{signature[:-1]}{'A' if signature[-1] != 'A' else 'B'}", # signature changed
+                     f"{role}:{payload[:-1]}{'A' if payload[-1] != 'A' else 'B'}.{signature}", # payload changed
+                     f"administrator:{payload}.{signature}", # role changed
+                     sign_token(b'other secret', 'alice', 'agent', 60),
+                     message, 'agent:', 'agent:.'):
+        response = get(client, tampered)
+        assert response.status_code == 401, tampered
+        assert response.json['error'] == 'Invalid or expired token'
+
+def test_non_ascii_tokens_are_rejected(client, signed):
+    # Header values arrive as latin-1 text, so the token may hold any of those characters
+    for token in ('agent:éx.y', 'agent:abc.é', 'agent:abcÿ.éé'):
+        assert get(client, token).status_code == 401
+
+def test_token_of_another_user_is_rejected(client, signed):
+    assert get(client, sign_token(SECRET, 'bob', 'agent', 60)).status_code == 401
+
+def test_expired_token_is_rejected(client, signed):
+    assert get(client, sign_token(SECRET, 'alice', 'agent', -1)).status_code == 401
+
+def forge(claims, role='agent'):
+    """Correctly signed token with any claims"""
+    message = f"{role}:{base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b'=').decode()}"
+    return f"{message}.{base64.urlsafe_b64encode(hmac.new(SECRET, message.encode(), hashlib.sha256).digest()).rstrip(b'=').decode()}"
+
+def test_signed_claims_are_checked(client, signed):
+    exp = int(time.time()) + 60
+    assert get(client, forge({'sub': 'alice', 'role': 'agent', 'exp': exp, 'jti': 'abc'})).status_code == 200
+    for claims in ({'sub': 'alice', 'role': 'agent', 'exp': exp}, {'role': 'agent', 'exp': exp, 'jti': 'abc'},
+                   {'sub': 'alice', 'role': 'agent', 'exp': str(exp), 'jti': 'abc'}, {'sub': 'alice', 'role': 'agent', 'exp': exp, 'jti': 5}):
+        assert get(client, forge(claims)).status_code == 401, claims
+
+def test_revoked_token_is_rejected(client, signed):
+    token = sign_token(SECRET, 'alice', 'agent', 60)
+    assert get(client, token).status_code == 200
+    signed.revoked.add(service.read_token(SECRET, token)['jti'])
+    assert get(client, token).status_code == 401
+
+def test_unknown_revocations_reject_the_request(client, signed):
+    signed.available = False
+    response = get(client, sign_token(SECRET, 'alice', 'agent', 60))
+    assert response.status_code == 401
+    assert response.json['error'] == 'Authentication service unavailable'
+
+class FakeResponse:
+    def __init__(self, revoked):
+        self.revoked = revoked
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'revoked': self.revoked}
+
+class FakeSession:
+    def __init__(self):
+        self.revoked, self.calls, self.fail = [], 0, False
+
+    def get(self, url, timeout):
+        self.calls += 1
+        if self.fail:
+            raise requests.ConnectionError('down')
+        return FakeResponse(list(self.revoked))
+
+def test_auth_client_refreshes_the_revoked_tokens(monkeypatch):
+    session = FakeSession()
+    auth_client = AuthClient('http://auth', ttl=60, revocation_refresh=5)
+    monkeypatch.setattr(auth_client, '_http', lambda: session)
+    now = [1000.0]
+    monkeypatch.setattr('authclient.time.monotonic', lambda: now[0])
+    assert not auth_client.is_revoked('a') and session.calls == 1
+    session.revoked.append('a')
+    assert not auth_client.is_revoked('a') and session.calls == 1 # list still fresh
+    now[0] += 5
+    assert auth_client.is_revoked('a') and session.calls == 2
+    # While the auth service is down the last list is used, until it is older than ttl
+    session.fail = True
+    now[0] += 30
+    assert auth_client.is_revoked('a')
+    now[0] += 30
+    with pytest.raises(AuthServiceUnavailable):
+        auth_client.is_revoked('a')